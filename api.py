@@ -3,16 +3,39 @@ TEMU SCRAPER API REST
 FastAPI backend para el sistema de scraping de Temu
 """
 
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+from fastapi import FastAPI, HTTPException, Header, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from pydantic import BaseModel, Field
-from typing import Optional, List
+from typing import Any, AsyncIterator, Optional, List
 import asyncio
-from datetime import datetime
+import codecs
+import csv
+import io
+import tempfile
+from datetime import datetime, timedelta
 import json
 import os
+import time
 
-from scraper import scrape_temu_search, scrape_single_product, generate_affiliate_link
+from scraper import (
+    scrape_temu_search, scrape_single_product, scrape_products_batch,
+    coalesced_search_events, search_flights, page_flights, normalize_query
+)
+from browser_pool import browser_pool
+from extractors import extraction_telemetry
+from cache import extraction_cache, response_cache, response_cache_key, STALE
+from readiness import readiness_stats
+from resource_blocking import resource_blocker
+from config import BATCH_MAX_URLS, TEMU_AFFILIATE_ID
+from temu_url_parser import canonicalize, generate_affiliate_link
+from jobs import job_manager, Job, QueueFullError
+from database import db
+from persistence import persistence
+from result_store import result_store
+from refresh import refresh_scheduler
+from llm_dispatch import llm_dispatcher
+from tracing import metrics, stage, trace, current_trace, TimingMiddleware
 
 # ================== CONFIGURACIÓN ==================
 
@@ -31,6 +54,27 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Tiempos por request (histograma por ruta + cabecera Server-Timing)
+app.add_middleware(TimingMiddleware)
+
+# ================== CICLO DE VIDA ==================
+
+@app.on_event("startup")
+async def startup_event():
+    """Arranca el pool de navegadores compartido, la persistencia, los workers de jobs y el refresco"""
+    await browser_pool.start()
+    await persistence.start()
+    await job_manager.start()
+    await refresh_scheduler.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Detiene el refresco y los workers de jobs, vacía la persistencia y cierra los navegadores del pool"""
+    await refresh_scheduler.stop()
+    await job_manager.stop()
+    await persistence.stop()
+    await browser_pool.close()
+
 # ================== MODELOS DE REQUEST ==================
 
 class SearchRequest(BaseModel):
@@ -47,57 +91,17 @@ class ProductURLRequest(BaseModel):
     """Request para scrape de producto individual"""
     product_url: str = Field(..., description="URL del producto en Temu")
 
+class ProductBatchRequest(BaseModel):
+    """Request para scrape de muchos productos en paralelo"""
+    product_urls: List[str] = Field(..., min_length=1, max_length=BATCH_MAX_URLS, description="URLs de productos en Temu")
+    max_concurrency: Optional[int] = Field(None, ge=1, le=50, description="Scrapes simultáneos (opcional)")
+    per_host_rps: Optional[float] = Field(None, ge=0.0, description="Requests por segundo por host (opcional, solo puede bajar el límite global)")
+
 class AffiliateLinkRequest(BaseModel):
     """Request para generar link de afiliado"""
     product_url: str = Field(..., description="URL del producto")
     affiliate_id: Optional[str] = Field(None, description="ID de afiliado (opcional)")
 
-# ================== STORAGE SIMPLE (JSON) ==================
-
-RESULTS_DIR = "results"
-os.makedirs(RESULTS_DIR, exist_ok=True)
-
-def save_results(data: dict, prefix: str = "search") -> str:
-    """Guarda resultados en archivo JSON"""
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    filename = f"{prefix}_{timestamp}.json"
-    filepath = os.path.join(RESULTS_DIR, filename)
-
-    with open(filepath, "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
-
-    return filename
-
-def load_results(filename: str) -> dict:
-    """Carga resultados desde archivo JSON"""
-    filepath = os.path.join(RESULTS_DIR, filename)
-
-    if not os.path.exists(filepath):
-        raise FileNotFoundError(f"Results file not found: {filename}")
-
-    with open(filepath, "r", encoding="utf-8") as f:
-        return json.load(f)
-
-def list_all_results() -> List[dict]:
-    """Lista todos los resultados guardados"""
-    results = []
-
-    for filename in os.listdir(RESULTS_DIR):
-        if filename.endswith(".json"):
-            filepath = os.path.join(RESULTS_DIR, filename)
-            stat = os.stat(filepath)
-
-            results.append({
-                "filename": filename,
-                "created_at": datetime.fromtimestamp(stat.st_ctime).isoformat(),
-                "size_kb": round(stat.st_size / 1024, 2)
-            })
-
-    # Ordenar por fecha más reciente
-    results.sort(key=lambda x: x["created_at"], reverse=True)
-
-    return results
-
 # ================== ENDPOINTS ==================
 
 @app.get("/")
@@ -108,9 +112,18 @@ async def root():
         "version": "1.0.0",
         "endpoints": {
             "search": "/api/search",
+            "search_stream": "/api/search/stream",
             "product": "/api/product",
+            "products_batch": "/api/products/batch",
+            "catalog": "/api/products",
+            "stats": "/api/stats",
+            "price_history": "/api/products/{product_id}/prices",
+            "refresh": "/api/refresh/queue",
+            "jobs": "/api/jobs/{job_id}",
             "affiliate": "/api/affiliate",
+            "affiliate_batch": "/api/affiliate/batch",
             "results": "/api/results",
+            "telemetry": "/api/telemetry",
             "docs": "/docs"
         }
     }
@@ -120,69 +133,495 @@ async def health_check():
     """Health check"""
     return {
         "status": "healthy",
+        "timestamp": datetime.now().isoformat(),
+        "browser_pool": browser_pool.stats()
+    }
+
+@app.get("/api/telemetry")
+async def get_telemetry():
+    """
+    Telemetría de scraping: camino de extracción usado por página y estado del pool
+    """
+    return {
+        "success": True,
+        "extraction": extraction_telemetry.snapshot(),
+        "extraction_cache": extraction_cache.stats(),
+        "llm": llm_dispatcher.stats(),
+        "response_cache": response_cache.stats(),
+        "readiness": readiness_stats.snapshot(),
+        "resource_blocking": resource_blocker.stats(),
+        "browser_pool": browser_pool.stats(),
+        "database_pool": db.pool_stats(),
+        "persistence": persistence.stats(),
+        "result_store": await result_store.stats(),
+        "refresh": refresh_scheduler.stats(),
+        "url_cache": canonicalize.cache_info()._asdict(),
+        "jobs": job_manager.stats(),
+        "coalescing": {
+            "search": search_flights.stats(),
+            "search_page": page_flights.stats()
+        },
         "timestamp": datetime.now().isoformat()
     }
 
-@app.post("/api/search")
-async def search_products(request: SearchRequest, background_tasks: BackgroundTasks):
+# ================== MÉTRICAS (PROMETHEUS) ==================
+
+# Estado de los componentes leído de sus stats() en cada scrape
+metrics.gauge_function("temu_browser_pool_idle", "Navegadores libres en el pool", lambda: browser_pool.stats()["idle"])
+metrics.gauge_function("temu_browser_pool_alive", "Navegadores vivos en el pool", lambda: browser_pool.stats()["alive"])
+metrics.counter_function("temu_browser_leases_total", "Leases de navegador entregados", lambda: browser_pool.leases)
+metrics.counter_function("temu_browser_launches_total", "Navegadores lanzados", lambda: browser_pool.launched)
+metrics.gauge_function(
+    "temu_llm_waiting", "Extracciones esperando cupo RPM/TPM del proveedor LLM",
+    lambda: {provider: stats["waiting"] for provider, stats in llm_dispatcher.stats()["providers"].items()},
+    labels=("provider",)
+)
+metrics.gauge_function("temu_job_queue_size", "Jobs esperando en la cola", lambda: job_manager.stats()["queue_size"])
+metrics.gauge_function(
+    "temu_jobs", "Jobs retenidos por estado", lambda: job_manager.stats()["jobs"], labels=("status",)
+)
+metrics.gauge_function("temu_persistence_pending", "Lotes pendientes de escribir", lambda: persistence.stats()["pending"])
+metrics.counter_function("temu_persistence_dropped_total", "Lotes descartados por backpressure", lambda: persistence.dropped)
+metrics.counter_function(
+    "temu_extraction_cache_lookups_total", "Consultas a la caché de extracción LLM",
+    lambda: {"hit": extraction_cache.hits, "miss": extraction_cache.misses}, labels=("result",)
+)
+metrics.counter_function(
+    "temu_response_cache_lookups_total", "Consultas a la caché de respuestas",
+    lambda: dict(response_cache.counts), labels=("result",)
+)
+metrics.counter_function(
+    "temu_coalesced_total", "Scrapes que se unieron a uno idéntico en curso",
+    lambda: {"search": search_flights.coalesced, "search_page": page_flights.coalesced}, labels=("kind",)
+)
+metrics.counter_function(
+    "temu_refresh_pages_total", "Páginas re-scrapeadas por el refresco", lambda: refresh_scheduler.pages
+)
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
     """
-    Búsqueda de productos en Temu con filtros
+    Métricas en formato de texto de Prometheus
 
-    Retorna inmediatamente con task_id y procesa en background
+    Histogramas de duración por etapa y por ruta HTTP, contadores de scrapes
+    y el estado del pool, la cola de jobs, la persistencia y las cachés.
     """
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+# ================== JOBS (SCRAPING EN BACKGROUND) ==================
+
+def timing_breakdown() -> Optional[dict]:
+    """Desglose de tiempos por etapa de la traza en curso (job o request)"""
+    current = current_trace()
+    return current.breakdown() if current else None
+
+async def run_search_job(params: dict, job: Job) -> dict:
+    """Ejecuta una búsqueda encolada"""
+    key = response_cache_key(params)
+    started = time.perf_counter()
+    try:
+        with trace() as job_trace:
+            results = await scrape_temu_search(**params, progress_callback=job.update_progress)
+
+            if not results.get("success"):
+                results["timing"] = job_trace.breakdown()
+                await persistence.submit_search(results, params, time.perf_counter() - started)
+                raise RuntimeError(results.get("error", "Unknown error"))
+
+            return await store_search_results(results, params, key, time.perf_counter() - started)
+    finally:
+        response_cache.end_revalidation("search", key)
+
+async def store_search_results(results: dict, params: dict, key: str, execution_time: float) -> dict:
+    """Agrega metadata a una búsqueda exitosa, la guarda, la deja en caché y la persiste"""
+    results["timestamp"] = datetime.now().isoformat()
+    results["request_params"] = params
+
+    # Guardar resultados
+    with stage("result_store_save"):
+        results["saved_as"] = await result_store.save(results, prefix="search")
+
+    with stage("response_cache"):
+        await response_cache.set("search", key, results)
+    results["timing"] = timing_breakdown()
+    await persistence.submit_search(results, params, execution_time)
+    return results
+
+async def run_product_job(params: dict, job: Job) -> dict:
+    """Ejecuta el scrape de un producto encolado"""
+    key = response_cache_key(params)
     try:
-        # Ejecutar scraping
-        results = await scrape_temu_search(
-            search_query=request.search_query,
-            max_products=request.max_products,
-            min_rating=request.min_rating,
-            min_reviews=request.min_reviews,
-            min_sales=request.min_sales,
-            price_min=request.price_min,
-            price_max=request.price_max
+        with trace() as job_trace:
+            result = await scrape_single_product(params["product_url"])
+
+            if not result.get("success"):
+                raise RuntimeError(result.get("error", "Unknown error"))
+
+            # Agregar metadata
+            result["timestamp"] = datetime.now().isoformat()
+
+            # Guardar resultado
+            with stage("result_store_save"):
+                result["saved_as"] = await result_store.save(result, prefix="product")
+
+            with stage("response_cache"):
+                await response_cache.set("product", key, result)
+            await persistence.submit_products([result["product"]])
+            result["timing"] = job_trace.breakdown()
+            return result
+    finally:
+        response_cache.end_revalidation("product", key)
+
+async def run_batch_job(params: dict, job: Job) -> dict:
+    """Ejecuta un batch de productos encolado; cada URL trae su propio resultado"""
+    with trace() as job_trace:
+        result = await scrape_products_batch(
+            params["product_urls"],
+            max_concurrency=params.get("max_concurrency"),
+            per_host_rps=params.get("per_host_rps"),
+            progress_callback=job.update_progress
         )
 
         # Agregar metadata
-        results["timestamp"] = datetime.now().isoformat()
-        results["request_params"] = request.dict()
+        result["timestamp"] = datetime.now().isoformat()
+
+        # Guardar resultado
+        with stage("result_store_save"):
+            result["saved_as"] = await result_store.save(result, prefix="batch")
+
+        await persistence.submit_products([item["product"] for item in result["results"] if item.get("success")])
+        result["timing"] = job_trace.breakdown()
+        return result
+
+async def run_refresh_job(params: dict, job: Job) -> dict:
+    """Re-scrapea los productos vencidos con mayor staleness esperada"""
+    return await refresh_scheduler.run_once(params.get("max_pages"))
+
+job_manager.register("search", run_search_job)
+job_manager.register("product", run_product_job)
+job_manager.register("batch", run_batch_job)
+job_manager.register("refresh", run_refresh_job)
+
+def enqueue_job(kind: str, params: dict) -> dict:
+    """Encola un job y devuelve la respuesta con su id"""
+    try:
+        job = job_manager.submit(kind, params)
+    except QueueFullError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+    return {
+        "success": True,
+        "job_id": job.id,
+        "status": job.status,
+        "status_url": f"/api/jobs/{job.id}"
+    }
+
+# ================== CACHÉ DE RESPUESTAS ==================
+
+def wants_bypass(cache_control: Optional[str]) -> bool:
+    """Cache-Control: no-cache fuerza un scrape nuevo"""
+    return "no-cache" in (cache_control or "").lower()
+
+def search_params(request: SearchRequest) -> dict:
+    """Parámetros de búsqueda normalizados (clave de caché y del job)"""
+    params = request.dict()
+    params["search_query"] = normalize_query(params["search_query"])
+    return params
 
-        # Guardar resultados
-        filename = save_results(results, prefix="search")
-        results["saved_as"] = filename
+def revalidate(kind: str, key: str, params: dict) -> bool:
+    """Encola un refresco de una entrada stale (uno solo por clave a la vez)"""
+    if not response_cache.begin_revalidation(kind, key):
+        return False
+    try:
+        job_manager.submit(kind, params)
+        return True
+    except QueueFullError:
+        response_cache.end_revalidation(kind, key)
+        return False
+
+async def cached_or_enqueue(kind: str, params: dict, response: Response, cache_control: Optional[str]) -> dict:
+    """
+    Sirve desde la caché de respuestas si hay entrada fresca o stale; si no, encola el job
+
+    Con stale se devuelve el valor cacheado y se refresca en background.
+    """
+    key = response_cache_key(params)
+    cached, cache_meta = await response_cache.get(kind, key, bypass=wants_bypass(cache_control))
+
+    if cached is None:
+        result = enqueue_job(kind, params)
+        result["cache"] = cache_meta
+        return result
+
+    if cache_meta["status"] == STALE:
+        cache_meta["revalidating"] = revalidate(kind, key, params)
+
+    job = job_manager.add_completed(kind, params, cached)
+    response.status_code = 200
+    return {
+        "success": True,
+        "job_id": job.id,
+        "status": job.status,
+        "status_url": f"/api/jobs/{job.id}",
+        "cache": cache_meta,
+        "result": cached
+    }
+
+# ================== SCRAPING ==================
+
+@app.post("/api/search", status_code=202)
+async def search_products(request: SearchRequest, response: Response, cache_control: Optional[str] = Header(None)):
+    """
+    Búsqueda de productos en Temu con filtros
+
+    Si la búsqueda está en caché responde 200 con el resultado; si no, retorna
+    inmediatamente con job_id y procesa en background.
+    Consultar el resultado en /api/jobs/{job_id}
+    """
+    result = await cached_or_enqueue("search", search_params(request), response, cache_control)
+    result["message"] = "Búsqueda en caché" if "result" in result else "Búsqueda encolada"
+    return result
+
+@app.post("/api/product", status_code=202)
+async def get_product(request: ProductURLRequest, response: Response, cache_control: Optional[str] = Header(None)):
+    """
+    Obtiene datos de un producto individual
+
+    Desde caché si está disponible; si no, retorna inmediatamente con job_id
+    y el resultado queda en /api/jobs/{job_id}
+    """
+    params = {"product_url": request.product_url.strip()}
+    result = await cached_or_enqueue("product", params, response, cache_control)
+    result["message"] = "Producto en caché" if "result" in result else "Producto encolado"
+    return result
+
+# ================== STREAMING ==================
+
+def format_event(event: dict, sse: bool) -> str:
+    """Serializa un evento como SSE (event + data) o como una línea NDJSON"""
+    if sse:
+        data = {k: v for k, v in event.items() if k != "event"}
+        return f"event: {event['event']}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+    return json.dumps(event, ensure_ascii=False) + "\n"
+
+async def cached_search_events(result: dict):
+    """Reproduce una búsqueda cacheada como flujo de eventos"""
+    for index, product in enumerate(result.get("products", [])):
+        yield {"event": "product", "index": index, "product": product}
+    yield {"event": "done", "result": result}
+
+@app.post("/api/search/stream")
+async def search_products_stream(
+    request: SearchRequest,
+    http_request: Request,
+    format: Optional[str] = None,
+    cache_control: Optional[str] = Header(None)
+):
+    """
+    Búsqueda con resultados en streaming
+
+    Envía eventos de progreso y cada producto filtrado en cuanto su página
+    está extraída, y al final el resultado completo (evento done).
+    NDJSON por defecto; SSE con ?format=sse o Accept: text/event-stream.
+    """
+    sse = format == "sse" or "text/event-stream" in http_request.headers.get("accept", "")
+    params = search_params(request)
+    key = response_cache_key(params)
+    cached, cache_meta = await response_cache.get("search", key, bypass=wants_bypass(cache_control))
+
+    if cached is not None and cache_meta["status"] == STALE:
+        cache_meta["revalidating"] = revalidate("search", key, params)
+
+    async def stream():
+        started = time.perf_counter()
+        yield format_event({"event": "start", "search_query": params["search_query"], "cache": cache_meta}, sse)
+
+        # Streams idénticos concurrentes (y los jobs de la misma búsqueda) comparten un scrape
+        events = cached_search_events(cached) if cached is not None else coalesced_search_events(**params)
+        # Traza propia: la del middleware ya se cerró al enviar las cabeceras
+        with trace() as stream_trace:
+            try:
+                async for event in events:
+                    if event["event"] == "done" and cached is None:
+                        result = event["result"]
+                        execution_time = time.perf_counter() - started
+                        if result.get("success"):
+                            event = {"event": "done", "result": await store_search_results(result, params, key, execution_time)}
+                        else:
+                            result["timing"] = stream_trace.breakdown()
+                            await persistence.submit_search(result, params, execution_time)
+                            event = {"event": "error", "error": result.get("error", "Unknown error")}
+                    yield format_event(event, sse)
+            except Exception as e:
+                yield format_event({"event": "error", "error": str(e)}, sse)
+            finally:
+                await events.aclose()
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream" if sse else "application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/api/jobs")
+async def list_jobs(limit: int = 50):
+    """
+    Lista los jobs más recientes (sin resultados)
+    """
+    jobs = job_manager.list(limit=limit)
+    return {
+        "success": True,
+        "total_jobs": len(jobs),
+        "stats": job_manager.stats(),
+        "jobs": [job.to_dict(include_result=False) for job in jobs]
+    }
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str):
+    """
+    Estado, progreso y resultado de un job
+    """
+    job = job_manager.get(job_id)
+
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job not found: {job_id}")
+
+    return {
+        "success": True,
+        **job.to_dict()
+    }
+
+@app.post("/api/products/batch", status_code=202)
+async def get_products_batch(request: ProductBatchRequest):
+    """
+    Scrapea una lista de productos en paralelo
+
+    Retorna inmediatamente con job_id; el resultado (uno por URL, un fallo no
+    aborta el batch) y el progreso quedan en /api/jobs/{job_id}
+    """
+    result = enqueue_job("batch", {
+        "product_urls": request.product_urls,
+        "max_concurrency": request.max_concurrency,
+        "per_host_rps": request.per_host_rps
+    })
+    result["message"] = f"Batch de {len(request.product_urls)} productos encolado"
+    return result
+
+# ================== CATÁLOGO ==================
+
+@app.get("/api/products")
+async def list_products(
+    query: Optional[str] = None,
+    min_rating: Optional[float] = None,
+    min_reviews: Optional[int] = None,
+    min_sales: Optional[int] = None,
+    price_min: Optional[float] = None,
+    price_max: Optional[float] = None,
+    category: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=500),
+    offset: int = Query(0, ge=0),
+    cursor: Optional[str] = None
+):
+    """
+    Productos guardados con filtros, ordenados por relevancia/popularidad
+
+    Paginación con offset, o con cursor: pasar el next_cursor de la respuesta
+    anterior (más eficiente en páginas profundas; no disponible con query).
+    """
+    filters = {
+        "query": query,
+        "min_rating": min_rating,
+        "min_reviews": min_reviews,
+        "min_sales": min_sales,
+        "price_min": price_min,
+        "price_max": price_max,
+        "category": category
+    }
+
+    try:
+        if query:
+            products = await db.search_products(limit=limit, offset=offset, cursor=cursor, **filters)
+            next_cursor = None
+        else:
+            page = await db.search_products_page(limit=limit, cursor=cursor, offset=offset, **filters)
+            products, next_cursor = page["products"], page["next_cursor"]
 
         return {
             "success": True,
-            "message": "Búsqueda completada",
-            "results": results
+            "total_products": len(products),
+            "next_cursor": next_cursor,
+            "products": [product.to_dict() for product in products]
         }
 
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error en scraping: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error buscando productos: {str(e)}")
 
-@app.post("/api/product")
-async def get_product(request: ProductURLRequest):
+@app.get("/api/stats")
+async def get_catalog_stats(breakdown_limit: int = Query(20, ge=0, le=500)):
     """
-    Obtiene datos de un producto individual
+    Estadísticas del catálogo (totales, precio y rating medios, búsquedas)
+    con desglose por categoría y por búsqueda
     """
     try:
-        result = await scrape_single_product(request.product_url)
+        return {
+            "success": True,
+            "totals": await db.get_stats(),
+            "by_category": await db.get_stats_breakdown("category", limit=breakdown_limit),
+            "by_query": await db.get_stats_breakdown("query", limit=breakdown_limit),
+            "timestamp": datetime.now().isoformat()
+        }
 
-        if not result.get("success"):
-            raise HTTPException(status_code=400, detail=result.get("error", "Unknown error"))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error obteniendo estadísticas: {str(e)}")
 
-        # Agregar metadata
-        result["timestamp"] = datetime.now().isoformat()
+# ================== HISTORIAL DE PRECIOS ==================
 
-        # Guardar resultado
-        filename = save_results(result, prefix="product")
-        result["saved_as"] = filename
+@app.get("/api/products/{product_id}/prices")
+async def get_price_history(
+    product_id: int,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    limit: int = 1000
+):
+    """
+    Cambios de precio de un producto (rango opcional start/end, ISO 8601)
+    """
+    try:
+        prices = await db.get_price_history(product_id, start=start, end=end, limit=limit)
 
-        return result
+        return {
+            "success": True,
+            "product_id": product_id,
+            "total_points": len(prices),
+            "prices": [price.to_dict() for price in prices]
+        }
 
-    except HTTPException:
-        raise
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error en scraping: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error cargando historial: {str(e)}")
+
+@app.get("/api/products/{product_id}/prices/daily")
+async def get_price_history_daily(
+    product_id: int,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None
+):
+    """
+    Historial de precios agregado por día (min/max/media/cierre) para gráficas
+    """
+    try:
+        days = await db.get_price_history_daily(product_id, start=start, end=end)
+
+        return {
+            "success": True,
+            "product_id": product_id,
+            "total_days": len(days),
+            "days": days
+        }
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error cargando historial: {str(e)}")
 
 @app.post("/api/affiliate")
 async def create_affiliate_link(request: AffiliateLinkRequest):
@@ -190,14 +629,14 @@ async def create_affiliate_link(request: AffiliateLinkRequest):
     Genera link de afiliado para una URL de producto
     """
     try:
-        affiliate_link = generate_affiliate_link(
-            product_url=request.product_url,
-            affiliate_id=request.affiliate_id or os.getenv("TEMU_AFFILIATE_ID", "YOUR_AFFILIATE_ID")
-        )
+        canonical = canonicalize(request.product_url)
+        affiliate_link = generate_affiliate_link(request.product_url, request.affiliate_id or TEMU_AFFILIATE_ID)
 
         return {
             "success": True,
             "original_url": request.product_url,
+            "goods_id": canonical.goods_id,
+            "clean_url": canonical.clean_url,
             "affiliate_link": affiliate_link,
             "timestamp": datetime.now().isoformat()
         }
@@ -205,30 +644,210 @@ async def create_affiliate_link(request: AffiliateLinkRequest):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error generando link: {str(e)}")
 
+# URLs convertidas por bloque de salida del endpoint batch
+AFFILIATE_BATCH_CHUNK = 1000
+# Salida de un upload que se mantiene en memoria antes de pasar a disco
+AFFILIATE_SPOOL_BYTES = 16 * 1024 * 1024
+AFFILIATE_CSV_FIELDS = ("url", "goods_id", "clean_url", "affiliate_link", "error")
+
+async def request_lines(request: Request) -> AsyncIterator[str]:
+    """Líneas del body de la request a medida que llegan (sin cargarlo entero)"""
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    pending = ""
+
+    async for chunk in request.stream():
+        pending += decoder.decode(chunk)
+        *lines, pending = pending.split("\n")
+        for line in lines:
+            yield line.rstrip("\r")
+
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending.rstrip("\r")
+
+async def uploaded_urls(request: Request, content_type: str) -> AsyncIterator[Any]:
+    """URLs de un upload NDJSON (strings u objetos con url/product_url), CSV o texto plano"""
+    url_column = 0
+    first = True
+
+    async for line in request_lines(request):
+        if not line.strip():
+            continue
+
+        if content_type == "text/csv":
+            row = next(csv.reader([line]))
+            if first:
+                first = False
+                header = [cell.strip().lower() for cell in row]
+                if "url" in header or "product_url" in header:
+                    url_column = header.index("url" if "url" in header else "product_url")
+                    continue
+            yield row[url_column].strip() if len(row) > url_column else ""
+
+        elif content_type in ("application/x-ndjson", "application/ndjson", "application/jsonl"):
+            try:
+                item = json.loads(line)
+            except ValueError:
+                yield line.strip()
+                continue
+            if isinstance(item, dict):
+                yield str(item.get("url") or item.get("product_url") or "")
+            else:
+                # Strings como URL; números, null o listas quedan como fila de error en affiliate_row
+                yield item
+
+        else:
+            yield line.strip()
+
+async def listed_urls(urls: List[str]) -> AsyncIterator[str]:
+    for url in urls:
+        yield url
+
+def affiliate_row(url: str, affiliate_id: str) -> dict:
+    """goods_id, URL limpia y link de afiliado de una URL (o el error)"""
+    if not url or not isinstance(url, str):
+        return {"url": url, "error": "Empty or invalid URL"}
+
+    try:
+        canonical = canonicalize(url)
+        return {
+            "url": url,
+            "goods_id": canonical.goods_id,
+            "clean_url": canonical.clean_url,
+            "affiliate_link": generate_affiliate_link(url, affiliate_id)
+        }
+    except ValueError as e:
+        return {"url": url, "error": str(e)}
+
+async def affiliate_rows(urls: AsyncIterator[str], affiliate_id: str, as_csv: bool) -> AsyncIterator[str]:
+    """Convierte las URLs y emite la salida por bloques de AFFILIATE_BATCH_CHUNK"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=AFFILIATE_CSV_FIELDS, extrasaction="ignore") if as_csv else None
+    if writer:
+        writer.writeheader()
+    pending = 0
+
+    async for url in urls:
+        row = affiliate_row(url, affiliate_id)
+        if writer:
+            writer.writerow(row)
+        else:
+            buffer.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+        pending += 1
+        if pending >= AFFILIATE_BATCH_CHUNK:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            pending = 0
+
+    if buffer.tell():
+        yield buffer.getvalue()
+
+async def spooled(blocks: AsyncIterator[str]) -> AsyncIterator[str]:
+    """
+    Consume blocks entero a un archivo temporal y lo devuelve en streaming
+
+    Para uploads: el body de la request no puede leerse mientras se envía la
+    respuesta, así que se convierte a medida que llega y se responde después.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=AFFILIATE_SPOOL_BYTES, mode="w+t", encoding="utf-8")
+    async for block in blocks:
+        spool.write(block)
+    spool.seek(0)
+
+    async def read():
+        try:
+            while True:
+                block = spool.read(64 * 1024)
+                if not block:
+                    break
+                yield block
+        finally:
+            spool.close()
+
+    return read()
+
+@app.post("/api/affiliate/batch")
+async def create_affiliate_links_batch(
+    request: Request,
+    affiliate_id: Optional[str] = Query(None, description="ID de afiliado (opcional)"),
+    output: Optional[str] = Query(None, alias="format", description="ndjson (por defecto) o csv")
+):
+    """
+    Conversión masiva de URLs: goods_id, URL limpia y link de afiliado por URL
+
+    Acepta un JSON (lista de URLs o {"urls": [...], "affiliate_id": ...}) o un
+    upload en streaming NDJSON, CSV (columna url/product_url o la primera) o
+    texto plano (una URL por línea), que se convierte a medida que llega. La
+    respuesta se emite en streaming como NDJSON o CSV (?format=csv o Accept:
+    text/csv), en el orden recibido.
+    """
+    content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+
+    if content_type == "application/json":
+        try:
+            body = await request.json()
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid JSON body")
+
+        if isinstance(body, dict):
+            affiliate_id = affiliate_id or body.get("affiliate_id")
+            body = body.get("urls")
+        if not isinstance(body, list):
+            raise HTTPException(status_code=400, detail="Expected a list of URLs or {\"urls\": [...]}")
+        urls = listed_urls(body)
+    else:
+        urls = uploaded_urls(request, content_type)
+
+    as_csv = output == "csv" or (output is None and "text/csv" in request.headers.get("accept", ""))
+    rows = affiliate_rows(urls, affiliate_id or TEMU_AFFILIATE_ID, as_csv)
+    if content_type != "application/json":
+        rows = await spooled(rows)
+
+    return StreamingResponse(rows, media_type="text/csv" if as_csv else "application/x-ndjson")
+
 @app.get("/api/results")
-async def get_all_results():
+async def get_all_results(
+    prefix: Optional[str] = Query(None, description="search, product o batch"),
+    since: Optional[datetime] = Query(None, description="Desde (ISO 8601)"),
+    until: Optional[datetime] = Query(None, description="Hasta (ISO 8601, exclusivo)"),
+    limit: int = Query(50, ge=1, le=500),
+    offset: int = Query(0, ge=0)
+):
     """
-    Lista todos los resultados guardados
+    Lista los resultados guardados (paginado, desde el índice del almacén)
     """
     try:
-        results = list_all_results()
+        page = await result_store.list(prefix=prefix, since=since, until=until, limit=limit, offset=offset)
 
         return {
             "success": True,
-            "total_results": len(results),
-            "results": results
+            "total_results": page["total"],
+            "limit": limit,
+            "offset": offset,
+            "results": page["results"]
         }
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error listando resultados: {str(e)}")
 
 @app.get("/api/results/{filename}")
-async def get_result(filename: str):
+async def get_result(
+    filename: str,
+    start: int = Query(0, ge=0, description="Primer producto a devolver"),
+    count: Optional[int] = Query(None, ge=1, description="Número de productos a devolver")
+):
     """
-    Obtiene un resultado específico por filename
+    Obtiene un resultado específico por id (filename), opcionalmente un rango de sus productos
     """
     try:
-        data = load_results(filename)
+        data = await result_store.load(filename)
+
+        products = data.get("products")
+        if isinstance(products, list) and (start or count):
+            data["products"] = products[start:start + count if count else None]
+            data["products_range"] = {"start": start, "count": len(data["products"]), "total": len(products)}
 
         return {
             "success": True,
@@ -244,16 +863,12 @@ async def get_result(filename: str):
 @app.delete("/api/results/{filename}")
 async def delete_result(filename: str):
     """
-    Elimina un resultado guardado
+    Elimina un resultado guardado (el espacio se recupera al compactar)
     """
     try:
-        filepath = os.path.join(RESULTS_DIR, filename)
-
-        if not os.path.exists(filepath):
+        if not await result_store.delete(filename):
             raise HTTPException(status_code=404, detail=f"File not found: {filename}")
 
-        os.remove(filepath)
-
         return {
             "success": True,
             "message": f"Deleted: {filename}"
@@ -264,31 +879,82 @@ async def delete_result(filename: str):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error eliminando archivo: {str(e)}")
 
+@app.post("/api/results/compact")
+async def compact_results(min_dead_ratio: float = Query(0.5, gt=0.0, le=1.0)):
+    """
+    Reescribe los segmentos con muchos resultados borrados para recuperar espacio
+    """
+    try:
+        return {"success": True, **await result_store.compact(min_dead_ratio)}
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error compactando resultados: {str(e)}")
+
+# ================== REFRESCO DE PRODUCTOS ==================
+
+@app.get("/api/refresh/queue")
+async def get_refresh_queue(
+    hours_ahead: float = Query(0, ge=0, description="Incluir los que vencen en las próximas N horas"),
+    limit: int = Query(100, ge=1, le=1000)
+):
+    """
+    Productos pendientes de re-scrape (por fecha prevista) con su volatilidad y staleness esperada
+    """
+    try:
+        until = datetime.utcnow() + timedelta(hours=hours_ahead)
+        products = await db.get_refresh_queue(until=until, limit=limit)
+
+        return {
+            "success": True,
+            "scheduler": refresh_scheduler.stats(),
+            "total": len(products),
+            "products": products
+        }
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error obteniendo cola de refresco: {str(e)}")
+
+@app.post("/api/refresh/run", status_code=202)
+async def run_refresh(max_pages: Optional[int] = Query(None, ge=1, le=BATCH_MAX_URLS)):
+    """
+    Encola un re-scrape inmediato de los productos vencidos más desactualizados
+    (p. ej. desde un cron de n8n en lugar de re-scrapear todo el catálogo)
+    """
+    return enqueue_job("refresh", {"max_pages": max_pages})
+
 # ================== WEBHOOK PARA N8N ==================
 
 @app.post("/webhook/n8n/search")
-async def n8n_search_webhook(request: SearchRequest):
+async def n8n_search_webhook(request: SearchRequest, cache_control: Optional[str] = Header(None)):
     """
     Endpoint especial para n8n
     Retorna datos en formato optimizado para n8n
     """
     try:
-        results = await scrape_temu_search(
-            search_query=request.search_query,
-            max_products=request.max_products,
-            min_rating=request.min_rating,
-            min_reviews=request.min_reviews,
-            min_sales=request.min_sales,
-            price_min=request.price_min,
-            price_max=request.price_max
-        )
-
-        if not results.get("success"):
-            return {
-                "success": False,
-                "error": results.get("error", "Unknown error"),
-                "products": []
-            }
+        params = search_params(request)
+        key = response_cache_key(params)
+        results, cache_meta = await response_cache.get("search", key, bypass=wants_bypass(cache_control))
+
+        if results is None:
+            started = time.perf_counter()
+            results = await scrape_temu_search(**params)
+            results["timing"] = timing_breakdown()
+            await persistence.submit_search(results, params, time.perf_counter() - started)
+
+            if not results.get("success"):
+                return {
+                    "success": False,
+                    "error": results.get("error", "Unknown error"),
+                    "products": [],
+                    "cache": cache_meta
+                }
+
+            results["timestamp"] = datetime.now().isoformat()
+            results["request_params"] = params
+            await response_cache.set("search", key, results)
+
+        elif cache_meta["status"] == STALE:
+            cache_meta["revalidating"] = revalidate("search", key, params)
 
         # Formato para n8n (array de productos)
         products = results.get("products", [])
@@ -298,6 +964,8 @@ async def n8n_search_webhook(request: SearchRequest):
             "total_products": len(products),
             "search_query": request.search_query,
             "timestamp": datetime.now().isoformat(),
+            "cache": cache_meta,
+            "timing": timing_breakdown(),
             "products": products
         }
 
@@ -0,0 +1,277 @@
+"""
+BROWSER POOL
+Pool de navegadores Chromium persistentes compartido por todo el proceso
+Evita lanzar y cerrar un Chromium completo en cada request de scraping
+"""
+
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import Optional, Set
+
+from crawl4ai import AsyncWebCrawler, BrowserConfig
+
+from config import BROWSER_POOL_SIZE, BROWSER_MAX_PAGES, BROWSER_MAX_RSS_MB, BROWSER_LEASE_TIMEOUT
+from resource_blocking import resource_blocker
+from tracing import stage
+
+try:
+    import psutil
+except ImportError:  # Está en requirements; si falta no se recicla por memoria (aviso en start)
+    psutil = None
+
+# ================== CONFIGURACIÓN DEL NAVEGADOR ==================
+
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36"
+
+DEFAULT_HEADERS = {
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8",
+    "Accept-Language": "en-US,en;q=0.5",
+    "Accept-Encoding": "gzip, deflate, br",
+    "DNT": "1",
+    "Connection": "keep-alive",
+    "Upgrade-Insecure-Requests": "1"
+}
+
+
+def build_browser_config() -> BrowserConfig:
+    """Configuración común de Chromium para todos los navegadores del pool"""
+    return BrowserConfig(
+        browser_type="chromium",
+        headless=True,
+        user_agent=USER_AGENT,
+        headers=DEFAULT_HEADERS
+    )
+
+# ================== NAVEGADOR DEL POOL ==================
+
+class PooledBrowser:
+    """Un navegador del pool con sus contadores de uso"""
+
+    def __init__(self, crawler: AsyncWebCrawler, pids: Set[int]):
+        self.crawler = crawler
+        self.pids = pids  # Procesos Chromium lanzados por este crawler
+        self.pages_served = 0
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+
+    def rss_mb(self) -> float:
+        """Memoria residente (MB) del árbol de procesos de este navegador"""
+        if psutil is None:
+            return 0.0
+
+        total = 0
+        for pid in self.pids:
+            try:
+                proc = psutil.Process(pid)
+                total += proc.memory_info().rss
+                for child in proc.children(recursive=True):
+                    total += child.memory_info().rss
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                continue
+
+        return total / (1024 * 1024)
+
+    def is_healthy(self) -> bool:
+        """Comprueba que el crawler siga arrancado y el navegador conectado"""
+        if not getattr(self.crawler, "ready", True):
+            return False
+
+        strategy = getattr(self.crawler, "crawler_strategy", None)
+        manager = getattr(strategy, "browser_manager", None)
+        browser = getattr(manager, "browser", None)
+        if browser is not None and not browser.is_connected():
+            return False
+
+        if psutil is not None and self.pids:
+            return any(psutil.pid_exists(pid) for pid in self.pids)
+
+        return True
+
+# ================== POOL ==================
+
+class BrowserPool:
+    """
+    Pool de navegadores con tamaño máximo, health checks y reciclado
+
+    Cada lease entrega un crawler en exclusiva. Al devolverlo se recicla si
+    superó max_pages páginas o max_rss_mb de memoria residente.
+    """
+
+    def __init__(
+        self,
+        size: int = BROWSER_POOL_SIZE,
+        max_pages: int = BROWSER_MAX_PAGES,
+        max_rss_mb: float = BROWSER_MAX_RSS_MB,
+        lease_timeout: float = BROWSER_LEASE_TIMEOUT
+    ):
+        self.size = max(1, size)
+        self.max_pages = max_pages
+        self.max_rss_mb = max_rss_mb
+        self.lease_timeout = lease_timeout
+
+        self._idle: Optional[asyncio.Queue] = None
+        self._launch_lock: Optional[asyncio.Lock] = None
+        self._browsers: Set[PooledBrowser] = set()
+        self._closing = False
+
+        # Métricas
+        self.launched = 0
+        self.recycled = 0
+        self.unhealthy = 0
+        self.leases = 0
+
+    @property
+    def started(self) -> bool:
+        return self._idle is not None
+
+    async def start(self, warm: bool = True):
+        """Inicializa el pool y, si warm=True, lanza todos los navegadores"""
+        if self.started:
+            return
+
+        if self.max_rss_mb and psutil is None:
+            print(f"⚠️  psutil no está instalado: BROWSER_MAX_RSS_MB={self.max_rss_mb:g} no tiene efecto (solo se recicla por páginas)")
+
+        self._closing = False
+        self._idle = asyncio.Queue(maxsize=self.size)
+        self._launch_lock = asyncio.Lock()
+
+        for _ in range(self.size):
+            slot = await self._launch() if warm else None
+            self._idle.put_nowait(slot)
+
+        print(f"✅ Browser pool listo ({self.size} navegadores)")
+
+    async def close(self):
+        """
+        Cierra los navegadores libres del pool
+
+        Los que están prestados los cierra lease() al devolverlos (el pool ya
+        no es el mismo), así ninguno se destruye dos veces.
+        """
+        if not self.started:
+            return
+
+        self._closing = True
+        while not self._idle.empty():
+            browser = self._idle.get_nowait()
+            if browser is not None:
+                await self._destroy(browser)
+
+        self._idle = None
+        self._launch_lock = None
+        print("🛑 Browser pool cerrado")
+
+    @asynccontextmanager
+    async def lease(self):
+        """
+        Presta un crawler del pool
+
+        Uso:
+            async with browser_pool.lease() as crawler:
+                result = await crawler.arun(url=..., config=...)
+
+        Sin start() previo el pool arranca en frío; tras close() se rechaza
+        (un job que aún drena no debe lanzar navegadores que nadie cerrará).
+        """
+        if not self.started:
+            if self._closing:
+                raise RuntimeError("Browser pool cerrado")
+            await self.start(warm=False)
+
+        idle = self._idle
+        with stage("browser_lease"):
+            browser = await asyncio.wait_for(idle.get(), timeout=self.lease_timeout)
+        broken = False
+
+        try:
+            if browser is not None and not browser.is_healthy():
+                self.unhealthy += 1
+                await self._destroy(browser)
+                browser = None
+
+            if browser is None:
+                with stage("browser_launch"):
+                    browser = await self._launch()
+
+            self.leases += 1
+            yield browser.crawler
+
+        except Exception:
+            broken = browser is not None and not browser.is_healthy()
+            raise
+
+        finally:
+            if browser is not None:
+                browser.pages_served += 1
+                browser.last_used = time.monotonic()
+
+                if broken or self._needs_recycle(browser):
+                    self.recycled += 1
+                    await self._destroy(browser)
+                    browser = None  # Se relanza de forma perezosa en el próximo lease
+
+            if self._closing or idle is not self._idle:
+                if browser is not None:
+                    await self._destroy(browser)
+            else:
+                idle.put_nowait(browser)
+
+    def stats(self) -> dict:
+        """Estado actual del pool"""
+        return {
+            "size": self.size,
+            "started": self.started,
+            "alive": len(self._browsers),
+            "idle": self._idle.qsize() if self.started else 0,
+            "leases": self.leases,
+            "launched": self.launched,
+            "recycled": self.recycled,
+            "unhealthy": self.unhealthy,
+            "rss_mb": round(sum(b.rss_mb() for b in self._browsers), 1),
+            "max_pages": self.max_pages,
+            "max_rss_mb": self.max_rss_mb
+        }
+
+    # ---------- internos ----------
+
+    def _needs_recycle(self, browser: PooledBrowser) -> bool:
+        if self.max_pages and browser.pages_served >= self.max_pages:
+            return True
+        if self.max_rss_mb and browser.rss_mb() > self.max_rss_mb:
+            return True
+        return False
+
+    async def _launch(self) -> PooledBrowser:
+        # Lanzamientos serializados para poder atribuir los PIDs nuevos a cada crawler
+        async with self._launch_lock:
+            before = _child_pids()
+            crawler = AsyncWebCrawler(config=build_browser_config())
+            # Bloqueo de imágenes, fuentes, media y trackers en cada página
+            crawler.crawler_strategy.set_hook("on_page_context_created", resource_blocker.attach)
+            await crawler.start()
+            pids = _child_pids() - before
+
+        browser = PooledBrowser(crawler, pids)
+        self._browsers.add(browser)
+        self.launched += 1
+        return browser
+
+    async def _destroy(self, browser: PooledBrowser):
+        self._browsers.discard(browser)
+        try:
+            await browser.crawler.close()
+        except Exception as e:
+            print(f"⚠️  Error cerrando navegador del pool: {e}")
+
+
+def _child_pids() -> Set[int]:
+    """PIDs de los procesos hijos directos del proceso actual"""
+    if psutil is None:
+        return set()
+    return {child.pid for child in psutil.Process().children()}
+
+# ================== INSTANCIA GLOBAL ==================
+
+browser_pool = BrowserPool()
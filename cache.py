@@ -0,0 +1,377 @@
+"""
+CACHÉS
+- Caché de extracción: resultados del LLM indexados por hash del contenido
+  de la página (SQLite en disco o Redis si REDIS_ENABLED=true)
+- Caché de respuestas: resultados de /api/search y /api/product con TTL por
+  endpoint y stale-while-revalidate (LRU en memoria o Redis)
+"""
+
+import asyncio
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Optional, Tuple
+
+from config import (
+    REDIS_URL, REDIS_ENABLED,
+    EXTRACTION_CACHE_ENABLED, EXTRACTION_CACHE_PATH,
+    EXTRACTION_CACHE_TTL_SECONDS, EXTRACTION_CACHE_MAX_ENTRIES,
+    RESPONSE_CACHE_ENABLED, RESPONSE_CACHE_BACKEND, RESPONSE_CACHE_MAX_ENTRIES,
+    RESPONSE_CACHE_TTLS, RESPONSE_CACHE_STALE_SECONDS
+)
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # Redis es opcional
+    aioredis = None
+
+# ================== CLAVES ==================
+
+_WHITESPACE = re.compile(r"\s+")
+# Parámetros de tracking que cambian en cada visita sin cambiar el contenido
+_VOLATILE_PARAMS = re.compile(r"([?&](?:_x_sessn_id|refer_page_[a-z]+|_bg_fs|_p_rfs)=)[^&\s)\"']*")
+
+
+def normalize_content(content: str) -> str:
+    """Normaliza el contenido limpio de la página para que el hash sea estable"""
+    content = _VOLATILE_PARAMS.sub(r"\1", content or "")
+    return _WHITESPACE.sub(" ", content).strip()
+
+
+def make_cache_key(content: str, schema_name: str, instruction: str, provider: str) -> str:
+    """Clave = hash(contenido normalizado) + schema + hash(instrucción) + proveedor"""
+    content_hash = hashlib.sha256(normalize_content(content).encode("utf-8")).hexdigest()
+    instruction_hash = hashlib.sha256(_WHITESPACE.sub(" ", instruction).strip().encode("utf-8")).hexdigest()[:16]
+    return f"{schema_name}:{provider}:{instruction_hash}:{content_hash}"
+
+# ================== BACKENDS ==================
+
+class SQLiteCacheBackend:
+    """Caché en un fichero SQLite con TTL y desalojo LRU por número de entradas"""
+
+    def __init__(self, path: str, ttl_seconds: int, max_entries: int):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS extraction_cache (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+            """)
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS ix_extraction_cache_accessed ON extraction_cache (accessed_at)"
+            )
+        return self._conn
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute(
+                "SELECT value, created_at FROM extraction_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+
+            value, created_at = row
+            if now - created_at > self.ttl_seconds:
+                conn.execute("DELETE FROM extraction_cache WHERE key = ?", (key,))
+                conn.commit()
+                return None
+
+            conn.execute("UPDATE extraction_cache SET accessed_at = ? WHERE key = ?", (now, key))
+            conn.commit()
+            return value
+
+    def set(self, key: str, value: str):
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO extraction_cache (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, value, now, now)
+            )
+            # Expirados primero, luego los menos usados recientemente
+            conn.execute("DELETE FROM extraction_cache WHERE created_at < ?", (now - self.ttl_seconds,))
+            conn.execute("""
+                DELETE FROM extraction_cache WHERE key IN (
+                    SELECT key FROM extraction_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?
+                )
+            """, (self.max_entries,))
+            conn.commit()
+
+    async def aget(self, key: str) -> Optional[str]:
+        return await asyncio.to_thread(self.get, key)
+
+    async def aset(self, key: str, value: str):
+        await asyncio.to_thread(self.set, key, value)
+
+
+class RedisCacheBackend:
+    """Caché en Redis: TTL nativo y un sorted set de accesos para el desalojo LRU"""
+
+    def __init__(self, url: str, ttl_seconds: int, max_entries: int, namespace: str = "scrapelynx:extraction"):
+        self.client = aioredis.from_url(url, decode_responses=True)
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.namespace = namespace
+        self._lru_key = f"{namespace}:lru"
+
+    def _key(self, key: str) -> str:
+        return f"{self.namespace}:{key}"
+
+    async def aget(self, key: str) -> Optional[str]:
+        value = await self.client.get(self._key(key))
+        if value is None:
+            await self.client.zrem(self._lru_key, key)
+            return None
+        await self.client.zadd(self._lru_key, {key: time.time()})
+        return value
+
+    async def aset(self, key: str, value: str, ttl: Optional[int] = None):
+        async with self.client.pipeline(transaction=False) as pipe:
+            pipe.set(self._key(key), value, ex=ttl or self.ttl_seconds)
+            pipe.zadd(self._lru_key, {key: time.time()})
+            await pipe.execute()
+
+        overflow = await self.client.zcard(self._lru_key) - self.max_entries
+        if overflow > 0:
+            evicted = await self.client.zrange(self._lru_key, 0, overflow - 1)
+            if evicted:
+                await self.client.delete(*[self._key(k) for k in evicted])
+                await self.client.zrem(self._lru_key, *evicted)
+
+class MemoryLRUBackend:
+    """Caché en memoria del proceso con TTL y tamaño máximo (LRU)"""
+
+    def __init__(self, ttl_seconds: int, max_entries: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._data: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+
+    async def aget(self, key: str) -> Optional[str]:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+
+        value, expires_at = entry
+        if time.monotonic() > expires_at:
+            del self._data[key]
+            return None
+
+        self._data.move_to_end(key)
+        return value
+
+    async def aset(self, key: str, value: str, ttl: Optional[int] = None):
+        self._data[key] = (value, time.monotonic() + (ttl or self.ttl_seconds))
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+
+# ================== CACHÉ DE EXTRACCIÓN ==================
+
+class ExtractionCache:
+    """Caché de resultados de extracción del LLM con contadores de aciertos"""
+
+    def __init__(self, enabled: bool = EXTRACTION_CACHE_ENABLED):
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+        if REDIS_ENABLED and aioredis is not None:
+            self.backend = RedisCacheBackend(REDIS_URL, EXTRACTION_CACHE_TTL_SECONDS, EXTRACTION_CACHE_MAX_ENTRIES)
+            self.backend_name = "redis"
+        else:
+            if REDIS_ENABLED:
+                print("⚠️  REDIS_ENABLED=true pero el paquete redis no está instalado, usando SQLite")
+            self.backend = SQLiteCacheBackend(
+                EXTRACTION_CACHE_PATH, EXTRACTION_CACHE_TTL_SECONDS, EXTRACTION_CACHE_MAX_ENTRIES
+            )
+            self.backend_name = "sqlite"
+
+    async def get(self, key: str) -> Optional[Any]:
+        """Devuelve el resultado cacheado o None"""
+        if not self.enabled:
+            return None
+
+        try:
+            value = await self.backend.aget(key)
+        except Exception as e:
+            self.errors += 1
+            print(f"⚠️  Error leyendo caché de extracción: {e}")
+            return None
+
+        if value is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return json.loads(value)
+
+    async def set(self, key: str, value: Any):
+        """Guarda un resultado de extracción"""
+        if not self.enabled:
+            return
+
+        try:
+            await self.backend.aset(key, json.dumps(value, ensure_ascii=False))
+        except Exception as e:
+            self.errors += 1
+            print(f"⚠️  Error escribiendo caché de extracción: {e}")
+
+    def stats(self) -> dict:
+        """Contadores de aciertos/fallos"""
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "backend": self.backend_name,
+            "hits": self.hits,
+            "misses": self.misses,
+            "errors": self.errors,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "ttl_seconds": EXTRACTION_CACHE_TTL_SECONDS,
+            "max_entries": EXTRACTION_CACHE_MAX_ENTRIES
+        }
+
+# ================== CACHÉ DE RESPUESTAS ==================
+
+# Estados de una consulta a la caché de respuestas
+FRESH = "hit"
+STALE = "stale"
+MISS = "miss"
+BYPASS = "bypass"
+
+
+def response_cache_key(params: dict) -> str:
+    """Clave estable para los parámetros (ya normalizados) de un endpoint"""
+    payload = json.dumps(params, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    Caché de respuestas de la API con TTL por endpoint y stale-while-revalidate
+
+    Una entrada es fresca durante el TTL del endpoint; después, durante
+    RESPONSE_CACHE_STALE_SECONDS, se sirve como stale mientras se refresca.
+    """
+
+    def __init__(
+        self,
+        ttls: dict = RESPONSE_CACHE_TTLS,
+        stale_seconds: int = RESPONSE_CACHE_STALE_SECONDS,
+        max_entries: int = RESPONSE_CACHE_MAX_ENTRIES,
+        enabled: bool = RESPONSE_CACHE_ENABLED
+    ):
+        self.ttls = ttls
+        self.stale_seconds = stale_seconds
+        self.enabled = enabled
+        self.counts = {FRESH: 0, STALE: 0, MISS: 0, BYPASS: 0}
+        self.errors = 0
+        self._revalidating = set()
+
+        max_ttl = max(ttls.values()) + stale_seconds
+        if RESPONSE_CACHE_BACKEND == "redis" and aioredis is not None:
+            self.backend = RedisCacheBackend(REDIS_URL, max_ttl, max_entries, namespace="scrapelynx:response")
+            self.backend_name = "redis"
+        else:
+            if RESPONSE_CACHE_BACKEND == "redis":
+                print("⚠️  Caché de respuestas en Redis sin el paquete redis instalado, usando memoria")
+            self.backend = MemoryLRUBackend(max_ttl, max_entries)
+            self.backend_name = "memory"
+
+    async def get(self, endpoint: str, key: str, bypass: bool = False) -> Tuple[Optional[Any], dict]:
+        """
+        Busca una respuesta cacheada
+
+        Returns:
+            Tupla (valor o None, metadata {status, age_seconds, ttl_seconds})
+        """
+        meta = {"status": MISS, "age_seconds": None, "ttl_seconds": self.ttls[endpoint], "backend": self.backend_name}
+
+        if not self.enabled or bypass:
+            meta["status"] = BYPASS if bypass else MISS
+            self.counts[meta["status"]] += 1
+            return None, meta
+
+        try:
+            raw = await self.backend.aget(f"{endpoint}:{key}")
+        except Exception as e:
+            self.errors += 1
+            print(f"⚠️  Error leyendo caché de respuestas: {e}")
+            raw = None
+
+        if raw is None:
+            self.counts[MISS] += 1
+            return None, meta
+
+        envelope = json.loads(raw)
+        age = time.time() - envelope["stored_at"]
+        meta["age_seconds"] = round(age, 1)
+
+        if age <= self.ttls[endpoint]:
+            meta["status"] = FRESH
+        elif age <= self.ttls[endpoint] + self.stale_seconds:
+            meta["status"] = STALE
+        else:
+            self.counts[MISS] += 1
+            return None, meta
+
+        self.counts[meta["status"]] += 1
+        return envelope["value"], meta
+
+    async def set(self, endpoint: str, key: str, value: Any):
+        """Guarda una respuesta (fin de cualquier revalidación en curso)"""
+        self._revalidating.discard((endpoint, key))
+        if not self.enabled:
+            return
+
+        envelope = json.dumps({"stored_at": time.time(), "value": value}, ensure_ascii=False)
+        try:
+            await self.backend.aset(f"{endpoint}:{key}", envelope, ttl=self.ttls[endpoint] + self.stale_seconds)
+        except Exception as e:
+            self.errors += 1
+            print(f"⚠️  Error escribiendo caché de respuestas: {e}")
+
+    def begin_revalidation(self, endpoint: str, key: str) -> bool:
+        """True si nadie está ya refrescando esta entrada"""
+        if (endpoint, key) in self._revalidating:
+            return False
+        self._revalidating.add((endpoint, key))
+        return True
+
+    def end_revalidation(self, endpoint: str, key: str):
+        self._revalidating.discard((endpoint, key))
+
+    def stats(self) -> dict:
+        lookups = sum(self.counts.values())
+        return {
+            "enabled": self.enabled,
+            "backend": self.backend_name,
+            "counts": dict(self.counts),
+            "errors": self.errors,
+            "hit_rate": round((self.counts[FRESH] + self.counts[STALE]) / lookups, 4) if lookups else 0.0,
+            "revalidating": len(self._revalidating),
+            "ttl_seconds": dict(self.ttls),
+            "stale_seconds": self.stale_seconds
+        }
+
+# ================== INSTANCIAS GLOBALES ==================
+
+extraction_cache = ExtractionCache()
+response_cache = ResponseCache()
@@ -19,22 +19,39 @@ DEBUG = os.getenv("DEBUG", "false").lower() == "true"
 DATABASE_TYPE = os.getenv("DATABASE_TYPE", "sqlite")
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///temu_products.db")
 
+DATABASE_REPLICA_URL = os.getenv("DATABASE_REPLICA_URL", "")  # Réplica de solo lectura (opcional)
+
+
+def to_async_url(url: str) -> str:
+    """URL con el driver async (asyncpg / aiosqlite)"""
+    if url.startswith("postgresql+asyncpg://") or url.startswith("sqlite+aiosqlite://"):
+        return url
+    if url.startswith("postgresql://"):
+        return url.replace("postgresql://", "postgresql+asyncpg://", 1)
+    if url.startswith("postgres://"):
+        return url.replace("postgres://", "postgresql+asyncpg://", 1)
+    if url.startswith("sqlite://"):
+        return url.replace("sqlite://", "sqlite+aiosqlite://", 1)
+    if DATABASE_TYPE == "postgresql":
+        return f"postgresql+asyncpg://{url}"
+    return url
+
+
 # Convertir URL para async
-if DATABASE_TYPE == "postgresql":
-    if DATABASE_URL.startswith("postgresql://"):
-        ASYNC_DATABASE_URL = DATABASE_URL.replace("postgresql://", "postgresql+asyncpg://")
-    elif DATABASE_URL.startswith("postgresql+asyncpg://"):
-        ASYNC_DATABASE_URL = DATABASE_URL
-    else:
-        ASYNC_DATABASE_URL = f"postgresql+asyncpg://{DATABASE_URL}"
-else:
-    ASYNC_DATABASE_URL = "sqlite+aiosqlite:///temu_products.db"
+ASYNC_DATABASE_URL = to_async_url(DATABASE_URL)
+ASYNC_DATABASE_REPLICA_URL = to_async_url(DATABASE_REPLICA_URL) if DATABASE_REPLICA_URL else ""
 
 # Pool settings
 DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
 DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
 DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "30"))
 DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "3600"))
+DB_UPSERT_CHUNK_SIZE = int(os.getenv("DB_UPSERT_CHUNK_SIZE", "500"))  # Filas por INSERT ... ON CONFLICT
+DB_POOL_WAIT_SAMPLES = int(os.getenv("DB_POOL_WAIT_SAMPLES", "1000"))  # Esperas de checkout para percentiles
+
+# SQLite: WAL + synchronous=NORMAL + mmap
+SQLITE_MMAP_SIZE_MB = int(os.getenv("SQLITE_MMAP_SIZE_MB", "256"))
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
 
 # ================== REDIS ==================
 
@@ -52,6 +69,94 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
 # Scraping limits
 MAX_CONCURRENT_REQUESTS = int(os.getenv("MAX_CONCURRENT_REQUESTS", "3"))
 REQUEST_DELAY_SECONDS = float(os.getenv("REQUEST_DELAY_SECONDS", "2"))
+SEARCH_MAX_PAGES = int(os.getenv("SEARCH_MAX_PAGES", "5"))  # Páginas de resultados máximas por búsqueda
+
+# Browser pool (navegadores Chromium reutilizados entre requests)
+BROWSER_POOL_SIZE = int(os.getenv("BROWSER_POOL_SIZE", str(MAX_CONCURRENT_REQUESTS)))
+BROWSER_MAX_PAGES = int(os.getenv("BROWSER_MAX_PAGES", "50"))  # Reciclar tras N páginas
+BROWSER_MAX_RSS_MB = float(os.getenv("BROWSER_MAX_RSS_MB", "1024"))  # Reciclar si supera esta memoria
+BROWSER_LEASE_TIMEOUT = float(os.getenv("BROWSER_LEASE_TIMEOUT", "120"))
+
+# Detección de página lista (grid/precio presente y estable, con techo)
+READINESS_MAX_WAIT_MS = int(os.getenv("READINESS_MAX_WAIT_MS", "10000"))
+READINESS_STABLE_MS = int(os.getenv("READINESS_STABLE_MS", "500"))
+READINESS_SAMPLES = int(os.getenv("READINESS_SAMPLES", "500"))  # Muestras guardadas por tipo de página
+
+# Bloqueo de recursos en Chromium (listas separadas por comas)
+RESOURCE_BLOCKING_ENABLED = os.getenv("RESOURCE_BLOCKING_ENABLED", "true").lower() == "true"
+BLOCKED_RESOURCE_TYPES = os.getenv("BLOCKED_RESOURCE_TYPES", "image,media,font").split(",")
+BLOCKED_URL_PATTERNS = os.getenv(
+    "BLOCKED_URL_PATTERNS",
+    "google-analytics.com,googletagmanager.com,doubleclick.net,facebook.net,connect.facebook,"
+    "analytics.tiktok.com,bat.bing.com,hotjar.com,clarity.ms"
+).split(",")
+ALLOWED_URL_PATTERNS = [p for p in os.getenv("ALLOWED_URL_PATTERNS", "").split(",") if p]
+
+# Cola de jobs de scraping (/api/search y /api/product devuelven job_id)
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", str(MAX_CONCURRENT_REQUESTS)))
+JOB_MAX_QUEUE = int(os.getenv("JOB_MAX_QUEUE", "100"))
+JOB_RESULT_TTL_SECONDS = int(os.getenv("JOB_RESULT_TTL_SECONDS", "3600"))
+JOB_MAX_RETAINED = int(os.getenv("JOB_MAX_RETAINED", "1000"))
+
+# Scraping de productos en batch
+BATCH_MAX_URLS = int(os.getenv("BATCH_MAX_URLS", "500"))
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", str(BROWSER_POOL_SIZE)))
+BATCH_PER_HOST_RPS = float(os.getenv("BATCH_PER_HOST_RPS", str(1 / REQUEST_DELAY_SECONDS if REQUEST_DELAY_SECONDS else 0)))
+
+# Persistencia write-behind de resultados en la base de datos
+PERSIST_ENABLED = os.getenv("PERSIST_ENABLED", "true").lower() == "true"
+PERSIST_BATCH_SIZE = int(os.getenv("PERSIST_BATCH_SIZE", "500"))  # Productos por flush
+PERSIST_FLUSH_INTERVAL_SECONDS = float(os.getenv("PERSIST_FLUSH_INTERVAL_SECONDS", "2.0"))
+PERSIST_MAX_PENDING = int(os.getenv("PERSIST_MAX_PENDING", "1000"))  # Resultados en cola (backpressure)
+PERSIST_MAX_RETRIES = int(os.getenv("PERSIST_MAX_RETRIES", "3"))  # Reintentos de un flush fallido
+PERSIST_RETRY_BACKOFF_SECONDS = float(os.getenv("PERSIST_RETRY_BACKOFF_SECONDS", "0.5"))  # Se duplica en cada reintento
+
+# Re-scrape incremental por prioridad (productos volátiles a menudo, estables rara vez)
+REFRESH_ENABLED = os.getenv("REFRESH_ENABLED", "false").lower() == "true"
+REFRESH_PAGES_PER_HOUR = float(os.getenv("REFRESH_PAGES_PER_HOUR", "120"))  # Presupuesto global
+REFRESH_BATCH_SIZE = int(os.getenv("REFRESH_BATCH_SIZE", str(BATCH_MAX_CONCURRENCY)))
+REFRESH_IDLE_SECONDS = float(os.getenv("REFRESH_IDLE_SECONDS", "60"))  # Espera si no hay productos vencidos
+REFRESH_TARGET_STALENESS = float(os.getenv("REFRESH_TARGET_STALENESS", "0.5"))  # P(cambió) al re-scrapear
+REFRESH_MIN_INTERVAL_HOURS = float(os.getenv("REFRESH_MIN_INTERVAL_HOURS", "1"))
+REFRESH_MAX_INTERVAL_HOURS = float(os.getenv("REFRESH_MAX_INTERVAL_HOURS", "168"))
+REFRESH_PRIOR_HOURS = float(os.getenv("REFRESH_PRIOR_HOURS", "48"))  # Producto nuevo: ~1 cambio cada 48 h
+REFRESH_HISTORY_DECAY = float(os.getenv("REFRESH_HISTORY_DECAY", "0.9"))  # Peso de las observaciones anteriores
+
+# Extracción determinista (sin LLM) antes de recurrir al LLM
+EXTRACTION_FAST_PATH_ENABLED = os.getenv("EXTRACTION_FAST_PATH_ENABLED", "true").lower() == "true"
+EXTRACTION_MIN_VALID_RATIO = float(os.getenv("EXTRACTION_MIN_VALID_RATIO", "0.8"))  # % de candidatos que deben validar
+
+# Caché de resultados del LLM (por hash del contenido de la página)
+EXTRACTION_CACHE_ENABLED = os.getenv("EXTRACTION_CACHE_ENABLED", "true").lower() == "true"
+EXTRACTION_CACHE_PATH = os.getenv("EXTRACTION_CACHE_PATH", "extraction_cache.db")
+EXTRACTION_CACHE_TTL_SECONDS = int(os.getenv("EXTRACTION_CACHE_TTL_SECONDS", "86400"))
+EXTRACTION_CACHE_MAX_ENTRIES = int(os.getenv("EXTRACTION_CACHE_MAX_ENTRIES", "5000"))
+
+# Caché de respuestas de /api/search y /api/product (memory o redis)
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "true").lower() == "true"
+RESPONSE_CACHE_BACKEND = os.getenv("RESPONSE_CACHE_BACKEND", "redis" if REDIS_ENABLED else "memory")
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1000"))
+RESPONSE_CACHE_TTLS = {
+    "search": int(os.getenv("RESPONSE_CACHE_TTL_SEARCH", "900")),
+    "product": int(os.getenv("RESPONSE_CACHE_TTL_PRODUCT", "3600")),
+}
+RESPONSE_CACHE_STALE_SECONDS = int(os.getenv("RESPONSE_CACHE_STALE_SECONDS", "3600"))  # stale-while-revalidate
+
+# Recorte de la página y presupuesto de tokens antes del LLM
+LLM_PRUNING_ENABLED = os.getenv("LLM_PRUNING_ENABLED", "true").lower() == "true"
+LLM_TOKEN_BUDGET = int(os.getenv("LLM_TOKEN_BUDGET", "12000"))  # Tokens máximos por página
+LLM_CHUNK_TOKENS = int(os.getenv("LLM_CHUNK_TOKENS", "3000"))  # Tokens por chunk (se extraen en paralelo)
+LLM_CHARS_PER_TOKEN = int(os.getenv("LLM_CHARS_PER_TOKEN", "4"))
+
+# Despacho de llamadas al LLM: límites del proveedor (0 = sin límite), reintentos por 429 y precios
+LLM_RPM_LIMIT = float(os.getenv("LLM_RPM_LIMIT", "500"))  # Requests por minuto
+LLM_TPM_LIMIT = float(os.getenv("LLM_TPM_LIMIT", "200000"))  # Tokens por minuto
+LLM_RATE_LIMITS = os.getenv("LLM_RATE_LIMITS", "")  # Por proveedor: "openai/gpt-4o=500:30000,..."
+LLM_BURST_SECONDS = float(os.getenv("LLM_BURST_SECONDS", "10"))  # Ráfaga máxima (segundos de cupo)
+LLM_OUTPUT_TOKENS_ESTIMATE = int(os.getenv("LLM_OUTPUT_TOKENS_ESTIMATE", "800"))  # Hasta medir la salida real
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "4"))
+LLM_RATE_LIMIT_BACKOFF_SECONDS = float(os.getenv("LLM_RATE_LIMIT_BACKOFF_SECONDS", "5"))
+LLM_PRICING = os.getenv("LLM_PRICING", "")  # USD por millón de tokens: "proveedor=entrada:salida,..."
 
 # ================== API ==================
 
@@ -83,6 +188,10 @@ RATE_LIMIT_WINDOW_MINUTES = int(os.getenv("RATE_LIMIT_WINDOW_MINUTES", "15"))
 RESULTS_DIR = os.getenv("RESULTS_DIR", "results")
 LOGS_DIR = os.getenv("LOGS_DIR", "logs")
 
+# Almacén de resultados: segmentos NDJSON comprimidos + índice SQLite
+RESULT_STORE_COMPRESSION = os.getenv("RESULT_STORE_COMPRESSION", "gzip")  # gzip o zstd
+RESULT_SEGMENT_MAX_MB = int(os.getenv("RESULT_SEGMENT_MAX_MB", "64"))
+
 # Crear directorios si no existen
 os.makedirs(RESULTS_DIR, exist_ok=True)
 os.makedirs(LOGS_DIR, exist_ok=True)
@@ -117,7 +226,7 @@ def print_config():
     print("="*60)
     print(f"Environment: {ENVIRONMENT}")
     print(f"Debug: {DEBUG}")
-    print(f"Database: {DATABASE_TYPE}")
+    print(f"Database: {DATABASE_TYPE}{' (+ read replica)' if DATABASE_REPLICA_URL else ''}")
     print(f"Redis: {'Enabled' if REDIS_ENABLED else 'Disabled'}")
     print(f"LLM Provider: {LLM_PROVIDER}")
     print(f"API Port: {API_PORT}")
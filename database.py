@@ -4,29 +4,33 @@ Sistema de base de datos para guardar productos scrapeados
 Soporta SQLite (desarrollo) y PostgreSQL (producción)
 """
 
-import os
-from datetime import datetime
-from typing import Optional, List, Dict
+import base64
+import hashlib
+import json
+import math
+import re
+import time
+from datetime import datetime, timedelta
+from typing import Optional, List, Dict, Tuple
 from contextlib import asynccontextmanager
 
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, Text, Boolean
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
-from sqlalchemy.orm import declarative_base, Session
-from sqlalchemy.pool import StaticPool
-from dotenv import load_dotenv
-
-load_dotenv()
-
-# ================== CONFIGURACIÓN ==================
-
-DATABASE_TYPE = os.getenv("DATABASE_TYPE", "sqlite")  # sqlite o postgresql
-DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///temu_products.db")
-
-# Para PostgreSQL async
-if DATABASE_TYPE == "postgresql":
-    ASYNC_DATABASE_URL = DATABASE_URL.replace("postgresql://", "postgresql+asyncpg://")
-else:
-    ASYNC_DATABASE_URL = "sqlite+aiosqlite:///temu_products.db"
+from sqlalchemy import (
+    Column, Integer, BigInteger, String, Float, DateTime, Text, Boolean, ForeignKey, Index,
+    func, select, update, bindparam, exists, text, literal_column, or_, and_, inspect, MetaData, Table
+)
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from sqlalchemy.orm import declarative_base, aliased
+
+from config import (
+    ASYNC_DATABASE_URL, ASYNC_DATABASE_REPLICA_URL, DB_UPSERT_CHUNK_SIZE,
+    REFRESH_TARGET_STALENESS, REFRESH_MIN_INTERVAL_HOURS, REFRESH_MAX_INTERVAL_HOURS,
+    REFRESH_PRIOR_HOURS, REFRESH_HISTORY_DECAY
+)
+from db_engine import build_engine, PoolMetrics
+from temu_url_parser import canonical_goods_id, clean_affiliate_link
 
 # ================== MODELOS ==================
 
@@ -35,8 +39,17 @@ Base = declarative_base()
 class Product(Base):
     """Modelo de producto scrapeado"""
     __tablename__ = "products"
+    __table_args__ = (
+        # Listados por popularidad (y paginación keyset por popularity_score, id)
+        Index("ix_products_active_popularity", "is_active", "popularity_score", "id"),
+        Index("ix_products_category_popularity", "category", "popularity_score", "id"),
+        # Cola de re-scrape: productos activos por fecha de próximo refresco
+        Index("ix_products_active_refresh", "is_active", "next_refresh_at"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
+    # Identidad canónica de Temu: la misma para todas las variantes de URL (ver product_aliases)
+    goods_id = Column(BigInteger, nullable=True, unique=True, index=True)
 
     # Datos del producto
     title = Column(String(500), nullable=False, index=True)
@@ -48,6 +61,7 @@ class Product(Base):
     rating = Column(Float, nullable=True, index=True)
     reviews_count = Column(Integer, nullable=True, index=True)
     sales_count = Column(Integer, nullable=True, index=True)
+    popularity_score = Column(Float, nullable=False, default=0.0)  # rating * reviews_count, mantenido por el upsert
 
     # URLs
     image_url = Column(Text, nullable=True)
@@ -64,12 +78,20 @@ class Product(Base):
 
     # Control
     is_active = Column(Boolean, default=True)
-    price_history = Column(Text, nullable=True)  # JSON string con historial de precios
+    price_history = Column(Text, nullable=True)  # Obsoleto: el historial está en product_prices
+
+    # Frescura: huella del contenido y volatilidad aprendida (ver _observe_refresh)
+    content_hash = Column(String(32), nullable=True)
+    checked_at = Column(DateTime, nullable=True)  # Último scrape, haya cambiado o no
+    change_events = Column(Float, nullable=False, default=0.0)  # Cambios de precio/stock (con decaimiento)
+    observed_hours = Column(Float, nullable=False, default=0.0)  # Horas observadas (con decaimiento)
+    next_refresh_at = Column(DateTime, nullable=True)
 
     def to_dict(self) -> dict:
         """Convierte el modelo a diccionario"""
         return {
             "id": self.id,
+            "goods_id": self.goods_id,
             "title": self.title,
             "price": self.price,
             "original_price": self.original_price,
@@ -77,6 +99,7 @@ class Product(Base):
             "rating": self.rating,
             "reviews_count": self.reviews_count,
             "sales_count": self.sales_count,
+            "popularity_score": self.popularity_score,
             "image_url": self.image_url,
             "product_url": self.product_url,
             "affiliate_link": self.affiliate_link,
@@ -84,9 +107,74 @@ class Product(Base):
             "search_query": self.search_query,
             "scraped_at": self.scraped_at.isoformat() if self.scraped_at else None,
             "updated_at": self.updated_at.isoformat() if self.updated_at else None,
+            "checked_at": self.checked_at.isoformat() if self.checked_at else None,
+            "next_refresh_at": self.next_refresh_at.isoformat() if self.next_refresh_at else None,
+            "changes_per_day": round(volatility(self.change_events, self.observed_hours) * 24, 3),
             "is_active": self.is_active
         }
 
+class ProductAlias(Base):
+    """Variantes de URL (slug, idioma, parámetros de tracking) de un producto ya guardado"""
+    __tablename__ = "product_aliases"
+
+    url = Column(String(1000), primary_key=True)
+    product_id = Column(Integer, ForeignKey("products.id", ondelete="CASCADE"), nullable=False, index=True)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+class ProductPrice(Base):
+    """Historial de precios (append-only): una fila por cambio de precio"""
+    __tablename__ = "product_prices"
+    __table_args__ = (
+        Index("ix_product_prices_product_recorded", "product_id", "recorded_at"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    product_id = Column(Integer, ForeignKey("products.id", ondelete="CASCADE"), nullable=False)
+    recorded_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+    price = Column(Float, nullable=False)
+    original_price = Column(Float, nullable=True)
+    discount_percentage = Column(Integer, nullable=True)
+
+    def to_dict(self) -> dict:
+        return {
+            "product_id": self.product_id,
+            "recorded_at": self.recorded_at.isoformat() if self.recorded_at else None,
+            "price": self.price,
+            "original_price": self.original_price,
+            "discount_percentage": self.discount_percentage
+        }
+
+class CatalogStat(Base):
+    """
+    Estadísticas mantenidas de forma incremental (lectura O(1))
+
+    scope: "global" (key ""), "category" o "query". El upsert de productos y
+    save_search_history aplican deltas; rebuild_stats las recalcula desde cero.
+    """
+    __tablename__ = "catalog_stats"
+
+    scope = Column(String(20), primary_key=True)
+    key = Column(String(200), primary_key=True)
+
+    product_count = Column(Integer, nullable=False, default=0)
+    price_sum = Column(Float, nullable=False, default=0.0)
+    rating_sum = Column(Float, nullable=False, default=0.0)
+    rating_count = Column(Integer, nullable=False, default=0)
+    search_count = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def to_dict(self) -> dict:
+        return {
+            "scope": self.scope,
+            "key": self.key,
+            "total_products": self.product_count,
+            "avg_price": round(self.price_sum / self.product_count, 2) if self.product_count else 0,
+            "avg_rating": round(self.rating_sum / self.rating_count, 2) if self.rating_count else 0,
+            "total_searches": self.search_count,
+            "updated_at": self.updated_at.isoformat() if self.updated_at else None
+        }
+
 class SearchHistory(Base):
     """Historial de búsquedas realizadas"""
     __tablename__ = "search_history"
@@ -111,6 +199,7 @@ class SearchHistory(Base):
     execution_time = Column(Float)  # Segundos
     success = Column(Boolean, default=True)
     error_message = Column(Text, nullable=True)
+    timing = Column(Text, nullable=True)  # Desglose de tiempos por etapa (JSON)
 
     def to_dict(self) -> dict:
         return {
@@ -127,7 +216,8 @@ class SearchHistory(Base):
             "created_at": self.created_at.isoformat() if self.created_at else None,
             "execution_time": self.execution_time,
             "success": self.success,
-            "error_message": self.error_message
+            "error_message": self.error_message,
+            "timing": json.loads(self.timing) if self.timing else None
         }
 
 # ================== DATABASE MANAGER ==================
@@ -136,87 +226,231 @@ class DatabaseManager:
     """Gestor de base de datos con soporte async"""
 
     def __init__(self):
-        # Engine síncrono (para crear tablas)
-        if DATABASE_TYPE == "sqlite":
-            self.engine = create_engine(
-                DATABASE_URL,
-                connect_args={"check_same_thread": False},
-                poolclass=StaticPool
-            )
-        else:
-            self.engine = create_engine(DATABASE_URL, pool_pre_ping=True)
+        # Engine principal (escrituras) y réplica opcional para consultas de solo lectura
+        self.async_engine = build_engine(ASYNC_DATABASE_URL)
+        self.read_engine = build_engine(ASYNC_DATABASE_REPLICA_URL) if ASYNC_DATABASE_REPLICA_URL else self.async_engine
 
-        # Engine asíncrono (para operaciones)
-        self.async_engine = create_async_engine(
-            ASYNC_DATABASE_URL,
-            echo=False,
-            pool_pre_ping=True
-        )
-
-        # Session maker
+        # Session makers
         self.async_session_maker = async_sessionmaker(
             self.async_engine,
             class_=AsyncSession,
             expire_on_commit=False
         )
+        self.read_session_maker = async_sessionmaker(
+            self.read_engine,
+            class_=AsyncSession,
+            expire_on_commit=False
+        )
+
+        # Métricas de los pools
+        self.pool_metrics = {"primary": PoolMetrics(self.async_engine)}
+        if self.read_engine is not self.async_engine:
+            self.pool_metrics["replica"] = PoolMetrics(self.read_engine)
+
+    async def create_tables(self):
+        """Crea todas las tablas, índices de búsqueda y migraciones pendientes"""
+        async with self.async_engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+            await conn.run_sync(_migrate_schema)
+            await conn.run_sync(_create_search_index)
+
+            # Estadísticas incrementales de una base de datos que ya tenía datos
+            if (await conn.execute(select(CatalogStat.scope).limit(1))).first() is None:
+                for statement in _rebuild_stats_statements():
+                    await conn.execute(statement)
 
-    def create_tables(self):
-        """Crea todas las tablas (síncrono)"""
-        Base.metadata.create_all(bind=self.engine)
         print("✅ Tablas creadas exitosamente")
 
     @asynccontextmanager
-    async def get_session(self):
-        """Context manager para sesiones async"""
-        async with self.async_session_maker() as session:
+    async def get_session(self, readonly: bool = False):
+        """
+        Context manager para sesiones async
+
+        readonly=True usa la réplica si DATABASE_REPLICA_URL está configurada.
+        """
+        replica = readonly and "replica" in self.pool_metrics
+        maker = self.read_session_maker if replica else self.async_session_maker
+        metrics = self.pool_metrics["replica" if replica else "primary"]
+
+        async with maker() as session:
             try:
+                # Checkout explícito para medir la espera por una conexión del pool
+                started = time.perf_counter()
+                try:
+                    await session.connection()
+                except PoolTimeoutError:
+                    metrics.observe_timeout()
+                    raise
+                metrics.observe(time.perf_counter() - started)
+
                 yield session
                 await session.commit()
             except Exception:
                 await session.rollback()
                 raise
 
+    def pool_stats(self) -> dict:
+        """Espera de checkout y ocupación de cada pool"""
+        return {name: metrics.snapshot() for name, metrics in self.pool_metrics.items()}
+
     async def save_product(self, product_data: dict) -> Product:
         """Guarda o actualiza un producto"""
-        async with self.get_session() as session:
-            # Buscar si existe por product_url
-            from sqlalchemy import select
-            stmt = select(Product).where(Product.product_url == product_data.get("product_url"))
-            result = await session.execute(stmt)
-            existing = result.scalar_one_or_none()
-
-            if existing:
-                # Actualizar
-                for key, value in product_data.items():
-                    if hasattr(existing, key):
-                        setattr(existing, key, value)
-                existing.updated_at = datetime.utcnow()
-                product = existing
-            else:
-                # Crear nuevo
-                product = Product(**product_data)
-                session.add(product)
-
-            await session.commit()
-            await session.refresh(product)
-            return product
-
-    async def save_products_batch(self, products_data: List[dict]) -> List[Product]:
-        """Guarda múltiples productos"""
+        saved = await self.save_products_batch([product_data])
+        return saved[0] if saved else await self.get_product_by_url(product_data["product_url"])
+
+    async def save_products_batch(
+        self,
+        products_data: List[dict],
+        chunk_size: int = DB_UPSERT_CHUNK_SIZE
+    ) -> List[Product]:
+        """
+        Guarda o actualiza múltiples productos en una sola transacción
+
+        INSERT ... ON CONFLICT (goods_id) DO UPDATE por bloques de chunk_size
+        filas: un round-trip por bloque. Las URLs sin goods_id reconocible usan
+        product_url como clave. El upsert es atómico en la base de datos, así
+        que dos scrapes que guardan el mismo producto a la vez no chocan. Los
+        campos que faltan en un scrape no borran los ya guardados, y las
+        variantes de URL de un producto ya guardado quedan como aliases.
+
+        Los productos cuya huella de contenido no cambió no se reescriben: solo
+        se actualiza su estado de refresco (checked_at, volatilidad y
+        next_refresh_at) con un UPDATE por clave primaria.
+
+        Returns:
+            Productos insertados o modificados
+        """
+        rows, variants = _upsert_rows(products_data)
+        if not rows:
+            return []
+
+        now = datetime.utcnow()
         saved = []
-        for product_data in products_data:
-            product = await self.save_product(product_data)
-            saved.append(product)
+
+        async with self.get_session() as session:
+            for start in range(0, len(rows), chunk_size):
+                chunk = rows[start:start + chunk_size]
+
+                # Valores previos: deltas de catalog_stats y detección de cambios
+                stmt = select(*_PREVIOUS_COLUMNS, *_STAT_COLUMNS).where(or_(
+                    Product.goods_id.in_([row["goods_id"] for row in chunk if row["goods_id"]]),
+                    Product.product_url.in_([row["product_url"] for row in chunk if not row["goods_id"]])
+                ))
+                previous = {
+                    product_key(row.goods_id, row.product_url): row
+                    for row in (await session.execute(stmt)).all()
+                }
+                previous.update(await self._claim_unidentified(session, chunk, previous, variants))
+
+                changed, unchanged = [], []
+                for row in chunk:
+                    old = previous.get(product_key(row["goods_id"], row["product_url"]))
+                    row["content_hash"] = content_fingerprint(row)
+                    refresh = _observe_refresh(old, row, now)
+
+                    if old is not None and old.is_active and old.content_hash == row["content_hash"]:
+                        # updated_at explícito: es la fecha del último cambio, no del último scrape
+                        unchanged.append({"id": old.id, "updated_at": old.updated_at, **refresh})
+                    else:
+                        row.update(refresh)
+                        changed.append(row)
+
+                if unchanged:
+                    await session.execute(update(Product), unchanged)
+
+                products = []
+                if changed:
+                    products = await self._upsert_products(session, changed)
+                    saved.extend(products)
+
+                    # Historial de precios y estadísticas en la misma transacción
+                    await session.execute(_record_price_changes([product.id for product in products]))
+
+                    deltas = _StatDeltas()
+                    for row in changed:
+                        old = previous.get(product_key(row["goods_id"], row["product_url"]))
+                        if old is not None:
+                            deltas.add_product(old, sign=-1)
+                    for product in products:
+                        deltas.add_product(product, sign=1)
+                    await self._apply_stat_deltas(session, deltas)
+
+                stored = {key: (old.id, old.product_url) for key, old in previous.items()}
+                stored.update({
+                    product_key(product.goods_id, product.product_url): (product.id, product.product_url)
+                    for product in products
+                })
+                await self._save_aliases(session, stored, variants)
+
         return saved
 
     async def get_product_by_url(self, product_url: str) -> Optional[Product]:
-        """Obtiene producto por URL"""
-        async with self.get_session() as session:
-            from sqlalchemy import select
-            stmt = select(Product).where(Product.product_url == product_url)
+        """Obtiene producto por URL (cualquier variante: se busca por goods_id o por alias)"""
+        goods_id = canonical_goods_id(product_url)
+        if goods_id is not None:
+            return await self.get_product_by_goods_id(goods_id)
+
+        url = canonical_url(product_url)
+        async with self.get_session(readonly=True) as session:
+            stmt = select(Product).where(or_(
+                Product.product_url == url,
+                Product.id.in_(select(ProductAlias.product_id).where(ProductAlias.url == url))
+            )).limit(1)
             result = await session.execute(stmt)
             return result.scalar_one_or_none()
 
+    async def get_product_by_goods_id(self, goods_id: int) -> Optional[Product]:
+        """Obtiene producto por su goods_id de Temu"""
+        async with self.get_session(readonly=True) as session:
+            result = await session.execute(select(Product).where(Product.goods_id == goods_id))
+            return result.scalar_one_or_none()
+
+    async def get_refresh_queue(self, until: Optional[datetime] = None, limit: int = 100) -> List[dict]:
+        """
+        Productos activos con refresco previsto hasta until (por defecto, ya vencidos)
+
+        Ordenados por next_refresh_at; cada uno incluye su staleness esperada
+        (probabilidad de que haya cambiado desde el último scrape).
+        """
+        now = datetime.utcnow()
+        async with self.get_session(readonly=True) as session:
+            stmt = (
+                select(
+                    Product.id, Product.product_url, Product.checked_at, Product.next_refresh_at,
+                    Product.change_events, Product.observed_hours
+                )
+                .where(Product.is_active == True, Product.next_refresh_at <= (until or now))
+                .order_by(Product.next_refresh_at)
+                .limit(limit)
+            )
+            rows = (await session.execute(stmt)).all()
+
+        return [
+            {
+                "id": row.id,
+                "product_url": row.product_url,
+                "checked_at": row.checked_at.isoformat() if row.checked_at else None,
+                "next_refresh_at": row.next_refresh_at.isoformat(),
+                "changes_per_day": round(volatility(row.change_events, row.observed_hours) * 24, 3),
+                "expected_staleness": round(
+                    expected_staleness(row.change_events, row.observed_hours, row.checked_at, now), 4
+                )
+            }
+            for row in rows
+        ]
+
+    async def defer_refresh(self, product_ids: List[int], hours: float = REFRESH_MIN_INTERVAL_HOURS):
+        """Aplaza el próximo refresco (p. ej. tras un scrape fallido)"""
+        if not product_ids:
+            return
+
+        async with self.get_session() as session:
+            await session.execute(
+                update(Product)
+                .where(Product.id.in_(product_ids))
+                .values(next_refresh_at=datetime.utcnow() + timedelta(hours=hours), updated_at=Product.updated_at)
+            )
+
     async def search_products(
         self,
         query: Optional[str] = None,
@@ -227,22 +461,23 @@ class DatabaseManager:
         price_max: Optional[float] = None,
         category: Optional[str] = None,
         limit: int = 100,
-        offset: int = 0
+        offset: int = 0,
+        cursor: Optional[str] = None
     ) -> List[Product]:
-        """Busca productos con filtros"""
-        async with self.get_session() as session:
-            from sqlalchemy import select, or_
-
+        """
+        Busca productos con filtros
+
+        Con query usa el índice de texto completo y ordena por relevancia
+        ponderada con la popularidad; sin query, por popularidad.
+        Con cursor (ver search_products_page) pagina por keyset en lugar de offset.
+        """
+        async with self.get_session(readonly=True) as session:
             stmt = select(Product).where(Product.is_active == True)
+            relevance = None
 
-            # Filtros
+            # Búsqueda de texto
             if query:
-                stmt = stmt.where(
-                    or_(
-                        Product.title.ilike(f"%{query}%"),
-                        Product.search_query.ilike(f"%{query}%")
-                    )
-                )
+                stmt, relevance = _text_search(stmt, query, self.async_engine.dialect.name)
 
             if min_rating:
                 stmt = stmt.where(Product.rating >= min_rating)
@@ -262,8 +497,19 @@ class DatabaseManager:
             if category:
                 stmt = stmt.where(Product.category == category)
 
-            # Ordenar por rating * reviews (popularidad)
-            stmt = stmt.order_by((Product.rating * Product.reviews_count).desc())
+            if cursor:
+                if relevance is not None:
+                    raise ValueError("Cursor pagination is not available for text queries, use offset")
+                score, last_id = decode_cursor(cursor)
+                stmt = stmt.where(or_(
+                    Product.popularity_score < score,
+                    and_(Product.popularity_score == score, Product.id < last_id)
+                ))
+
+            # Ordenar por relevancia (si hay query) y popularidad (rating * reviews)
+            if relevance is not None:
+                stmt = stmt.order_by((relevance * (1.0 + _popularity_boost(Product.popularity_score))).desc())
+            stmt = stmt.order_by(Product.popularity_score.desc(), Product.id.desc())
 
             # Paginación
             stmt = stmt.limit(limit).offset(offset)
@@ -271,55 +517,796 @@ class DatabaseManager:
             result = await session.execute(stmt)
             return result.scalars().all()
 
+    async def search_products_page(self, limit: int = 100, cursor: Optional[str] = None, **filters) -> dict:
+        """
+        Página de productos por popularidad con paginación keyset
+
+        Returns:
+            Dict con products y next_cursor (None en la última página)
+        """
+        products = await self.search_products(limit=limit + 1, cursor=cursor, **filters)
+        has_more = len(products) > limit
+        products = products[:limit]
+
+        return {
+            "products": products,
+            "next_cursor": encode_cursor(products[-1]) if has_more else None
+        }
+
+    async def get_price_history(
+        self,
+        product_id: int,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+        limit: int = 1000
+    ) -> List[ProductPrice]:
+        """Cambios de precio de un producto en un rango de fechas (más antiguos primero)"""
+        async with self.get_session(readonly=True) as session:
+            stmt = select(ProductPrice).where(ProductPrice.product_id == product_id)
+
+            if start:
+                stmt = stmt.where(ProductPrice.recorded_at >= start)
+
+            if end:
+                stmt = stmt.where(ProductPrice.recorded_at < end)
+
+            stmt = stmt.order_by(ProductPrice.recorded_at).limit(limit)
+
+            result = await session.execute(stmt)
+            return result.scalars().all()
+
+    async def get_price_history_daily(
+        self,
+        product_id: int,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None
+    ) -> List[dict]:
+        """
+        Historial agregado por día (para gráficas)
+
+        Cada día incluye min/max/media de los precios registrados ese día y el
+        precio vigente al cierre (último cambio del día).
+        """
+        async with self.get_session(readonly=True) as session:
+            day = func.date(ProductPrice.recorded_at).label("day")
+            stmt = select(
+                day,
+                func.min(ProductPrice.price),
+                func.max(ProductPrice.price),
+                func.avg(ProductPrice.price),
+                func.count(ProductPrice.id),
+                func.max(ProductPrice.recorded_at)
+            ).where(ProductPrice.product_id == product_id)
+
+            if start:
+                stmt = stmt.where(ProductPrice.recorded_at >= start)
+
+            if end:
+                stmt = stmt.where(ProductPrice.recorded_at < end)
+
+            stmt = stmt.group_by(day).order_by(day)
+            rows = (await session.execute(stmt)).all()
+
+            # Precio de cierre: el del último cambio de cada día
+            closes = {}
+            last_changes = [row[5] for row in rows]
+            if last_changes:
+                close_stmt = select(ProductPrice.recorded_at, ProductPrice.price).where(
+                    ProductPrice.product_id == product_id,
+                    ProductPrice.recorded_at.in_(last_changes)
+                )
+                closes = dict((await session.execute(close_stmt)).all())
+
+            return [
+                {
+                    "day": str(row[0]),
+                    "min_price": row[1],
+                    "max_price": row[2],
+                    "avg_price": round(row[3], 2),
+                    "changes": row[4],
+                    "close_price": closes.get(row[5])
+                }
+                for row in rows
+            ]
+
     async def save_search_history(self, search_data: dict) -> SearchHistory:
         """Guarda historial de búsqueda"""
+        saved = await self.save_search_histories([search_data])
+        return saved[0]
+
+    async def save_search_histories(self, searches_data: List[dict]) -> List[SearchHistory]:
+        """Guarda varias búsquedas (y sus estadísticas) en una sola transacción"""
+        if not searches_data:
+            return []
+
         async with self.get_session() as session:
-            search = SearchHistory(**search_data)
-            session.add(search)
-            await session.commit()
-            await session.refresh(search)
-            return search
+            searches = [SearchHistory(**search_data) for search_data in searches_data]
+            session.add_all(searches)
+
+            deltas = _StatDeltas()
+            for search in searches:
+                deltas.add_search(search.search_query)
+            await self._apply_stat_deltas(session, deltas)
+
+            await session.flush()
+            return searches
 
     async def get_search_history(self, limit: int = 50) -> List[SearchHistory]:
         """Obtiene historial de búsquedas"""
-        async with self.get_session() as session:
+        async with self.get_session(readonly=True) as session:
             from sqlalchemy import select
             stmt = select(SearchHistory).order_by(SearchHistory.created_at.desc()).limit(limit)
             result = await session.execute(stmt)
             return result.scalars().all()
 
     async def get_stats(self) -> dict:
-        """Obtiene estadísticas generales"""
-        async with self.get_session() as session:
-            from sqlalchemy import select, func
+        """Obtiene estadísticas generales (fila global de catalog_stats)"""
+        async with self.get_session(readonly=True) as session:
+            stat = await session.get(CatalogStat, ("global", ""))
 
-            # Total productos
-            total_stmt = select(func.count(Product.id)).where(Product.is_active == True)
-            total_result = await session.execute(total_stmt)
-            total_products = total_result.scalar()
+        if stat is None:
+            return await self.compute_stats()
 
-            # Precio promedio
-            avg_price_stmt = select(func.avg(Product.price)).where(Product.is_active == True)
-            avg_price_result = await session.execute(avg_price_stmt)
-            avg_price = avg_price_result.scalar() or 0
+        stats = stat.to_dict()
+        return {key: stats[key] for key in ("total_products", "avg_price", "avg_rating", "total_searches")}
 
-            # Rating promedio
-            avg_rating_stmt = select(func.avg(Product.rating)).where(Product.is_active == True)
-            avg_rating_result = await session.execute(avg_rating_stmt)
-            avg_rating = avg_rating_result.scalar() or 0
+    async def compute_stats(self) -> dict:
+        """Estadísticas generales calculadas sobre las tablas en una sola consulta"""
+        async with self.get_session(readonly=True) as session:
+            stmt = select(
+                func.count(Product.id),
+                func.avg(Product.price),
+                func.avg(Product.rating),
+                select(func.count(SearchHistory.id)).scalar_subquery()
+            ).where(Product.is_active == True)
 
-            # Total búsquedas
-            total_searches_stmt = select(func.count(SearchHistory.id))
-            total_searches_result = await session.execute(total_searches_stmt)
-            total_searches = total_searches_result.scalar()
+            total_products, avg_price, avg_rating, total_searches = (await session.execute(stmt)).one()
 
             return {
                 "total_products": total_products,
-                "avg_price": round(avg_price, 2),
-                "avg_rating": round(avg_rating, 2),
+                "avg_price": round(avg_price or 0, 2),
+                "avg_rating": round(avg_rating or 0, 2),
                 "total_searches": total_searches
             }
 
+    async def get_stats_breakdown(self, scope: str = "category", limit: int = 50) -> List[dict]:
+        """Estadísticas por categoría (scope="category") o por búsqueda (scope="query")"""
+        if scope not in ("category", "query"):
+            raise ValueError(f"Unknown stats scope: {scope}")
+
+        order = CatalogStat.product_count if scope == "category" else CatalogStat.search_count
+        async with self.get_session(readonly=True) as session:
+            stmt = (
+                select(CatalogStat)
+                .where(CatalogStat.scope == scope)
+                .where(or_(CatalogStat.product_count > 0, CatalogStat.search_count > 0))
+                .order_by(order.desc(), CatalogStat.key)
+                .limit(limit)
+            )
+            result = await session.execute(stmt)
+            return [stat.to_dict() for stat in result.scalars().all()]
+
+    async def rebuild_stats(self):
+        """Recalcula catalog_stats desde products y search_history"""
+        async with self.get_session() as session:
+            for statement in _rebuild_stats_statements():
+                await session.execute(statement)
+
+    # ---------- internos ----------
+
+    def _insert(self):
+        """INSERT con ON CONFLICT del dialecto del engine"""
+        return pg_insert if self.async_engine.dialect.name == "postgresql" else sqlite_insert
+
+    async def _upsert_products(self, session, rows: List[dict]) -> List[Product]:
+        """Upsert de filas: por goods_id las que lo tienen, por product_url el resto"""
+        products = []
+        by_goods_id = [row for row in rows if row["goods_id"]]
+        by_url = [row for row in rows if not row["goods_id"]]
+
+        for group, target in ((by_goods_id, Product.goods_id), (by_url, Product.product_url)):
+            if not group:
+                continue
+
+            stmt = self._insert()(Product).values(group)
+            stmt = stmt.on_conflict_do_update(index_elements=[target], set_=_upsert_set(stmt.excluded))
+            result = await session.scalars(
+                stmt.returning(Product),
+                execution_options={"populate_existing": True}
+            )
+            products.extend(result.all())
+
+        return products
+
+    async def _claim_unidentified(self, session, chunk: List[dict], previous: dict, variants: Dict[tuple, set]) -> dict:
+        """
+        Asigna el goods_id a productos guardados antes sin él
+
+        Una URL guardada con goods_id NULL (slug sin id numérico y sin id del
+        extractor) que vuelve con goods_id no choca con ON CONFLICT (goods_id)
+        sino con el UNIQUE de product_url. Se busca la fila sin goods_id por su
+        URL o por un alias y se le pone el goods_id, para que el upsert la
+        actualice en lugar de insertar otra.
+
+        Returns:
+            Valores previos de las filas reclamadas, por clave de producto
+        """
+        urls = {}
+        for row in chunk:
+            key = product_key(row["goods_id"], row["product_url"])
+            if row["goods_id"] and key not in previous:
+                for url in variants.get(key, {row["product_url"]}):
+                    urls.setdefault(url, key)
+        if not urls:
+            return {}
+
+        stmt = (
+            select(*_PREVIOUS_COLUMNS, *_STAT_COLUMNS, ProductAlias.url.label("alias_url"))
+            .outerjoin(ProductAlias, and_(ProductAlias.product_id == Product.id, ProductAlias.url.in_(urls)))
+            .where(Product.goods_id.is_(None), or_(Product.product_url.in_(urls), ProductAlias.url.in_(urls)))
+            .order_by(Product.id)
+        )
+        claimed, claimed_ids = {}, set()
+        for old in (await session.execute(stmt)).all():
+            key = urls.get(old.product_url) or urls.get(old.alias_url)
+            if key in claimed or old.id in claimed_ids:
+                continue
+            claimed[key] = old
+            claimed_ids.add(old.id)
+
+        if claimed:
+            # updated_at explícito: asignar la identidad no es un cambio de contenido
+            await session.execute(update(Product), [
+                {"id": old.id, "goods_id": key[1], "updated_at": old.updated_at} for key, old in claimed.items()
+            ])
+        return claimed
+
+    async def _save_aliases(self, session, stored: Dict[tuple, tuple], variants: Dict[tuple, set]):
+        """Registra las variantes de URL distintas de la product_url guardada"""
+        aliases = [
+            {"url": url, "product_id": product_id, "created_at": datetime.utcnow()}
+            for key, (product_id, product_url) in stored.items()
+            for url in sorted(variants.get(key, ()))
+            if url != product_url
+        ]
+        if not aliases:
+            return
+
+        stmt = self._insert()(ProductAlias).values(aliases)
+        await session.execute(stmt.on_conflict_do_nothing(index_elements=[ProductAlias.url]))
+
+    async def _apply_stat_deltas(self, session, deltas: "_StatDeltas"):
+        """Suma los deltas a catalog_stats con un único upsert"""
+        rows = deltas.rows()
+        if not rows:
+            return
+
+        stmt = self._insert()(CatalogStat).values(rows)
+        columns = CatalogStat.__table__.c
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[CatalogStat.scope, CatalogStat.key],
+            set_={
+                **{name: columns[name] + stmt.excluded[name] for name in _STAT_FIELDS},
+                "updated_at": stmt.excluded.updated_at
+            }
+        )
+        await session.execute(stmt)
+
+# ================== UPSERT ==================
+
+# Columnas que escribe el upsert (el id y la fecha del primer scrape no se tocan)
+_UPSERT_COLUMNS = [
+    column.name for column in Product.__table__.columns
+    if column.name not in ("id", "price_history")
+]
+_UPSERT_UPDATE_COLUMNS = [name for name in _UPSERT_COLUMNS if name not in ("goods_id", "product_url", "scraped_at")]
+# Si el scrape no trae el campo se conserva el valor guardado
+_KEEP_IF_MISSING = {
+    "original_price", "discount_percentage", "rating", "reviews_count", "sales_count",
+    "image_url", "affiliate_link", "category", "search_query"
+}
+
+
+def _popularity(rating, reviews_count) -> float:
+    return (rating or 0) * (reviews_count or 0)
+
+
+def _upsert_set(excluded) -> dict:
+    """SET del ON CONFLICT DO UPDATE (popularity_score con los valores finales)"""
+    columns = Product.__table__.c
+    values = {
+        name: (
+            func.coalesce(excluded[name], columns[name])
+            if name in _KEEP_IF_MISSING else excluded[name]
+        )
+        for name in _UPSERT_UPDATE_COLUMNS
+    }
+    values["popularity_score"] = (
+        func.coalesce(values["rating"], 0) * func.coalesce(values["reviews_count"], 0)
+    )
+    return values
+
+
+def canonical_url(url: str) -> str:
+    """URL sin parámetros de afiliado ni de tracking"""
+    return clean_affiliate_link(url)
+
+
+def _goods_id(value) -> Optional[int]:
+    text_value = str(value or "").strip()
+    return int(text_value) if text_value.isdigit() and 0 < int(text_value) < 2 ** 63 else None
+
+
+def product_key(goods_id: Optional[int], product_url: str) -> tuple:
+    """Identidad de un producto: su goods_id o, si no se reconoce, su URL"""
+    return ("goods_id", goods_id) if goods_id else ("product_url", product_url)
+
+
+def _upsert_rows(products_data: List[dict]) -> Tuple[List[dict], Dict[tuple, set]]:
+    """
+    Filas homogéneas para el INSERT multi-VALUES
+
+    Una fila por producto (goods_id o, si no hay, product_url; gana la última:
+    ON CONFLICT no admite la misma clave dos veces en una sentencia) y
+    ordenadas por clave para que upserts concurrentes bloqueen las filas en
+    el mismo orden.
+
+    Returns:
+        Tupla (filas, variantes de URL vistas por clave de producto)
+    """
+    now = datetime.utcnow()
+    rows, variants = {}, {}
+
+    for product_data in products_data:
+        product_url = product_data.get("product_url")
+        if not product_url:
+            continue
+
+        row = {name: product_data.get(name) for name in _UPSERT_COLUMNS}
+        row["product_url"] = canonical_url(product_url)
+        # El goods_id de la URL manda; el del extractor sirve si la URL no lo trae
+        row["goods_id"] = canonical_goods_id(row["product_url"]) or _goods_id(row["goods_id"])
+        row["scraped_at"] = row["scraped_at"] or now
+        row["updated_at"] = now
+        row["is_active"] = True if row["is_active"] is None else row["is_active"]
+        row["popularity_score"] = _popularity(row["rating"], row["reviews_count"])
+
+        key = product_key(row["goods_id"], row["product_url"])
+        rows[key] = row
+        variants.setdefault(key, set()).add(row["product_url"])
+
+    ordered = sorted(rows.values(), key=lambda row: (row["goods_id"] is None, row["goods_id"] or 0, row["product_url"]))
+    return ordered, variants
+
+# ================== FRESCURA ==================
+
+# Campos que forman la huella del contenido de un producto
+_FINGERPRINT_FIELDS = (
+    "title", "price", "original_price", "discount_percentage", "rating", "reviews_count",
+    "sales_count", "image_url", "category", "is_active"
+)
+# Valores previos que lee el upsert: estadísticas + detección de cambios
+_PREVIOUS_COLUMNS = (
+    Product.id, Product.goods_id, Product.product_url, Product.original_price, Product.updated_at, Product.content_hash,
+    Product.checked_at, Product.change_events, Product.observed_hours
+)
+
+
+def content_fingerprint(row: dict) -> str:
+    """Huella (md5) de los campos scrapeados de un producto"""
+    payload = json.dumps([row.get(name) for name in _FINGERPRINT_FIELDS], default=str, separators=(",", ":"))
+    return hashlib.md5(payload.encode("utf-8")).hexdigest()
+
+
+def volatility(change_events: float, observed_hours: float) -> float:
+    """
+    Cambios de precio/stock esperados por hora
+
+    Estimador gamma-Poisson: un cambio a priori cada REFRESH_PRIOR_HOURS,
+    corregido con los cambios observados.
+    """
+    return ((change_events or 0) + 1.0) / ((observed_hours or 0) + REFRESH_PRIOR_HOURS)
+
+
+def expected_staleness(change_events: float, observed_hours: float, checked_at: Optional[datetime], now: datetime) -> float:
+    """Probabilidad de que el producto haya cambiado desde checked_at"""
+    if checked_at is None:
+        return 1.0
+    hours = max(0.0, (now - checked_at).total_seconds() / 3600)
+    return 1.0 - math.exp(-volatility(change_events, observed_hours) * hours)
+
+
+def refresh_interval_hours(change_events: float, observed_hours: float) -> float:
+    """Horas hasta que la staleness esperada alcanza REFRESH_TARGET_STALENESS"""
+    hours = -math.log(1.0 - REFRESH_TARGET_STALENESS) / volatility(change_events, observed_hours)
+    return min(REFRESH_MAX_INTERVAL_HOURS, max(REFRESH_MIN_INTERVAL_HOURS, hours))
+
+
+def _observe_refresh(previous, row: dict, now: datetime) -> dict:
+    """
+    Nuevo estado de refresco de un producto tras un scrape
+
+    Cuenta como cambio una variación de precio o que un producto inactivo
+    vuelva a estar disponible. Las observaciones anteriores pesan
+    REFRESH_HISTORY_DECAY para adaptarse a cambios de comportamiento.
+    """
+    change_events, observed_hours = 0.0, 0.0
+
+    if previous is not None and previous.checked_at is not None:
+        elapsed = max(0.0, (now - previous.checked_at).total_seconds() / 3600)
+        changed = (
+            not previous.is_active
+            or previous.price != row["price"]
+            or (row["original_price"] is not None and previous.original_price != row["original_price"])
+        )
+        change_events = previous.change_events * REFRESH_HISTORY_DECAY + (1.0 if changed else 0.0)
+        observed_hours = previous.observed_hours * REFRESH_HISTORY_DECAY + elapsed
+
+    return {
+        "checked_at": now,
+        "change_events": change_events,
+        "observed_hours": observed_hours,
+        "next_refresh_at": now + timedelta(hours=refresh_interval_hours(change_events, observed_hours))
+    }
+
+# ================== ESQUEMA ==================
+
+def _migrate_schema(conn):
+    """Añade a una base de datos existente las columnas e índices nuevos"""
+    columns = {column["name"] for column in inspect(conn).get_columns("products")}
+
+    if "popularity_score" not in columns:
+        conn.execute(text("ALTER TABLE products ADD COLUMN popularity_score FLOAT NOT NULL DEFAULT 0"))
+        conn.execute(text(
+            "UPDATE products SET popularity_score = COALESCE(rating, 0) * COALESCE(reviews_count, 0)"
+        ))
+        _create_indexes(conn, "popularity_score")
+        print("✅ Columna popularity_score añadida")
+
+    if "next_refresh_at" not in columns:
+        for statement in (
+            "ALTER TABLE products ADD COLUMN content_hash VARCHAR(32)",
+            "ALTER TABLE products ADD COLUMN checked_at TIMESTAMP",
+            "ALTER TABLE products ADD COLUMN change_events FLOAT NOT NULL DEFAULT 0",
+            "ALTER TABLE products ADD COLUMN observed_hours FLOAT NOT NULL DEFAULT 0",
+            "ALTER TABLE products ADD COLUMN next_refresh_at TIMESTAMP",
+            # Los productos existentes entran a la cola por antigüedad
+            "UPDATE products SET checked_at = updated_at, next_refresh_at = updated_at",
+        ):
+            conn.execute(text(statement))
+        _create_indexes(conn, "next_refresh_at")
+        print("✅ Columnas de refresco añadidas")
+
+    if "goods_id" not in columns:
+        conn.execute(text("ALTER TABLE products ADD COLUMN goods_id BIGINT"))
+        merged = _backfill_goods_ids(conn)
+        _create_indexes(conn, "goods_id")
+        if merged:
+            for statement in _rebuild_stats_statements():
+                conn.execute(statement)
+        print(f"✅ Columna goods_id añadida ({merged} variantes de URL fusionadas)")
+
+    if "timing" not in {column["name"] for column in inspect(conn).get_columns("search_history")}:
+        conn.execute(text("ALTER TABLE search_history ADD COLUMN timing TEXT"))
+        print("✅ Columna timing añadida al historial de búsquedas")
+
+
+def _backfill_goods_ids(conn) -> int:
+    """
+    Rellena goods_id de los productos existentes
+
+    Si varias filas son variantes del mismo producto se conserva la
+    actualizada más recientemente; las demás se desactivan y sus URLs pasan
+    a ser aliases de la conservada.
+
+    Returns:
+        Número de filas fusionadas
+    """
+    table = Product.__table__
+    rows = conn.execute(
+        select(table.c.id, table.c.product_url).order_by(table.c.updated_at.desc(), table.c.id.desc())
+    ).all()
+
+    kept, updates, duplicates, aliases = {}, [], [], []
+    for product_id, product_url in rows:
+        goods_id = canonical_goods_id(product_url)
+        if goods_id is None:
+            continue
+        if goods_id in kept:
+            duplicates.append(product_id)
+            aliases.append({"url": canonical_url(product_url), "product_id": kept[goods_id], "created_at": datetime.utcnow()})
+        else:
+            kept[goods_id] = product_id
+            updates.append({"pid": product_id, "gid": goods_id})
+
+    # updated_at se conserva: sigue siendo la fecha del último cambio
+    if updates:
+        conn.execute(
+            table.update().where(table.c.id == bindparam("pid"))
+            .values(goods_id=bindparam("gid"), updated_at=table.c.updated_at),
+            updates
+        )
+    if duplicates:
+        conn.execute(
+            table.update().where(table.c.id.in_(duplicates))
+            .values(is_active=False, updated_at=table.c.updated_at)
+        )
+        conn.execute(ProductAlias.__table__.insert(), aliases)
+
+    return len(duplicates)
+
+
+def _create_indexes(conn, column: str):
+    """Crea los índices de products que incluyen column"""
+    for index in Product.__table__.indexes:
+        if column in index.columns:
+            index.create(bind=conn, checkfirst=True)
+
+
+def _create_search_index(conn):
+    """
+    Crea el índice de texto completo de productos (idempotente)
+
+    SQLite: tabla virtual FTS5 sobre products mantenida con triggers.
+    PostgreSQL: columna tsvector generada con índice GIN y un índice
+    pg_trgm sobre title para coincidencias parciales.
+    """
+    dialect = conn.dialect.name
+
+    if dialect == "sqlite":
+        existed = conn.execute(
+            text("SELECT 1 FROM sqlite_master WHERE name = 'products_fts'")
+        ).first() is not None
+        for statement in _SQLITE_SEARCH_DDL:
+            conn.execute(text(statement))
+        if not existed:
+            # Indexar los productos que ya existían
+            conn.execute(text("INSERT INTO products_fts(products_fts) VALUES ('rebuild')"))
+
+    elif dialect == "postgresql":
+        for statement in _POSTGRES_SEARCH_DDL:
+            conn.execute(text(statement))
+
+# ================== ESTADÍSTICAS ==================
+
+_STAT_FIELDS = ("product_count", "price_sum", "rating_sum", "rating_count", "search_count")
+# Columnas de products que afectan a catalog_stats
+_STAT_COLUMNS = (Product.price, Product.rating, Product.category, Product.search_query, Product.is_active)
+
+
+def _stat_key(value: Optional[str]) -> str:
+    return (value or "").strip().lower()[:200]
+
+
+class _StatDeltas:
+    """Acumula los cambios de catalog_stats de una transacción por (scope, key)"""
+
+    def __init__(self):
+        self._deltas: Dict[tuple, Dict[str, float]] = {}
+
+    def _add(self, scope: str, key: str, **values):
+        delta = self._deltas.setdefault((scope, key), dict.fromkeys(_STAT_FIELDS, 0))
+        for name, value in values.items():
+            delta[name] += value
+
+    def add_product(self, product, sign: int):
+        """Suma (sign=1) o resta (sign=-1) la contribución de un producto"""
+        if not product.is_active:
+            return
+
+        values = {
+            "product_count": sign,
+            "price_sum": sign * (product.price or 0),
+            "rating_sum": sign * (product.rating or 0),
+            "rating_count": sign if product.rating is not None else 0
+        }
+        self._add("global", "", **values)
+        if product.category:
+            self._add("category", _stat_key(product.category), **values)
+        if product.search_query:
+            self._add("query", _stat_key(product.search_query), **values)
+
+    def add_search(self, search_query: Optional[str]):
+        self._add("global", "", search_count=1)
+        if search_query:
+            self._add("query", _stat_key(search_query), search_count=1)
+
+    def rows(self) -> List[dict]:
+        now = datetime.utcnow()
+        return [
+            {"scope": scope, "key": key, "updated_at": now, **delta}
+            for (scope, key), delta in sorted(self._deltas.items())
+            if any(delta.values())
+        ]
+
+
+def _rebuild_stats_statements() -> list:
+    """DELETE + INSERT ... SELECT que recalculan catalog_stats (una pasada por agrupación)"""
+    table = CatalogStat.__table__
+    active = Product.is_active == True
+    now = literal_column("CURRENT_TIMESTAMP")
+    product_fields = ["scope", "key", "product_count", "price_sum", "rating_sum", "rating_count", "search_count", "updated_at"]
+
+    def by_products(scope: str, key_column):
+        key = literal_column("''") if key_column is None else func.lower(func.trim(key_column))
+        stmt = select(
+            literal_column(f"'{scope}'"), key,
+            func.count(Product.id),
+            func.coalesce(func.sum(Product.price), 0.0),
+            func.coalesce(func.sum(Product.rating), 0.0),
+            func.count(Product.rating),
+            literal_column("0"),
+            now
+        ).where(active)
+        if key_column is not None:
+            stmt = stmt.where(key_column.is_not(None), key_column != "").group_by(key)
+        return table.insert().from_select(product_fields, stmt)
+
+    query_key = func.lower(func.trim(SearchHistory.search_query))
+    searches = select(
+        literal_column("'query'"), query_key, func.count(SearchHistory.id), now
+    ).group_by(query_key)
+    stat = aliased(CatalogStat)
+
+    return [
+        table.delete(),
+        by_products("global", None),
+        by_products("category", Product.category),
+        by_products("query", Product.search_query),
+        # Búsquedas: las queries sin productos se insertan, las demás se actualizan
+        table.update()
+        .where(table.c.scope == "global")
+        .values(search_count=select(func.count(SearchHistory.id)).scalar_subquery()),
+        table.update()
+        .where(table.c.scope == "query")
+        .values(search_count=select(func.count(SearchHistory.id)).where(query_key == table.c.key).scalar_subquery()),
+        table.insert().from_select(
+            ["scope", "key", "search_count", "updated_at"],
+            searches.where(~exists().where(stat.scope == "query", stat.key == query_key))
+        ),
+    ]
+
+# ================== PAGINACIÓN KEYSET ==================
+
+def encode_cursor(product: Product) -> str:
+    """Cursor opaco con la posición (popularity_score, id) del último producto"""
+    payload = json.dumps([product.popularity_score, product.id], separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[float, int]:
+    """Inverso de encode_cursor; ValueError si el cursor no es válido"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        score, last_id = json.loads(base64.urlsafe_b64decode(padded))
+        return float(score), int(last_id)
+    except Exception:
+        raise ValueError(f"Invalid cursor: {cursor}")
+
+# ================== BÚSQUEDA DE TEXTO ==================
+
+_SQLITE_SEARCH_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+        title, search_query,
+        content='products', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS products_fts_insert AFTER INSERT ON products BEGIN
+        INSERT INTO products_fts(rowid, title, search_query) VALUES (new.id, new.title, new.search_query);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS products_fts_delete AFTER DELETE ON products BEGIN
+        INSERT INTO products_fts(products_fts, rowid, title, search_query)
+        VALUES ('delete', old.id, old.title, old.search_query);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS products_fts_update AFTER UPDATE OF title, search_query ON products BEGIN
+        INSERT INTO products_fts(products_fts, rowid, title, search_query)
+        VALUES ('delete', old.id, old.title, old.search_query);
+        INSERT INTO products_fts(rowid, title, search_query) VALUES (new.id, new.title, new.search_query);
+    END""",
+]
+
+_POSTGRES_SEARCH_DDL = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    """ALTER TABLE products ADD COLUMN IF NOT EXISTS search_vector tsvector
+        GENERATED ALWAYS AS (
+            setweight(to_tsvector('simple', coalesce(title, '')), 'A') ||
+            setweight(to_tsvector('simple', coalesce(search_query, '')), 'B')
+        ) STORED""",
+    "CREATE INDEX IF NOT EXISTS ix_products_search_vector ON products USING GIN (search_vector)",
+    "CREATE INDEX IF NOT EXISTS ix_products_title_trgm ON products USING GIN (title gin_trgm_ops)",
+]
+
+# Tabla FTS5 (fuera de Base.metadata: la crea create_search_index)
+_products_fts = Table("products_fts", MetaData(), Column("rowid", Integer))
+
+_SEARCH_TOKEN = re.compile(r"\w+", re.UNICODE)
+
+
+def _search_tokens(query: str) -> List[str]:
+    """Palabras de la query sin operadores ni comillas (seguras para MATCH / to_tsquery)"""
+    return _SEARCH_TOKEN.findall(query.lower())
+
+
+def _popularity_boost(popularity):
+    """Popularidad saturada en [0, 1): multiplica la relevancia por hasta 2x"""
+    popularity = func.coalesce(popularity, 0)
+    return popularity / (popularity + 1000.0)
+
+
+def _text_search(stmt, query: str, dialect: str):
+    """
+    Aplica la búsqueda de texto a stmt
+
+    Returns:
+        Tupla (stmt filtrado, expresión de relevancia: mayor es mejor)
+    """
+    tokens = _search_tokens(query)
+
+    if dialect == "sqlite" and tokens:
+        # Todas las palabras, con coincidencia por prefijo: "wire"* "earb"*
+        match = " ".join(f'"{token}"*' for token in tokens)
+        stmt = stmt.join(_products_fts, _products_fts.c.rowid == Product.id).where(
+            literal_column("products_fts").match(match)
+        )
+        # bm25 es negativo (más negativo = más relevante); title pesa más que search_query
+        relevance = -func.bm25(literal_column("products_fts"), 10.0, 1.0)
+        return stmt, relevance
+
+    if dialect == "postgresql" and tokens:
+        search_vector = literal_column("products.search_vector")
+        tsquery = func.to_tsquery(
+            literal_column("'simple'::regconfig"),
+            " & ".join(f"{token}:*" for token in tokens)
+        )
+        stmt = stmt.where(or_(
+            search_vector.op("@@")(tsquery),
+            Product.title.ilike(f"%{query}%")  # Subcadenas, servido por el índice pg_trgm
+        ))
+        relevance = func.ts_rank_cd(search_vector, tsquery) + func.similarity(Product.title, query)
+        return stmt, relevance
+
+    # Otros motores: búsqueda por subcadena
+    stmt = stmt.where(or_(
+        Product.title.ilike(f"%{query}%"),
+        Product.search_query.ilike(f"%{query}%")
+    ))
+    return stmt, None
+
+
+def _record_price_changes(product_ids: List[int]):
+    """
+    INSERT ... SELECT del precio actual de los productos cuyo precio cambió
+
+    Compara products (ya actualizado por el upsert) con la última fila de
+    product_prices de cada producto; si coinciden no se escribe nada.
+    """
+    latest = aliased(ProductPrice)
+    previous = aliased(ProductPrice)
+
+    latest_id = (
+        select(latest.id)
+        .where(latest.product_id == Product.id)
+        .order_by(latest.recorded_at.desc(), latest.id.desc())
+        .limit(1)
+        .correlate(Product)
+        .scalar_subquery()
+    )
+    unchanged = exists().where(
+        previous.id == latest_id,
+        previous.price == Product.price,
+        previous.original_price.is_not_distinct_from(Product.original_price)
+    )
+
+    changed = select(
+        Product.id, Product.updated_at, Product.price,
+        Product.original_price, Product.discount_percentage
+    ).where(Product.id.in_(product_ids), ~unchanged)
+
+    return ProductPrice.__table__.insert().from_select(
+        ["product_id", "recorded_at", "price", "original_price", "discount_percentage"],
+        changed
+    )
+
 # ================== INSTANCIA GLOBAL ==================
 
 db = DatabaseManager()
@@ -328,7 +1315,7 @@ db = DatabaseManager()
 
 async def init_database():
     """Inicializa la base de datos"""
-    db.create_tables()
+    await db.create_tables()
     print("✅ Base de datos inicializada")
 
 async def test_database():
@@ -342,6 +1329,18 @@ async def test_database():
         print(f"❌ Error conectando a la base de datos: {e}")
         return False
 
+
+async def test_goods_id_upgrade(product_data: dict) -> bool:
+    """
+    Regresión: una URL guardada sin goods_id que vuelve con goods_id del
+    extractor actualiza la misma fila (antes fallaba con UNIQUE de product_url)
+    """
+    first = await db.save_product({**product_data, "goods_id": None})
+    second = await db.save_product({**product_data, "goods_id": 601099999999999})
+    ok = first.id == second.id and second.goods_id == 601099999999999
+    print(f"{'✅' if ok else '❌'} goods_id asignado a la fila existente ({first.id} -> {second.id})")
+    return ok
+
 # ================== MAIN (TESTING) ==================
 
 if __name__ == "__main__":
@@ -349,7 +1348,7 @@ if __name__ == "__main__":
 
     async def main():
         print("🔧 Inicializando base de datos...")
-        init_database()
+        await init_database()
 
         print("\n🧪 Probando conexión...")
         await test_database()
@@ -373,6 +1372,9 @@ if __name__ == "__main__":
         product = await db.save_product(test_product)
         print(f"✅ Producto guardado: {product.id} - {product.title}")
 
+        print("\n🔁 Producto sin goods_id que luego lo trae...")
+        await test_goods_id_upgrade({**test_product, "product_url": "https://www.temu.com/test-product-sin-id"})
+
         print("\n🔍 Buscando productos...")
         products = await db.search_products(query="earbuds", limit=10)
         print(f"✅ Encontrados {len(products)} productos")
@@ -0,0 +1,113 @@
+"""
+DB ENGINE
+Fábrica única de engines async a partir de config.py: pool configurado,
+pragmas de SQLite y métricas de espera y uso del pool
+"""
+
+import threading
+from collections import deque
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlalchemy.pool import StaticPool
+
+from config import (
+    DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE, DB_POOL_WAIT_SAMPLES,
+    SQLITE_MMAP_SIZE_MB, SQLITE_BUSY_TIMEOUT_MS
+)
+
+# ================== ENGINE ==================
+
+def build_engine(url: str) -> AsyncEngine:
+    """
+    Engine async para una URL (asyncpg o aiosqlite)
+
+    Aplica DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT y DB_POOL_RECYCLE;
+    en SQLite activa WAL, synchronous=NORMAL y mmap en cada conexión.
+    """
+    options = {"echo": False, "pool_pre_ping": True}
+
+    if _is_memory_sqlite(url):
+        # Una sola conexión compartida: cada conexión nueva sería otra base vacía
+        options["poolclass"] = StaticPool
+    else:
+        options.update(
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT,
+            pool_recycle=DB_POOL_RECYCLE
+        )
+
+    engine = create_async_engine(url, **options)
+
+    if engine.dialect.name == "sqlite":
+        event.listen(engine.sync_engine, "connect", _sqlite_pragmas)
+
+    return engine
+
+
+def _is_memory_sqlite(url: str) -> bool:
+    return url.startswith("sqlite") and (":memory:" in url or url.rstrip("/").endswith(":"))
+
+
+def _sqlite_pragmas(dbapi_connection, connection_record):
+    """WAL (lectores no bloquean al escritor), fsync solo en checkpoints y lecturas por mmap"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE_MB * 1024 * 1024}")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.close()
+
+# ================== MÉTRICAS ==================
+
+class PoolMetrics:
+    """Tiempo de espera para obtener conexión y ocupación del pool de un engine"""
+
+    def __init__(self, engine: AsyncEngine, samples: int = DB_POOL_WAIT_SAMPLES):
+        self.engine = engine
+        self._lock = threading.Lock()
+        self._waits = deque(maxlen=samples)
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds_total = 0.0
+
+    def observe(self, seconds: float):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_seconds_total += seconds
+            self._waits.append(seconds)
+
+    def observe_timeout(self):
+        with self._lock:
+            self.timeouts += 1
+
+    def snapshot(self) -> dict:
+        pool = self.engine.pool
+        size = pool.size() if hasattr(pool, "size") else 1
+        checked_out = pool.checkedout() if hasattr(pool, "checkedout") else 0
+        capacity = size + max(0, getattr(pool, "_max_overflow", 0))
+
+        with self._lock:
+            waits = sorted(self._waits)
+            return {
+                "dialect": self.engine.dialect.name,
+                "pool_class": type(pool).__name__,
+                "size": size,
+                "capacity": capacity,
+                "checked_out": checked_out,
+                "utilization": round(checked_out / capacity, 4) if capacity else 0.0,
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "wait_ms_avg": round(self.wait_seconds_total / self.checkouts * 1000, 2) if self.checkouts else 0.0,
+                "wait_ms_p50": _percentile_ms(waits, 0.50),
+                "wait_ms_p95": _percentile_ms(waits, 0.95),
+                "wait_ms_max": round(waits[-1] * 1000, 2) if waits else 0.0
+            }
+
+
+def _percentile_ms(ordered: list, fraction: float) -> float:
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return round(ordered[index] * 1000, 2)
@@ -0,0 +1,335 @@
+"""
+EXTRACTORES DETERMINISTAS
+Extracción de productos de Temu sin LLM, a partir del estado JSON embebido
+(window.rawData, JSON-LD) o de selectores CSS. Si no alcanza, el scraper
+recurre al LLM.
+"""
+
+import json
+import re
+import threading
+from typing import Any, List, Optional
+from urllib.parse import urljoin
+
+from crawl4ai.extraction_strategy import JsonCssExtractionStrategy
+
+TEMU_BASE_URL = "https://www.temu.com"
+
+# ================== ESTADO JSON EMBEBIDO ==================
+
+# Variables globales donde Temu serializa el estado inicial de la página
+STATE_PATTERNS = [
+    re.compile(r"window\.rawData\s*=\s*"),
+    re.compile(r"window\.__INITIAL_STATE__\s*=\s*"),
+    re.compile(r"window\.__INITIAL_PROPS__\s*=\s*"),
+]
+NEXT_DATA_PATTERN = re.compile(r'<script[^>]+id="__NEXT_DATA__"[^>]*>(.*?)</script>', re.S)
+LD_JSON_PATTERN = re.compile(r'<script[^>]+type="application/ld\+json"[^>]*>(.*?)</script>', re.S | re.I)
+
+_decoder = json.JSONDecoder()
+
+
+def find_embedded_states(html: str) -> List[Any]:
+    """Devuelve los objetos JSON de estado embebidos en el HTML"""
+    states = []
+
+    for pattern in STATE_PATTERNS:
+        for match in pattern.finditer(html):
+            try:
+                obj, _ = _decoder.raw_decode(html, match.end())
+                states.append(obj)
+            except ValueError:
+                continue
+
+    for match in NEXT_DATA_PATTERN.finditer(html):
+        try:
+            states.append(json.loads(match.group(1)))
+        except ValueError:
+            continue
+
+    return states
+
+
+def find_ld_json(html: str) -> List[dict]:
+    """Devuelve los bloques JSON-LD (schema.org) de la página"""
+    blocks = []
+    for match in LD_JSON_PATTERN.finditer(html):
+        try:
+            data = json.loads(match.group(1).strip())
+        except ValueError:
+            continue
+        if isinstance(data, list):
+            blocks.extend(d for d in data if isinstance(d, dict))
+        elif isinstance(data, dict):
+            blocks.extend(data.get("@graph", [data]))
+    return blocks
+
+# ================== NORMALIZACIÓN ==================
+
+ID_KEYS = ("goods_id", "goodsId", "goods_id_str")
+TITLE_KEYS = ("title", "goods_name", "goodsName", "name")
+PRICE_KEYS = ("price_str", "priceStr", "sale_price_str", "price", "sale_price", "salePrice")
+ORIGINAL_PRICE_KEYS = ("market_price_str", "marketPriceStr", "market_price", "marketPrice", "original_price")
+DISCOUNT_KEYS = ("discount", "discount_str", "discountStr", "discount_percentage")
+RATING_KEYS = ("goods_score", "goodsScore", "rating", "score", "star")
+REVIEWS_KEYS = ("comment_num", "commentNum", "review_num", "reviewNum", "comment_num_tips", "reviews_count")
+SALES_KEYS = ("sales_num", "salesNum", "sales_tip", "salesTip", "sold_quantity", "sales_count")
+IMAGE_KEYS = ("hd_thumb_url", "thumb_url", "thumbUrl", "image_url", "image", "img_url")
+URL_KEYS = ("link_url", "linkUrl", "seo_link_url", "goods_url", "product_url", "url")
+CATEGORY_KEYS = ("cat_name", "catName", "category", "category_name")
+# Sub-objetos donde Temu anida precios y valoraciones
+NESTED_KEYS = ("price_info", "priceInfo", "comment", "goods_comment", "sales_info", "salesInfo")
+
+_NUMBER = re.compile(r"(\d[\d,]*\.?\d*)\s*([kKmM]?)")
+
+
+def parse_number(value: Any) -> Optional[float]:
+    """Convierte '$12.99', '1.2K+ sold' o '-60%' en número"""
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, dict):
+        return None
+
+    match = _NUMBER.search(str(value))
+    if not match:
+        return None
+
+    number = float(match.group(1).replace(",", ""))
+    suffix = match.group(2).lower()
+    if suffix == "k":
+        number *= 1_000
+    elif suffix == "m":
+        number *= 1_000_000
+    return number
+
+
+def _lookup(data: dict, keys) -> Any:
+    """Primer valor no vacío entre las claves dadas (incluye sub-objetos)"""
+    for key in keys:
+        value = data.get(key)
+        if value not in (None, "", [], {}):
+            return value
+    for nested in NESTED_KEYS:
+        sub = data.get(nested)
+        if isinstance(sub, dict):
+            value = _lookup_flat(sub, keys)
+            if value is not None:
+                return value
+    return None
+
+
+def _lookup_flat(data: dict, keys) -> Any:
+    for key in keys:
+        value = data.get(key)
+        if value not in (None, "", [], {}):
+            return value
+    return None
+
+
+def _as_int(value: Any) -> Optional[int]:
+    number = parse_number(value)
+    return int(number) if number is not None else None
+
+
+def _as_text(value: Any) -> Optional[str]:
+    if isinstance(value, list):
+        value = value[0] if value else None
+    if isinstance(value, dict):
+        value = _lookup_flat(value, ("url", "name", "text"))
+    return str(value).strip() if value not in (None, "") else None
+
+
+def coerce_product(data: dict, base_url: str = TEMU_BASE_URL) -> dict:
+    """Normaliza un objeto de Temu (estado, JSON-LD o CSS) a los campos de TemuProduct"""
+    product_url = _as_text(_lookup(data, URL_KEYS))
+    image_url = _as_text(_lookup(data, IMAGE_KEYS))
+
+    discount = _as_int(_lookup(data, DISCOUNT_KEYS))
+
+    return {
+        "title": _as_text(_lookup(data, TITLE_KEYS)),
+        "price": parse_number(_lookup(data, PRICE_KEYS)),
+        "original_price": parse_number(_lookup(data, ORIGINAL_PRICE_KEYS)),
+        "discount_percentage": abs(discount) if discount is not None else None,
+        "rating": parse_number(_lookup(data, RATING_KEYS)),
+        "reviews_count": _as_int(_lookup(data, REVIEWS_KEYS)),
+        "sales_count": _as_int(_lookup(data, SALES_KEYS)),
+        "image_url": urljoin(base_url, image_url) if image_url else None,
+        "product_url": urljoin(base_url, product_url) if product_url else None,
+        "category": _as_text(_lookup(data, CATEGORY_KEYS)),
+        "goods_id": _as_text(_lookup_flat(data, ID_KEYS)),
+    }
+
+
+def _coerce_ld_product(data: dict, base_url: str) -> dict:
+    """Normaliza un Product de schema.org"""
+    offers = data.get("offers") or {}
+    if isinstance(offers, list):
+        offers = offers[0] if offers else {}
+    rating = data.get("aggregateRating") or {}
+
+    flat = {
+        "title": data.get("name"),
+        "price": offers.get("price") or offers.get("lowPrice"),
+        "original_price": offers.get("highPrice"),
+        "rating": rating.get("ratingValue"),
+        "reviews_count": rating.get("reviewCount") or rating.get("ratingCount"),
+        "image_url": data.get("image"),
+        "product_url": data.get("url") or offers.get("url"),
+        "category": data.get("category"),
+        "goods_id": data.get("sku") or data.get("productID"),
+    }
+    return coerce_product(flat, base_url)
+
+# ================== BÚSQUEDA DE PRODUCTOS EN EL ESTADO ==================
+
+MAX_WALK_DEPTH = 12
+
+
+def _looks_like_goods(data: dict) -> bool:
+    has_id = any(key in data for key in ID_KEYS)
+    has_title = any(isinstance(data.get(key), str) for key in TITLE_KEYS)
+    has_price = _lookup(data, PRICE_KEYS) is not None
+    return has_id and has_title and has_price
+
+
+def _walk_goods(node: Any, found: List[dict], seen: set, depth: int = 0):
+    if depth > MAX_WALK_DEPTH:
+        return
+
+    if isinstance(node, dict):
+        if _looks_like_goods(node):
+            goods_id = str(_lookup_flat(node, ID_KEYS))
+            if goods_id not in seen:
+                seen.add(goods_id)
+                found.append(node)
+            return
+        for value in node.values():
+            _walk_goods(value, found, seen, depth + 1)
+
+    elif isinstance(node, list):
+        for value in node:
+            _walk_goods(value, found, seen, depth + 1)
+
+
+def products_from_state(html: str, base_url: str = TEMU_BASE_URL) -> List[dict]:
+    """Productos encontrados en el estado JSON embebido"""
+    found, seen = [], set()
+    for state in find_embedded_states(html):
+        _walk_goods(state, found, seen)
+    return [coerce_product(item, base_url) for item in found]
+
+
+def products_from_ld_json(html: str, base_url: str = TEMU_BASE_URL) -> List[dict]:
+    """Productos declarados en JSON-LD (Product o ItemList de Products)"""
+    products = []
+    for block in find_ld_json(html):
+        kind = block.get("@type")
+        if kind == "Product":
+            products.append(_coerce_ld_product(block, base_url))
+        elif kind == "ItemList":
+            for element in block.get("itemListElement", []):
+                item = element.get("item", element) if isinstance(element, dict) else None
+                if isinstance(item, dict) and item.get("@type") == "Product":
+                    products.append(_coerce_ld_product(item, base_url))
+    return products
+
+# ================== SELECTORES CSS ==================
+
+# Temu ofusca sus clases, así que se usan atributos estables (enlaces -g-<id>.html)
+SEARCH_CSS_SCHEMA = {
+    "name": "Temu search results",
+    "baseSelector": "div[data-tooltip^='goodContainer'], div[data-uniqid]",
+    "fields": [
+        {"name": "title", "selector": "h2, h3, [data-type='title'], a[title]", "type": "text"},
+        {"name": "price", "selector": "[data-type='price']", "type": "text"},
+        {"name": "original_price", "selector": "[data-type='marketPrice'], del", "type": "text"},
+        {"name": "rating", "selector": "[aria-label*='star']", "type": "attribute", "attribute": "aria-label"},
+        {"name": "reviews_count", "selector": "[aria-label*='review']", "type": "attribute", "attribute": "aria-label"},
+        {"name": "sales_count", "selector": "[data-type='saleTips'], [aria-label*='sold']", "type": "text"},
+        {"name": "image_url", "selector": "img", "type": "attribute", "attribute": "src"},
+        {"name": "product_url", "selector": "a[href*='-g-']", "type": "attribute", "attribute": "href"},
+    ]
+}
+
+PRODUCT_CSS_SCHEMA = {
+    "name": "Temu product detail",
+    "baseSelector": "body",
+    "fields": [
+        {"name": "title", "selector": "h1", "type": "text"},
+        {"name": "price", "selector": "[data-type='price'], [aria-label^='$']", "type": "text"},
+        {"name": "original_price", "selector": "[data-type='marketPrice'], del", "type": "text"},
+        {"name": "rating", "selector": "[aria-label*='star']", "type": "attribute", "attribute": "aria-label"},
+        {"name": "reviews_count", "selector": "[aria-label*='review']", "type": "attribute", "attribute": "aria-label"},
+        {"name": "sales_count", "selector": "[aria-label*='sold']", "type": "attribute", "attribute": "aria-label"},
+        {"name": "image_url", "selector": "meta[property='og:image']", "type": "attribute", "attribute": "content"},
+        {"name": "category", "selector": "nav[aria-label*='readcrumb'] a:last-of-type", "type": "text"},
+    ]
+}
+
+_css_search = JsonCssExtractionStrategy(SEARCH_CSS_SCHEMA)
+_css_product = JsonCssExtractionStrategy(PRODUCT_CSS_SCHEMA)
+
+
+def products_from_css(html: str, url: str, page_type: str) -> List[dict]:
+    """Productos extraídos con selectores CSS"""
+    strategy = _css_search if page_type == "search" else _css_product
+    try:
+        items = strategy.extract(url, html)
+    except Exception as e:
+        print(f"⚠️  Error en extracción CSS: {e}")
+        return []
+
+    products = []
+    for item in items or []:
+        product = coerce_product(item)
+        if page_type == "product" and not product["product_url"]:
+            product["product_url"] = url
+        products.append(product)
+    return products
+
+# ================== TELEMETRÍA ==================
+
+class ExtractionTelemetry:
+    """Contadores de qué camino de extracción se usó por tipo de página"""
+
+    PATHS = ("json_state", "ld_json", "css", "llm", "failed")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counts = {}
+            self.duration_ms = {}
+
+    def record(self, page_type: str, path: str, duration_ms: float):
+        with self._lock:
+            by_path = self.counts.setdefault(page_type, dict.fromkeys(self.PATHS, 0))
+            by_path[path] = by_path.get(path, 0) + 1
+            self.duration_ms[(page_type, path)] = self.duration_ms.get((page_type, path), 0.0) + duration_ms
+
+    def snapshot(self) -> dict:
+        """Resumen con la tasa de uso del LLM por tipo de página"""
+        with self._lock:
+            summary = {}
+            for page_type, by_path in self.counts.items():
+                total = sum(by_path.values())
+                # Toda página que llegó al LLM cuenta, también las que fallaron allí
+                reached_llm = by_path.get("llm", 0) + by_path.get("failed", 0)
+                summary[page_type] = {
+                    "pages": total,
+                    "by_path": dict(by_path),
+                    "llm_hit_rate": round(reached_llm / total, 4) if total else 0.0,
+                    "avg_ms_by_path": {
+                        path: round(self.duration_ms[(page_type, path)] / count, 1)
+                        for path, count in by_path.items() if count
+                    }
+                }
+            return summary
+
+
+extraction_telemetry = ExtractionTelemetry()
@@ -38,8 +38,8 @@ async function handleSearch(e) {
     showLoading();
 
     try {
-        // Call API
-        const response = await fetch(`${API_URL}/api/search`, {
+        // Call API (streaming: products arrive as each page is extracted)
+        const response = await fetch(`${API_URL}/api/search/stream`, {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json'
@@ -51,15 +51,32 @@ async function handleSearch(e) {
             throw new Error(`HTTP error! status: ${response.status}`);
         }
 
-        const data = await response.json();
+        let shown = 0;
+        let result = null;
+
+        for await (const event of readEvents(response)) {
+            if (event.event === 'product') {
+                if (shown === 0) {
+                    hideLoading();
+                    results.innerHTML = '';
+                    noResults.classList.add('hidden');
+                }
+                results.appendChild(createProductCard(event.product));
+                shown++;
+            } else if (event.event === 'done') {
+                result = event.result;
+            } else if (event.event === 'error') {
+                throw new Error(event.error || 'Scraping failed');
+            }
+        }
 
         // Hide loading
         hideLoading();
 
-        // Display results
-        if (data.success && data.results.products && data.results.products.length > 0) {
-            displayResults(data.results);
-        } else {
+        // Display final stats
+        if (result && result.products && result.products.length > 0) {
+            displayStats(result, result.products);
+        } else if (shown === 0) {
             showNoResults();
         }
 
@@ -70,6 +87,28 @@ async function handleSearch(e) {
     }
 }
 
+// Read an NDJSON response as a sequence of events
+async function* readEvents(response) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+
+        buffer += decoder.decode(value, { stream: true });
+        const lines = buffer.split('\n');
+        buffer = lines.pop();
+
+        for (const line of lines) {
+            if (line.trim()) yield JSON.parse(line);
+        }
+    }
+
+    if (buffer.trim()) yield JSON.parse(buffer);
+}
+
 // Display Results
 function displayResults(data) {
     const products = data.products || [];
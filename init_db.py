@@ -21,7 +21,7 @@ async def main():
     try:
         # 1. Crear tablas
         print("📊 Creando tablas...")
-        init_database()
+        await init_database()
         print("✅ Tablas creadas exitosamente\n")
 
         # 2. Probar conexión
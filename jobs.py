@@ -0,0 +1,201 @@
+"""
+JOBS
+Cola de trabajos de scraping en proceso con un pool fijo de workers
+La API encola y devuelve un job_id al instante; el cliente consulta /api/jobs/{id}
+"""
+
+import asyncio
+import time
+import uuid
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from config import JOB_WORKERS, JOB_MAX_QUEUE, JOB_RESULT_TTL_SECONDS, JOB_MAX_RETAINED
+
+# Estados posibles de un job
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+
+
+class QueueFullError(Exception):
+    """La cola de jobs está llena (backpressure)"""
+
+
+class Job:
+    """Un trabajo de scraping encolado"""
+
+    def __init__(self, kind: str, params: dict):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.params = params
+        self.status = QUEUED
+        self.progress: dict = {}
+        self.result: Optional[dict] = None
+        self.error: Optional[str] = None
+        self.created_at = datetime.now()
+        self.started_at: Optional[datetime] = None
+        self.finished_at: Optional[datetime] = None
+        self._finished_monotonic: Optional[float] = None
+
+    @property
+    def done(self) -> bool:
+        return self.status in (COMPLETED, FAILED)
+
+    def update_progress(self, progress: dict):
+        """Callback para que el handler informe de su progreso"""
+        self.progress = dict(progress)
+
+    def to_dict(self, include_result: bool = True) -> dict:
+        data = {
+            "job_id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "progress": self.progress,
+            "params": self.params,
+            "error": self.error,
+            "created_at": self.created_at.isoformat(),
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None
+        }
+        if include_result:
+            data["result"] = self.result
+        return data
+
+
+Handler = Callable[[dict, Job], Awaitable[dict]]
+
+
+class JobManager:
+    """Cola + workers + almacén en memoria de jobs terminados (con TTL)"""
+
+    def __init__(
+        self,
+        workers: int = JOB_WORKERS,
+        max_queue: int = JOB_MAX_QUEUE,
+        result_ttl: int = JOB_RESULT_TTL_SECONDS,
+        max_retained: int = JOB_MAX_RETAINED
+    ):
+        self.workers = max(1, workers)
+        self.max_queue = max_queue
+        self.result_ttl = result_ttl
+        self.max_retained = max_retained
+
+        self._handlers: Dict[str, Handler] = {}
+        self._jobs: Dict[str, Job] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+
+    def register(self, kind: str, handler: Handler):
+        """Registra el handler async que ejecuta los jobs de un tipo"""
+        self._handlers[kind] = handler
+
+    async def start(self):
+        """Arranca los workers"""
+        if self._queue is not None:
+            return
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        print(f"✅ Job workers listos ({self.workers})")
+
+    async def stop(self):
+        """Detiene los workers; los jobs en curso se marcan como fallidos"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
+
+    def submit(self, kind: str, params: dict) -> Job:
+        """Encola un job y lo devuelve sin esperar a que se ejecute"""
+        if kind not in self._handlers:
+            raise ValueError(f"Unknown job kind: {kind}")
+        if self._queue is None:
+            raise RuntimeError("Job manager not started")
+
+        self._prune()
+        job = Job(kind, params)
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            raise QueueFullError(f"Job queue is full ({self.max_queue} jobs)")
+
+        self._jobs[job.id] = job
+        return job
+
+    def add_completed(self, kind: str, params: dict, result: dict) -> Job:
+        """Registra un job ya resuelto (p. ej. servido desde la caché de respuestas)"""
+        self._prune()
+        job = Job(kind, params)
+        job.status = COMPLETED
+        job.result = result
+        job.started_at = job.created_at
+        self._finish(job)
+        self._jobs[job.id] = job
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self._jobs.get(job_id)
+
+    def list(self, limit: int = 50) -> List[Job]:
+        """Jobs más recientes primero"""
+        self._prune()
+        jobs = sorted(self._jobs.values(), key=lambda j: j.created_at, reverse=True)
+        return jobs[:limit]
+
+    def stats(self) -> dict:
+        by_status = {QUEUED: 0, RUNNING: 0, COMPLETED: 0, FAILED: 0}
+        for job in self._jobs.values():
+            by_status[job.status] += 1
+        return {
+            "workers": self.workers,
+            "queue_size": self._queue.qsize() if self._queue else 0,
+            "max_queue": self.max_queue,
+            "jobs": by_status
+        }
+
+    # ---------- internos ----------
+
+    async def _worker(self, index: int):
+        while True:
+            job = await self._queue.get()
+            job.status = RUNNING
+            job.started_at = datetime.now()
+
+            try:
+                job.result = await self._handlers[job.kind](job.params, job)
+                job.status = COMPLETED
+            except asyncio.CancelledError:
+                job.status = FAILED
+                job.error = "Cancelled (server shutdown)"
+                self._finish(job)
+                raise
+            except Exception as e:
+                job.status = FAILED
+                job.error = str(e)
+
+            self._finish(job)
+            self._queue.task_done()
+
+    def _finish(self, job: Job):
+        job.finished_at = datetime.now()
+        job._finished_monotonic = time.monotonic()
+
+    def _prune(self):
+        """Elimina jobs terminados vencidos o que exceden el máximo retenido"""
+        now = time.monotonic()
+        finished = [job for job in self._jobs.values() if job.done]
+
+        for job in finished:
+            if now - job._finished_monotonic > self.result_ttl:
+                del self._jobs[job.id]
+
+        overflow = len(self._jobs) - self.max_retained
+        if overflow > 0:
+            finished = sorted((j for j in self._jobs.values() if j.done), key=lambda j: j._finished_monotonic)
+            for job in finished[:overflow]:
+                del self._jobs[job.id]
+
+
+job_manager = JobManager()
@@ -0,0 +1,298 @@
+"""
+LLM DISPATCH
+Punto único por el que pasan todas las llamadas de extracción al LLM.
+
+Antes de cada llamada se estiman los tokens del prompt y se espera turno en
+dos token buckets por proveedor (requests/minuto y tokens/minuto), así que
+bajo carga el trabajo se encola en lugar de chocar con los 429 del
+proveedor y desperdiciar el render del navegador. Tras la llamada se
+corrige la reserva con los tokens reales y se registran tokens, coste y
+latencia. Si aun así llega un rate limit, se frena a todo el proveedor y se
+reintenta la llamada.
+"""
+
+import asyncio
+import copy
+import json
+import re
+import time
+from collections import deque
+from typing import Dict, Optional, Tuple
+
+from config import (
+    LLM_PROVIDER, LLM_CHARS_PER_TOKEN, LLM_RPM_LIMIT, LLM_TPM_LIMIT, LLM_RATE_LIMITS, LLM_PRICING,
+    LLM_BURST_SECONDS, LLM_OUTPUT_TOKENS_ESTIMATE, LLM_MAX_RETRIES, LLM_RATE_LIMIT_BACKOFF_SECONDS
+)
+from throttle import TokenBucket
+from tracing import metrics, record
+
+# Tokens de la plantilla de prompt de crawl4ai (instrucciones fijas alrededor del contenido)
+PROMPT_OVERHEAD_TOKENS = 400
+
+# USD por millón de tokens (entrada, salida); LLM_PRICING los sobrescribe o amplía
+DEFAULT_PRICES = {
+    "openai/gpt-4o-mini": (0.15, 0.60),
+    "openai/gpt-4o": (2.50, 10.00),
+    "openai/gpt-4.1-mini": (0.40, 1.60),
+    "openai/gpt-4.1-nano": (0.10, 0.40),
+    "openai/gpt-4.1": (2.00, 8.00),
+}
+FREE_PROVIDERS = ("ollama/",)  # Modelos locales
+
+# Errores de rate limit del proveedor. crawl4ai reintenta los 429 por su cuenta y,
+# al agotar los reintentos, devuelve una lista y falla leyendo .usage
+RATE_LIMIT_PATTERN = re.compile(r"rate.?limit|\b429\b|too many requests|'list' object has no attribute 'usage'", re.I)
+
+LLM_CALL_SECONDS = metrics.histogram(
+    "temu_llm_call_duration_seconds", "Duración de las llamadas al LLM", labels=("provider",)
+)
+LLM_QUEUE_SECONDS = metrics.histogram(
+    "temu_llm_queue_seconds", "Espera por los límites RPM/TPM antes de llamar al LLM", labels=("provider",)
+)
+LLM_TOKENS = metrics.counter("temu_llm_tokens_total", "Tokens consumidos en el LLM", labels=("provider", "kind"))
+LLM_COST = metrics.counter("temu_llm_cost_usd_total", "Coste estimado del LLM (USD)", labels=("provider",))
+LLM_CALLS = metrics.counter("temu_llm_calls_total", "Llamadas al LLM por resultado", labels=("provider", "outcome"))
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimación rápida de tokens (caracteres / LLM_CHARS_PER_TOKEN)"""
+    return len(text or "") // LLM_CHARS_PER_TOKEN + 1
+
+
+def _provider_pairs(setting: str) -> Dict[str, Tuple[float, float]]:
+    """Parsea "proveedor=a:b,proveedor2=a:b" en {proveedor: (a, b)}"""
+    pairs = {}
+    for item in setting.split(","):
+        provider, _, values = item.strip().partition("=")
+        first, _, second = values.partition(":")
+        if provider and second:
+            pairs[provider] = (float(first), float(second))
+    return pairs
+
+
+RATE_LIMITS = _provider_pairs(LLM_RATE_LIMITS)
+PRICES = {**DEFAULT_PRICES, **_provider_pairs(LLM_PRICING)}
+
+
+def price_for(provider: str) -> Optional[Tuple[float, float]]:
+    """Precio (entrada, salida) por millón de tokens, o None si no se conoce"""
+    if provider.startswith(FREE_PROVIDERS):
+        return 0.0, 0.0
+    return PRICES.get(provider)
+
+
+def _rate_limited(blocks) -> bool:
+    for block in blocks or []:
+        if isinstance(block, dict) and block.get("error") and RATE_LIMIT_PATTERN.search(str(block.get("content"))):
+            return True
+    return False
+
+
+def _usage(strategy) -> Optional[Tuple[int, int]]:
+    """Tokens (prompt, completion) que reportó el proveedor en esta llamada"""
+    usages = getattr(strategy, "usages", None)
+    if not usages:
+        return None
+    return (
+        sum(getattr(usage, "prompt_tokens", 0) or 0 for usage in usages),
+        sum(getattr(usage, "completion_tokens", 0) or 0 for usage in usages)
+    )
+
+
+class ProviderLimiter:
+    """Buckets RPM/TPM y contadores de un proveedor (0 = sin límite)"""
+
+    def __init__(self, provider: str, rpm: float, tpm: float, burst_seconds: float = LLM_BURST_SECONDS):
+        self.provider = provider
+        self.rpm = rpm
+        self.tpm = tpm
+        # Ráfaga de burst_seconds de cupo: evita gastar el minuto entero de golpe
+        self.requests = TokenBucket(rpm / 60, max(1.0, rpm * burst_seconds / 60)) if rpm > 0 else None
+        self.tokens = TokenBucket(tpm / 60, max(1.0, tpm * burst_seconds / 60)) if tpm > 0 else None
+        self.expected_output = float(LLM_OUTPUT_TOKENS_ESTIMATE)  # Media móvil de tokens de salida
+
+        self.calls = 0
+        self.failed = 0
+        self.rate_limited = 0
+        self.retries = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.estimated_calls = 0  # Llamadas sin uso reportado (se contabiliza la estimación)
+        self.cost_usd = 0.0
+        self.queue_seconds = 0.0
+        self.call_seconds = 0.0
+        self.in_flight = 0
+        self.waiting = 0
+
+    async def acquire(self, tokens: int) -> float:
+        """Espera turno en ambos buckets; devuelve los segundos esperados"""
+        started = time.perf_counter()
+        self.waiting += 1
+        try:
+            if self.requests:
+                await self.requests.acquire(1)
+            if self.tokens:
+                await self.tokens.acquire(tokens)
+        finally:
+            self.waiting -= 1
+        return time.perf_counter() - started
+
+    def settle(self, reserved: int, used: int):
+        """Corrige la reserva de tokens con lo consumido de verdad"""
+        if self.tokens:
+            self.tokens.adjust(reserved - used)
+
+    def back_off(self, seconds: float):
+        """Tras un 429 nadie llama al proveedor durante seconds"""
+        for bucket in (self.requests, self.tokens):
+            if bucket:
+                bucket.pause(seconds)
+
+    def stats(self) -> dict:
+        price = price_for(self.provider)
+        return {
+            "rpm_limit": self.rpm,
+            "tpm_limit": self.tpm,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "calls": self.calls,
+            "failed": self.failed,
+            "rate_limited": self.rate_limited,
+            "retries": self.retries,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "estimated_calls": self.estimated_calls,
+            "expected_output_tokens": round(self.expected_output),
+            "cost_usd": round(self.cost_usd, 6),
+            "priced": price is not None,
+            "avg_call_ms": round(self.call_seconds / self.calls * 1000, 1) if self.calls else 0.0,
+            "avg_queue_ms": round(self.queue_seconds / self.calls * 1000, 1) if self.calls else 0.0
+        }
+
+
+class LLMDispatcher:
+    """Cola por proveedor con límites RPM/TPM y contabilidad de tokens, coste y latencia"""
+
+    def __init__(self, max_retries: int = LLM_MAX_RETRIES, backoff_seconds: float = LLM_RATE_LIMIT_BACKOFF_SECONDS):
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self._limiters: Dict[str, ProviderLimiter] = {}
+        self.recent = deque(maxlen=100)  # Últimas llamadas (para depurar costes y latencias)
+
+    def limiter(self, provider: str) -> ProviderLimiter:
+        limiter = self._limiters.get(provider)
+        if limiter is None:
+            rpm, tpm = RATE_LIMITS.get(provider, (LLM_RPM_LIMIT, LLM_TPM_LIMIT))
+            limiter = self._limiters[provider] = ProviderLimiter(provider, rpm, tpm)
+        return limiter
+
+    async def extract(self, extraction_strategy, url: str, content: str) -> Tuple[list, dict]:
+        """
+        Ejecuta extraction_strategy.run sobre content cuando el proveedor tiene cupo
+
+        Returns:
+            Tupla (bloques extraídos, uso de la llamada: tokens, coste y latencias)
+        """
+        provider = getattr(extraction_strategy, "provider", None) or LLM_PROVIDER
+        limiter = self.limiter(provider)
+        prompt_estimate = estimate_tokens(content) + self._prompt_overhead(extraction_strategy)
+
+        queued, attempts = 0.0, 0
+        while True:
+            reserved = prompt_estimate + round(limiter.expected_output)
+            waited = await limiter.acquire(reserved)
+            queued += waited
+            record("llm_queue", waited)
+            LLM_QUEUE_SECONDS.observe(waited, provider=provider)
+
+            blocks, usage, seconds = await self._call(extraction_strategy, url, content, limiter)
+            attempts += 1
+            prompt_tokens, completion_tokens = usage or (prompt_estimate, round(limiter.expected_output))
+            limiter.settle(reserved, prompt_tokens + completion_tokens)
+
+            if not _rate_limited(blocks):
+                break
+            limiter.rate_limited += 1
+            LLM_CALLS.inc(provider=provider, outcome="rate_limited")
+            if attempts > self.max_retries:
+                break
+
+            # Frena a todo el proveedor y vuelve a la cola (sin repetir el render de la página)
+            limiter.retries += 1
+            limiter.back_off(self.backoff_seconds * 2 ** (attempts - 1))
+            print(f"⏳ Rate limit de {provider}: reintentando extracción ({attempts}/{self.max_retries})")
+
+        failed = not blocks or all(isinstance(block, dict) and block.get("error") for block in blocks)
+        return blocks, self._account(limiter, usage, prompt_tokens, completion_tokens, seconds, queued, attempts, failed)
+
+    def stats(self) -> dict:
+        return {
+            "providers": {provider: limiter.stats() for provider, limiter in self._limiters.items()},
+            "recent_calls": list(self.recent)[-10:]
+        }
+
+    # ---------- internos ----------
+
+    def _prompt_overhead(self, extraction_strategy) -> int:
+        schema = getattr(extraction_strategy, "schema", None)
+        instruction = getattr(extraction_strategy, "instruction", None) or ""
+        return PROMPT_OVERHEAD_TOKENS + estimate_tokens(instruction) + (estimate_tokens(json.dumps(schema, indent=2)) if schema else 0)
+
+    async def _call(self, extraction_strategy, url: str, content: str, limiter: ProviderLimiter):
+        # Copia con contadores de uso propios: la estrategia se comparte entre los chunks en paralelo
+        strategy = copy.copy(extraction_strategy)
+        if hasattr(strategy, "usages"):
+            strategy.usages = []
+        if hasattr(strategy, "total_usage"):
+            strategy.total_usage = type(extraction_strategy.total_usage)()
+
+        limiter.in_flight += 1
+        started = time.perf_counter()
+        try:
+            blocks = await asyncio.to_thread(strategy.run, url, [content])
+        finally:
+            limiter.in_flight -= 1
+        seconds = time.perf_counter() - started
+        record("llm_call", seconds)
+        return blocks, _usage(strategy), seconds
+
+    def _account(self, limiter: ProviderLimiter, usage, prompt_tokens: int, completion_tokens: int,
+                 seconds: float, queued: float, attempts: int, failed: bool) -> dict:
+        provider = limiter.provider
+        price = price_for(provider)
+        cost = (prompt_tokens * price[0] + completion_tokens * price[1]) / 1_000_000 if price else 0.0
+
+        limiter.calls += 1
+        limiter.failed += failed
+        limiter.prompt_tokens += prompt_tokens
+        limiter.completion_tokens += completion_tokens
+        limiter.cost_usd += cost
+        limiter.call_seconds += seconds
+        limiter.queue_seconds += queued
+        if usage is None:
+            limiter.estimated_calls += 1
+        else:
+            limiter.expected_output = 0.8 * limiter.expected_output + 0.2 * completion_tokens
+
+        LLM_CALL_SECONDS.observe(seconds, provider=provider)
+        LLM_TOKENS.inc(prompt_tokens, provider=provider, kind="prompt")
+        LLM_TOKENS.inc(completion_tokens, provider=provider, kind="completion")
+        LLM_COST.inc(cost, provider=provider)
+        LLM_CALLS.inc(provider=provider, outcome="failed" if failed else "success")
+
+        call = {
+            "provider": provider,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "estimated": usage is None,
+            "cost_usd": round(cost, 6),
+            "call_ms": round(seconds * 1000, 1),
+            "queue_ms": round(queued * 1000, 1),
+            "attempts": attempts,
+            "failed": failed
+        }
+        self.recent.append(call)
+        return call
+
+
+llm_dispatcher = LLMDispatcher()
@@ -0,0 +1,334 @@
+"""
+PERSISTENCIA WRITE-BEHIND
+Los endpoints entregan los resultados a un buffer en memoria y un flusher en
+background los escribe en la base de datos por lotes (tamaño o tiempo):
+upsert masivo de productos + inserción de historial de búsquedas.
+"""
+
+import asyncio
+import json
+import time
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+from sqlalchemy.exc import DataError, IntegrityError
+
+from config import (
+    PERSIST_ENABLED, PERSIST_BATCH_SIZE, PERSIST_FLUSH_INTERVAL_SECONDS,
+    PERSIST_MAX_PENDING, PERSIST_MAX_RETRIES, PERSIST_RETRY_BACKOFF_SECONDS
+)
+from database import db
+
+# Errores de los datos (no de la conexión): reintentar el mismo lote no sirve
+DATA_ERRORS = (IntegrityError, DataError)
+# Los descartes por cola llena se resumen en un aviso cada tantos segundos
+DROP_LOG_INTERVAL_SECONDS = 10.0
+
+# Campos del modelo Product que vienen del scraper
+PRODUCT_FIELDS = (
+    "goods_id", "title", "price", "original_price", "discount_percentage", "rating", "reviews_count",
+    "sales_count", "image_url", "product_url", "affiliate_link", "category"
+)
+
+
+def product_row(product: dict, search_query: Optional[str] = None) -> Optional[dict]:
+    """Producto scrapeado -> fila de products (None si faltan campos obligatorios)"""
+    row = {field: product.get(field) for field in PRODUCT_FIELDS}
+    row["product_url"] = row["product_url"] or product.get("original_url")
+    if not row["product_url"] or not row["title"] or row["price"] is None:
+        return None
+    row["search_query"] = search_query
+    return row
+
+
+_EMPTY = object()
+
+
+class WriteBehindBuffer:
+    """
+    Cola acotada de resultados pendientes de guardar + flusher en background
+
+    Backpressure: si la cola está llena, submit descarta el resultado al
+    instante (queda contado en stats): el guardado nunca añade latencia a la
+    request que lo encola.
+
+    Un flush con error de datos (IntegrityError, DataError) se parte en
+    mitades hasta aislar la fila problemática: solo se pierde esa fila. Los
+    errores transitorios (conexión, pool) se reintentan con backoff y, si la
+    base de datos no vuelve, se descarta el lote entero con un solo aviso.
+    Productos y búsquedas se guardan por separado.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = PERSIST_ENABLED,
+        batch_size: int = PERSIST_BATCH_SIZE,
+        flush_interval: float = PERSIST_FLUSH_INTERVAL_SECONDS,
+        max_pending: int = PERSIST_MAX_PENDING,
+        max_retries: int = PERSIST_MAX_RETRIES,
+        retry_backoff: float = PERSIST_RETRY_BACKOFF_SECONDS
+    ):
+        self.enabled = enabled
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._getter: Optional[asyncio.Future] = None
+        self._closing = False
+
+        # Métricas
+        self.submitted = 0
+        self.dropped = 0
+        self.flushes = 0
+        self.flush_errors = 0
+        self.retries = 0
+        self.products_failed = 0  # Descartados tras reintentos y aislamiento
+        self.searches_failed = 0
+        self.products_written = 0
+        self.products_unchanged = 0  # Sin cambios (o repetidos en el lote): no se reescriben
+        self.searches_written = 0
+        self.last_flush_ms = 0.0
+        self.last_error: Optional[str] = None
+        self._unreported_drops = 0
+        self._drops_reported_at = 0.0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    async def start(self):
+        """Crea las tablas si faltan y arranca el flusher"""
+        if not self.enabled or self.running:
+            return
+
+        try:
+            await db.create_tables()
+        except Exception as e:
+            self.enabled = False
+            print(f"⚠️  Persistencia desactivada, base de datos no disponible: {e}")
+            return
+
+        self._closing = False
+        self._queue = asyncio.Queue(maxsize=self.max_pending)
+        self._task = asyncio.create_task(self._run())
+        print(f"✅ Persistencia write-behind lista (lotes de {self.batch_size}, cada {self.flush_interval}s)")
+
+    async def stop(self):
+        """Detiene el flusher escribiendo antes todo lo pendiente"""
+        if not self.running:
+            return
+
+        # Marca de fin detrás de lo pendiente: el flusher lo escribe todo y termina
+        self._closing = True
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+        self._queue = None
+        print("🛑 Persistencia write-behind detenida")
+
+    async def submit_search(self, results: dict, params: dict, execution_time: Optional[float] = None):
+        """Encola una búsqueda (exitosa o no): sus productos y su fila de historial"""
+        search_query = params.get("search_query")
+        products = [product_row(p, search_query) for p in results.get("products", [])]
+
+        history = {
+            "search_query": search_query,
+            "max_products": params.get("max_products"),
+            "min_rating": params.get("min_rating"),
+            "min_reviews": params.get("min_reviews"),
+            "min_sales": params.get("min_sales"),
+            "price_min": params.get("price_min"),
+            "price_max": params.get("price_max"),
+            "total_found": results.get("total_found", 0),
+            "total_filtered": results.get("total_after_filters", 0),
+            "execution_time": round(execution_time, 3) if execution_time is not None else None,
+            "success": bool(results.get("success")),
+            "error_message": results.get("error"),
+            "timing": json.dumps(results["timing"]) if results.get("timing") else None
+        }
+
+        await self._submit([p for p in products if p], [history])
+
+    async def submit_products(self, products: List[dict]):
+        """Encola productos sueltos (scrape individual o batch)"""
+        rows = [row for row in (product_row(p) for p in products) if row]
+        if rows:
+            await self._submit(rows, [])
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "running": self.running,
+            "pending": self._queue.qsize() if self._queue else 0,
+            "max_pending": self.max_pending,
+            "submitted": self.submitted,
+            "dropped": self.dropped,
+            "flushes": self.flushes,
+            "flush_errors": self.flush_errors,
+            "retries": self.retries,
+            "products_failed": self.products_failed,
+            "searches_failed": self.searches_failed,
+            "products_written": self.products_written,
+            "products_unchanged": self.products_unchanged,
+            "searches_written": self.searches_written,
+            "last_flush_ms": self.last_flush_ms,
+            "last_error": self.last_error
+        }
+
+    # ---------- internos ----------
+
+    async def _submit(self, products: List[dict], searches: List[dict]):
+        if not self.running or self._closing:
+            return
+
+        try:
+            self._queue.put_nowait((products, searches))
+            self.submitted += 1
+        except asyncio.QueueFull:
+            self.dropped += 1
+            self._unreported_drops += 1
+            self._report_drops()
+
+    def _report_drops(self):
+        """Un aviso por intervalo con los resultados descartados desde el anterior"""
+        now = time.monotonic()
+        if not self._unreported_drops or now - self._drops_reported_at < DROP_LOG_INTERVAL_SECONDS:
+            return
+        print(f"⚠️  Buffer de persistencia lleno ({self.max_pending}): {self._unreported_drops} resultado(s) descartado(s)")
+        self._unreported_drops = 0
+        self._drops_reported_at = now
+
+    async def _next(self, timeout: Optional[float] = None):
+        """
+        Siguiente elemento de la cola, o _EMPTY si vence el timeout
+
+        El get pendiente se conserva entre llamadas para no perder elementos
+        al vencer el timeout.
+        """
+        if self._getter is None:
+            self._getter = asyncio.ensure_future(self._queue.get())
+
+        done, _ = await asyncio.wait({self._getter}, timeout=timeout)
+        if not done:
+            return _EMPTY
+
+        item = self._getter.result()
+        self._getter = None
+        return item
+
+    async def _run(self):
+        """Agrupa resultados hasta batch_size productos o flush_interval segundos"""
+        stopping = False
+
+        while not stopping:
+            item = await self._next()
+            if item is None:
+                break
+
+            batch, count = [item], len(item[0])
+            deadline = time.monotonic() + self.flush_interval
+
+            while count < self.batch_size:
+                item = await self._next(timeout=max(0.0, deadline - time.monotonic()))
+                if item is _EMPTY:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+                count += len(item[0])
+
+            await self._flush(batch)
+
+    async def _flush(self, batch: list):
+        if not batch:
+            return
+
+        products = [product for item in batch for product in item[0]]
+        searches = [search for item in batch for search in item[1]]
+        started = time.perf_counter()
+
+        # Por separado: un producto inválido no cuesta las filas de historial
+        if products:
+            saved, failed = await self._save(db.save_products_batch, products, "productos")
+            self.products_written += len(saved)
+            self.products_unchanged += len(products) - len(saved) - failed
+            self.products_failed += failed
+        if searches:
+            saved, failed = await self._save(db.save_search_histories, searches, "búsquedas")
+            self.searches_written += len(saved)
+            self.searches_failed += failed
+
+        self._report_drops()
+        self.flushes += 1
+        self.last_flush_ms = round((time.perf_counter() - started) * 1000, 1)
+
+    async def _save(self, save: Callable[[list], Awaitable[list]], rows: list, kind: str) -> Tuple[list, int]:
+        """
+        Guarda rows reintentando con backoff los errores transitorios
+
+        Solo los errores de datos se aíslan fila a fila; si la base de datos
+        sigue caída tras los reintentos se descarta el lote entero de una vez
+        (partirlo solo multiplicaría los intentos contra la misma base caída).
+
+        Returns:
+            Tupla (lo que devolvió save, filas descartadas)
+        """
+        delay = self.retry_backoff
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await save(rows), 0
+            except DATA_ERRORS as e:
+                self._record_error(e)
+                break
+            except Exception as e:
+                self._record_error(e)
+                if attempt == self.max_retries:
+                    print(f"❌ {len(rows)} {kind} descartados tras {self.max_retries + 1} intentos: {self.last_error}")
+                    return [], len(rows)
+                self.retries += 1
+                await asyncio.sleep(delay)
+                delay *= 2
+
+        print(f"⚠️  Error de datos guardando {len(rows)} {kind}, aislando la fila problemática: {self.last_error}")
+        outcome = {"saved": [], "done": 0, "failed": 0}
+        try:
+            await self._isolate(save, rows, kind, outcome)
+        except Exception as e:
+            # La base de datos cayó a mitad del aislamiento: lo que queda se descarta junto
+            self._record_error(e)
+            pending = len(rows) - outcome["done"]
+            print(f"❌ {pending} {kind} descartados, la base de datos falló durante el aislamiento: {self.last_error}")
+            outcome["failed"] += pending
+        return outcome["saved"], outcome["failed"]
+
+    async def _isolate(self, save: Callable[[list], Awaitable[list]], rows: list, kind: str, outcome: dict):
+        """
+        Parte rows en mitades hasta que solo quedan fuera las filas que fallan solas
+
+        Solo se parte ante errores de datos; cualquier otro error se propaga.
+        """
+        if len(rows) == 1:
+            print(f"❌ Fila de {kind} descartada ({rows[0].get('product_url') or rows[0].get('search_query')}): {self.last_error}")
+            outcome["done"] += 1
+            outcome["failed"] += 1
+            return
+
+        middle = len(rows) // 2
+        for half in (rows[:middle], rows[middle:]):
+            try:
+                outcome["saved"].extend(await save(half))
+                outcome["done"] += len(half)
+            except DATA_ERRORS as e:
+                self._record_error(e)
+                await self._isolate(save, half, kind, outcome)
+
+    def _record_error(self, error: Exception):
+        self.flush_errors += 1
+        self.last_error = str(error)
+
+
+persistence = WriteBehindBuffer()
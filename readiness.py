@@ -0,0 +1,118 @@
+"""
+READINESS
+Detección adaptativa de página lista: se devuelve el HTML en cuanto el grid
+de productos (o el bloque de precio) está presente y estable, con un techo
+configurable, en lugar de esperar networkidle + 3 s fijos.
+"""
+
+import json
+import re
+import threading
+from collections import deque
+from typing import Optional
+
+from config import READINESS_MAX_WAIT_MS, READINESS_STABLE_MS, READINESS_SAMPLES
+
+# ================== CONDICIONES POR TIPO DE PÁGINA ==================
+
+# Selector que indica contenido útil y mínimo de elementos para considerarlo listo
+READY_SELECTORS = {
+    "search": ("a[href*='-g-']", 8),
+    "product": ("h1, [data-type='price'], [aria-label^='$']", 2),
+}
+
+_READY_JS = """js:() => {
+    const root = document.documentElement;
+    const now = performance.now();
+    const count = document.querySelectorAll(%(selector)s).length;
+    const state = window.__slReady || (window.__slReady = {count: -1, since: now});
+
+    const mark = (reason) => {
+        root.setAttribute('data-sl-ready-ms', Math.round(now));
+        root.setAttribute('data-sl-ready-reason', reason);
+        return true;
+    };
+
+    if (count !== state.count) {
+        state.count = count;
+        state.since = now;
+    } else if (count >= %(min_items)d && now - state.since >= %(stable_ms)d) {
+        return mark('stable');
+    }
+
+    // Techo: devolver lo que haya en lugar de fallar por timeout
+    if (now >= %(max_wait_ms)d) {
+        return mark('ceiling');
+    }
+    return false;
+}"""
+
+_READY_ATTRS = re.compile(r'data-sl-ready-ms="(\d+)"(?:[^>]*?data-sl-ready-reason="(\w+)")?')
+
+
+def wait_condition(page_type: str) -> str:
+    """Condición JS para CrawlerRunConfig.wait_for"""
+    selector, min_items = READY_SELECTORS[page_type]
+    return _READY_JS % {
+        "selector": json.dumps(selector),
+        "min_items": min_items,
+        "stable_ms": READINESS_STABLE_MS,
+        "max_wait_ms": READINESS_MAX_WAIT_MS
+    }
+
+
+def wait_timeout_ms() -> int:
+    """Timeout de crawl4ai para wait_for (con margen sobre el techo propio)"""
+    return READINESS_MAX_WAIT_MS + 5000
+
+# ================== ESTADÍSTICAS ==================
+
+class ReadinessStats:
+    """Tiempo hasta página lista observado por tipo de página"""
+
+    def __init__(self, samples: int = READINESS_SAMPLES):
+        self._lock = threading.Lock()
+        self._samples = {}
+        self._reasons = {}
+        self.max_samples = samples
+
+    def record_from_html(self, page_type: str, html: str) -> Optional[dict]:
+        """Lee las marcas que deja la condición JS en <html> y las registra"""
+        match = _READY_ATTRS.search((html or "")[:4096])
+        if not match:
+            return None
+
+        ready_ms = int(match.group(1))
+        reason = match.group(2) or "stable"
+
+        with self._lock:
+            self._samples.setdefault(page_type, deque(maxlen=self.max_samples)).append(ready_ms)
+            reasons = self._reasons.setdefault(page_type, {})
+            reasons[reason] = reasons.get(reason, 0) + 1
+
+        return {"ready_ms": ready_ms, "reason": reason}
+
+    def snapshot(self) -> dict:
+        """Percentiles del tiempo hasta listo, para ajustar los valores por defecto"""
+        with self._lock:
+            summary = {}
+            for page_type, samples in self._samples.items():
+                ordered = sorted(samples)
+                summary[page_type] = {
+                    "samples": len(ordered),
+                    "p50_ms": _percentile(ordered, 0.50),
+                    "p90_ms": _percentile(ordered, 0.90),
+                    "p99_ms": _percentile(ordered, 0.99),
+                    "max_ms": ordered[-1],
+                    "reasons": dict(self._reasons.get(page_type, {})),
+                    "max_wait_ms": READINESS_MAX_WAIT_MS
+                }
+            return summary
+
+
+def _percentile(ordered: list, fraction: float) -> int:
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+readiness_stats = ReadinessStats()
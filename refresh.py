@@ -0,0 +1,159 @@
+"""
+REFRESH SCHEDULER
+Re-scrape incremental de los productos guardados: una cola de prioridad por
+staleness esperada (probabilidad de que el producto haya cambiado desde el
+último scrape, según su volatilidad aprendida) dentro de un presupuesto
+global de páginas por hora. Los productos estables se visitan rara vez y las
+ofertas volátiles a menudo; si el scrape no cambia nada no se reescribe.
+"""
+
+import asyncio
+import heapq
+from datetime import datetime
+from typing import List, Optional
+
+from config import (
+    REFRESH_ENABLED, REFRESH_PAGES_PER_HOUR, REFRESH_BATCH_SIZE,
+    REFRESH_IDLE_SECONDS, REFRESH_MIN_INTERVAL_HOURS
+)
+from database import db
+from persistence import product_row
+from scraper import scrape_products_batch
+from throttle import TokenBucket
+
+
+class RefreshScheduler:
+    """Loop en background que re-scrapea los productos vencidos más desactualizados"""
+
+    def __init__(
+        self,
+        enabled: bool = REFRESH_ENABLED,
+        pages_per_hour: float = REFRESH_PAGES_PER_HOUR,
+        batch_size: int = REFRESH_BATCH_SIZE,
+        idle_seconds: float = REFRESH_IDLE_SECONDS
+    ):
+        self.enabled = enabled and pages_per_hour > 0
+        self.pages_per_hour = pages_per_hour
+        self.batch_size = max(1, batch_size)
+        self.idle_seconds = idle_seconds
+
+        self._budget = TokenBucket(rate=pages_per_hour / 3600, capacity=self.batch_size) if pages_per_hour > 0 else None
+        self._task: Optional[asyncio.Task] = None
+
+        # Métricas
+        self.runs = 0
+        self.pages = 0
+        self.changed = 0
+        self.unchanged = 0
+        self.failed = 0
+        self.last_run_at: Optional[datetime] = None
+        self.last_error: Optional[str] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    async def start(self):
+        """Arranca el loop de refresco (solo si REFRESH_ENABLED)"""
+        if not self.enabled or self.running:
+            return
+        self._task = asyncio.create_task(self._run())
+        print(f"✅ Refresco de productos activo ({self.pages_per_hour:g} páginas/hora)")
+
+    async def stop(self):
+        if not self.running:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        print("🛑 Refresco de productos detenido")
+
+    async def run_once(self, max_pages: Optional[int] = None) -> dict:
+        """
+        Re-scrapea ahora los productos vencidos con mayor staleness esperada
+
+        No consume el presupuesto por hora (lo usa el loop en background).
+        """
+        batch = await self._next_batch(max_pages or self.batch_size)
+        return await self._refresh(batch)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "running": self.running,
+            "pages_per_hour": self.pages_per_hour,
+            "batch_size": self.batch_size,
+            "runs": self.runs,
+            "pages_scraped": self.pages,
+            "changed": self.changed,
+            "unchanged": self.unchanged,
+            "failed": self.failed,
+            "unchanged_ratio": round(self.unchanged / (self.changed + self.unchanged), 4) if self.changed + self.unchanged else 0.0,
+            "last_run_at": self.last_run_at.isoformat() if self.last_run_at else None,
+            "last_error": self.last_error
+        }
+
+    # ---------- internos ----------
+
+    async def _next_batch(self, size: int) -> List[dict]:
+        """Los size productos vencidos con mayor staleness esperada"""
+        due = await db.get_refresh_queue(limit=size * 4)
+        return heapq.nlargest(size, due, key=lambda product: product["expected_staleness"])
+
+    async def _run(self):
+        while True:
+            try:
+                batch = await self._next_batch(self.batch_size)
+                if not batch:
+                    await asyncio.sleep(self.idle_seconds)
+                    continue
+
+                # Presupuesto global: espera hasta poder gastar len(batch) páginas
+                await self._budget.acquire(len(batch))
+                await self._refresh(batch)
+
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.last_error = str(e)
+                print(f"❌ Error en el refresco de productos: {e}")
+                await asyncio.sleep(self.idle_seconds)
+
+    async def _refresh(self, batch: List[dict]) -> dict:
+        if not batch:
+            return {"pages": 0, "changed": 0, "unchanged": 0, "failed": 0}
+
+        result = await scrape_products_batch([product["product_url"] for product in batch])
+
+        rows, failed = [], []
+        for candidate, item in zip(batch, result["results"]):
+            row = None
+            if item.get("success"):
+                # Se guarda bajo la URL almacenada aunque el extractor devuelva otra variante
+                row = product_row({**item["product"], "product_url": candidate["product_url"]})
+            if row:
+                rows.append(row)
+            else:
+                failed.append(candidate["id"])
+
+        saved = await db.save_products_batch(rows)
+        await db.defer_refresh(failed, hours=REFRESH_MIN_INTERVAL_HOURS)
+
+        summary = {
+            "pages": len(batch),
+            "changed": len(saved),
+            "unchanged": len(rows) - len(saved),
+            "failed": len(failed)
+        }
+
+        self.runs += 1
+        self.pages += summary["pages"]
+        self.changed += summary["changed"]
+        self.unchanged += summary["unchanged"]
+        self.failed += summary["failed"]
+        self.last_run_at = datetime.now()
+        print(f"🔄 Refresco: {summary['changed']} cambiados, {summary['unchanged']} sin cambios, {summary['failed']} fallidos")
+        return summary
+
+
+refresh_scheduler = RefreshScheduler()
@@ -0,0 +1,345 @@
+"""
+RESULT STORE
+Almacén de resultados de scraping: segmentos append-only de NDJSON comprimido
+(un frame gzip/zstd por resultado) y un índice SQLite con id, prefijo, fecha,
+tamaños, número de productos y posición en el segmento.
+
+Listar y paginar solo consulta el índice; leer un resultado descomprime solo
+su frame; borrar marca el resultado en el índice y compact() recupera espacio.
+"""
+
+import asyncio
+import gzip
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import uuid
+from datetime import datetime
+from typing import Optional
+
+from config import RESULTS_DIR, RESULT_STORE_COMPRESSION, RESULT_SEGMENT_MAX_MB
+
+try:
+    import zstandard
+except ImportError:  # zstd es opcional: sin él se usa gzip
+    zstandard = None
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    id TEXT PRIMARY KEY,
+    prefix TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    segment TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    codec TEXT NOT NULL,
+    raw_size INTEGER NOT NULL,
+    product_count INTEGER NOT NULL,
+    deleted INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS ix_results_created ON results (deleted, created_at);
+CREATE INDEX IF NOT EXISTS ix_results_prefix_created ON results (deleted, prefix, created_at);
+CREATE INDEX IF NOT EXISTS ix_results_segment ON results (segment);
+"""
+
+# ================== COMPRESIÓN ==================
+
+def _compress(payload: bytes, codec: str) -> bytes:
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=3).compress(payload)
+    return gzip.compress(payload, compresslevel=6)
+
+
+def _decompress(frame: bytes, codec: str) -> bytes:
+    if codec == "zstd":
+        return zstandard.ZstdDecompressor().decompress(frame)
+    return gzip.decompress(frame)
+
+
+def _product_count(data: dict) -> int:
+    """Productos de un resultado (búsqueda, producto individual o batch)"""
+    if isinstance(data.get("products"), list):
+        return len(data["products"])
+    if isinstance(data.get("results"), list):
+        return sum(1 for item in data["results"] if item.get("success"))
+    return 1 if data.get("product") else 0
+
+# ================== ALMACÉN ==================
+
+class ResultStore:
+    """Segmentos comprimidos + índice; las operaciones de disco van a un thread"""
+
+    def __init__(
+        self,
+        directory: str = RESULTS_DIR,
+        compression: str = RESULT_STORE_COMPRESSION,
+        segment_max_mb: int = RESULT_SEGMENT_MAX_MB
+    ):
+        self.directory = directory
+        self.segments_dir = os.path.join(directory, "segments")
+        self.codec = "zstd" if compression == "zstd" and zstandard is not None else "gzip"
+        self.segment_max_bytes = segment_max_mb * 1024 * 1024
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._segment: Optional[str] = None
+
+        if compression == "zstd" and zstandard is None:
+            print("⚠️  RESULT_STORE_COMPRESSION=zstd sin el paquete zstandard, usando gzip")
+
+    # ---------- API async ----------
+
+    async def save(self, data: dict, prefix: str = "search") -> str:
+        """Guarda un resultado y devuelve su id"""
+        return await asyncio.to_thread(self.save_sync, data, prefix)
+
+    async def load(self, result_id: str) -> dict:
+        """Carga un resultado (FileNotFoundError si no existe)"""
+        return await asyncio.to_thread(self.load_sync, result_id)
+
+    async def list(
+        self,
+        prefix: Optional[str] = None,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+        limit: int = 50,
+        offset: int = 0
+    ) -> dict:
+        """Página del índice, más recientes primero"""
+        return await asyncio.to_thread(self.list_sync, prefix, since, until, limit, offset)
+
+    async def delete(self, result_id: str) -> bool:
+        """Borra un resultado; False si no existía"""
+        return await asyncio.to_thread(self.delete_sync, result_id)
+
+    async def compact(self, min_dead_ratio: float = 0.5) -> dict:
+        """Reescribe los segmentos con al menos min_dead_ratio de bytes borrados"""
+        return await asyncio.to_thread(self.compact_sync, min_dead_ratio)
+
+    async def stats(self) -> dict:
+        return await asyncio.to_thread(self.stats_sync)
+
+    # ---------- implementación síncrona ----------
+
+    def save_sync(self, data: dict, prefix: str = "search") -> str:
+        created_at = datetime.now()
+        result_id = f"{prefix}_{created_at.strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}"
+        payload = json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n"
+        frame = _compress(payload, self.codec)
+
+        with self._lock:
+            conn = self._connection()
+            segment, offset = self._append(frame)
+            conn.execute(
+                "INSERT INTO results (id, prefix, created_at, segment, offset, length, codec, raw_size, product_count) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (result_id, prefix, created_at.isoformat(), segment, offset, len(frame),
+                 self.codec, len(payload), _product_count(data))
+            )
+            conn.commit()
+
+        return result_id
+
+    def load_sync(self, result_id: str) -> dict:
+        with self._lock:
+            row = self._connection().execute(
+                "SELECT segment, offset, length, codec FROM results WHERE id = ? AND deleted = 0",
+                (result_id,)
+            ).fetchone()
+
+        if row is None:
+            raise FileNotFoundError(f"Results not found: {result_id}")
+
+        segment, offset, length, codec = row
+        with open(os.path.join(self.segments_dir, segment), "rb") as f:
+            f.seek(offset)
+            frame = f.read(length)
+
+        return json.loads(_decompress(frame, codec))
+
+    def list_sync(
+        self,
+        prefix: Optional[str] = None,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+        limit: int = 50,
+        offset: int = 0
+    ) -> dict:
+        where, params = ["deleted = 0"], []
+        if prefix:
+            where.append("prefix = ?")
+            params.append(prefix)
+        if since:
+            where.append("created_at >= ?")
+            params.append(since.isoformat())
+        if until:
+            where.append("created_at < ?")
+            params.append(until.isoformat())
+        clause = " AND ".join(where)
+
+        with self._lock:
+            conn = self._connection()
+            total = conn.execute(f"SELECT COUNT(*) FROM results WHERE {clause}", params).fetchone()[0]
+            rows = conn.execute(
+                f"SELECT id, prefix, created_at, raw_size, length, product_count FROM results "
+                f"WHERE {clause} ORDER BY created_at DESC, id DESC LIMIT ? OFFSET ?",
+                params + [limit, offset]
+            ).fetchall()
+
+        return {
+            "total": total,
+            "results": [
+                {
+                    "id": result_id,
+                    "filename": result_id,
+                    "prefix": row_prefix,
+                    "created_at": created_at,
+                    "size_kb": round(raw_size / 1024, 2),
+                    "compressed_kb": round(length / 1024, 2),
+                    "products": product_count
+                }
+                for result_id, row_prefix, created_at, raw_size, length, product_count in rows
+            ]
+        }
+
+    def delete_sync(self, result_id: str) -> bool:
+        with self._lock:
+            conn = self._connection()
+            cursor = conn.execute("UPDATE results SET deleted = 1 WHERE id = ? AND deleted = 0", (result_id,))
+            conn.commit()
+            return cursor.rowcount > 0
+
+    def compact_sync(self, min_dead_ratio: float = 0.5) -> dict:
+        rewritten, reclaimed = 0, 0
+
+        with self._lock:
+            conn = self._connection()
+            segments = conn.execute(
+                "SELECT segment, SUM(length), SUM(CASE WHEN deleted = 1 THEN length ELSE 0 END) "
+                "FROM results GROUP BY segment"
+            ).fetchall()
+            active = self._active_segment()
+
+            for segment, total, dead in segments:
+                if segment == active or not total or dead / total < min_dead_ratio:
+                    continue
+
+                reclaimed += self._rewrite_segment(conn, segment)
+                rewritten += 1
+
+        return {"segments_rewritten": rewritten, "bytes_reclaimed": reclaimed}
+
+    def stats_sync(self) -> dict:
+        with self._lock:
+            conn = self._connection()
+            count, raw, compressed, products = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(raw_size), 0), COALESCE(SUM(length), 0), "
+                "COALESCE(SUM(product_count), 0) FROM results WHERE deleted = 0"
+            ).fetchone()
+            segments = conn.execute("SELECT COUNT(DISTINCT segment) FROM results").fetchone()[0]
+
+        return {
+            "results": count,
+            "products": products,
+            "segments": segments,
+            "codec": self.codec,
+            "raw_mb": round(raw / (1024 * 1024), 2),
+            "compressed_mb": round(compressed / (1024 * 1024), 2),
+            "compression_ratio": round(raw / compressed, 2) if compressed else 0.0
+        }
+
+    # ---------- internos (con self._lock) ----------
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(self.segments_dir, exist_ok=True)
+            self._conn = sqlite3.connect(os.path.join(self.directory, "index.db"), check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(_SCHEMA)
+            self._import_legacy()
+        return self._conn
+
+    def _active_segment(self) -> str:
+        """Segmento donde se escribe; se rota al superar segment_max_bytes"""
+        if self._segment is None:
+            segments = sorted(name for name in os.listdir(self.segments_dir) if name.startswith("segment-"))
+            self._segment = segments[-1] if segments else self._segment_name(1)
+
+        path = os.path.join(self.segments_dir, self._segment)
+        if os.path.exists(path) and os.path.getsize(path) >= self.segment_max_bytes:
+            self._segment = self._segment_name(int(self._segment.split("-")[1].split(".")[0]) + 1)
+        return self._segment
+
+    def _segment_name(self, number: int) -> str:
+        return f"segment-{number:06d}.ndjson.{'zst' if self.codec == 'zstd' else 'gz'}"
+
+    def _append(self, frame: bytes) -> tuple:
+        segment = self._active_segment()
+        with open(os.path.join(self.segments_dir, segment), "ab") as f:
+            offset = f.tell()
+            f.write(frame)
+        return segment, offset
+
+    def _rewrite_segment(self, conn: sqlite3.Connection, segment: str) -> int:
+        """Copia los frames vivos de un segmento a uno nuevo y elimina el viejo"""
+        path = os.path.join(self.segments_dir, segment)
+        size = os.path.getsize(path)
+        live = conn.execute(
+            "SELECT id, offset, length FROM results WHERE segment = ? AND deleted = 0 ORDER BY offset",
+            (segment,)
+        ).fetchall()
+
+        compacted = f"compacted-{uuid.uuid4().hex[:12]}.{segment.split('.', 1)[1]}"
+        new_path = os.path.join(self.segments_dir, compacted)
+        moves = []
+        with open(path, "rb") as src, open(new_path, "wb") as dst:
+            for result_id, offset, length in live:
+                src.seek(offset)
+                moves.append((compacted, dst.tell(), result_id))
+                dst.write(src.read(length))
+
+        conn.executemany("UPDATE results SET segment = ?, offset = ? WHERE id = ?", moves)
+        conn.execute("DELETE FROM results WHERE segment = ? AND deleted = 1", (segment,))
+        conn.commit()
+        os.remove(path)
+
+        if not live:
+            os.remove(new_path)
+        return size - (os.path.getsize(new_path) if live else 0)
+
+    def _import_legacy(self):
+        """Importa los .json sueltos de versiones anteriores (se mueven a legacy/)"""
+        legacy = [name for name in os.listdir(self.directory) if name.endswith(".json")]
+        if not legacy:
+            return
+
+        legacy_dir = os.path.join(self.directory, "legacy")
+        os.makedirs(legacy_dir, exist_ok=True)
+
+        for name in legacy:
+            path = os.path.join(self.directory, name)
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"⚠️  No se pudo importar {name}: {e}")
+                continue
+
+            payload = json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n"
+            frame = _compress(payload, self.codec)
+            segment, offset = self._append(frame)
+            created_at = datetime.fromtimestamp(os.stat(path).st_mtime).isoformat()
+            self._conn.execute(
+                "INSERT OR IGNORE INTO results (id, prefix, created_at, segment, offset, length, codec, raw_size, product_count) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (name, name.split("_")[0], created_at, segment, offset, len(frame),
+                 self.codec, len(payload), _product_count(data))
+            )
+            shutil.move(path, os.path.join(legacy_dir, name))
+
+        self._conn.commit()
+        print(f"📦 {len(legacy)} resultados JSON importados al almacén")
+
+
+result_store = ResultStore()
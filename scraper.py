@@ -4,13 +4,36 @@ Scraper avanzado para productos de Temu con generación de links de afiliado
 """
 
 import asyncio
+import copy
 import json
-from crawl4ai import AsyncWebCrawler, CrawlerRunConfig
+import math
+import re
+import time
+from crawl4ai import CrawlerRunConfig, CacheMode
 from crawl4ai.extraction_strategy import LLMExtractionStrategy
-from pydantic import BaseModel, Field
-from typing import List, Optional
+from pydantic import BaseModel, Field, ValidationError
+from typing import AsyncIterator, Callable, List, Optional
+from urllib.parse import urljoin
 import os
 
+from lxml import etree, html as lxml_html
+
+from browser_pool import browser_pool
+from config import (
+    EXTRACTION_FAST_PATH_ENABLED, EXTRACTION_MIN_VALID_RATIO,
+    LLM_PRUNING_ENABLED, LLM_TOKEN_BUDGET, LLM_CHUNK_TOKENS, LLM_CHARS_PER_TOKEN,
+    MAX_CONCURRENT_REQUESTS, REQUEST_DELAY_SECONDS, SEARCH_MAX_PAGES,
+    BATCH_MAX_CONCURRENCY, BATCH_PER_HOST_RPS, TEMU_AFFILIATE_ID
+)
+from extractors import products_from_state, products_from_ld_json, products_from_css, extraction_telemetry
+from cache import extraction_cache, make_cache_key
+from temu_url_parser import extract_product_id_from_url, canonical_goods_id, generate_affiliate_link
+from throttle import HostRateLimiter
+from singleflight import SingleFlight
+from readiness import wait_condition, wait_timeout_ms, readiness_stats
+from tracing import stage, record, SCRAPES
+from llm_dispatch import llm_dispatcher, estimate_tokens
+
 # ================== MODELOS DE DATOS ==================
 
 class TemuProduct(BaseModel):
@@ -33,104 +56,448 @@ class TemuSearchResults(BaseModel):
 
 # ================== CONFIGURACIÓN ==================
 
-# Tu ID de afiliado de Temu (cámbialo por el tuyo)
-TEMU_AFFILIATE_ID = "YOUR_AFFILIATE_ID"  # ← CAMBIAR ESTO
-
 # Modelo LLM a usar (opciones: "ollama/llama2", "openai/gpt-4o", "openai/gpt-4o-mini")
 LLM_PROVIDER = "openai/gpt-4o-mini"  # Más barato y rápido
 
-# ================== FUNCIONES PRINCIPALES ==================
+# Schema usado por tipo de página (forma parte de la clave de caché del LLM)
+SCHEMA_NAMES = {
+    "search": TemuSearchResults.__name__,
+    "product": TemuProduct.__name__
+}
+
+# ================== PREPROCESADO PARA EL LLM ==================
+
+# Elementos que nunca aportan datos de producto
+BOILERPLATE_TAGS = ("script", "style", "noscript", "svg", "iframe", "template", "link", "meta",
+                    "header", "footer", "nav", "form", "button", "input", "select")
+# Clases/ids/aria-labels de bloques accesorios (carruseles, recomendaciones, banners...)
+BOILERPLATE_PATTERN = re.compile(
+    r"recommend|carousel|swiper|banner|footer|header|cookie|popup|modal|toast|you-may-also|also-like|"
+    r"similar|sidebar|breadcrumb|login|coupon|download-app",
+    re.I
+)
+BLOCK_TAGS = {"div", "li", "p", "section", "article", "ul", "ol", "tr", "h1", "h2", "h3", "h4", "h5", "h6", "br"}
+PRODUCT_LINK_XPATH = "//a[contains(@href, '-g-')]"
+
+
+def _drop_boilerplate(doc, keep_links: int):
+    """Elimina tags y bloques accesorios que no contienen el grueso de productos"""
+    for element in doc.xpath("//" + " | //".join(BOILERPLATE_TAGS)):
+        element.drop_tree()
+
+    doomed = []
+    for element in doc.iter():
+        if not isinstance(element.tag, str):
+            continue
+        marker = " ".join(filter(None, (element.get("class"), element.get("id"), element.get("aria-label"))))
+        if marker and BOILERPLATE_PATTERN.search(marker):
+            # Nunca eliminar el contenedor que tiene la mayoría de los productos
+            if keep_links and len(element.xpath("." + PRODUCT_LINK_XPATH)) * 2 > keep_links:
+                continue
+            doomed.append(element)
+
+    for element in doomed:
+        if element.getparent() is not None:
+            element.drop_tree()
+
+
+def _product_region(doc, page_type: str):
+    """Elemento más profundo que contiene el grid de productos (o el detalle)"""
+    if page_type == "product":
+        for xpath in ("//main", "//*[@role='main']", "//h1/ancestor::*[self::div or self::section][3]"):
+            found = doc.xpath(xpath)
+            if found:
+                return found[0]
+        return doc
+
+    links = doc.xpath(PRODUCT_LINK_XPATH)
+    if not links:
+        return doc
+
+    counts = {}
+    for link in links:
+        for ancestor in link.iterancestors():
+            counts[ancestor] = counts.get(ancestor, 0) + 1
+
+    threshold = 0.8 * len(links)
+    for ancestor in links[0].iterancestors():
+        if counts.get(ancestor, 0) >= threshold:
+            return ancestor
+    return doc
+
+
+def _serialize(node, parts: list, base_url: str):
+    """Texto compacto estilo markdown conservando enlaces e imágenes"""
+    tag = node.tag if isinstance(node.tag, str) else ""
+    if not tag:
+        return
+
+    if tag == "img":
+        src = node.get("src") or node.get("data-src")
+        if src:
+            parts.append(f" ![{(node.get('alt') or '').strip()}]({urljoin(base_url, src)}) ")
+    elif tag == "a" and node.get("href"):
+        label = " ".join(node.text_content().split())
+        parts.append(f" [{label}]({urljoin(base_url, node.get('href'))}) ")
+        for img in node.iter("img"):
+            _serialize(img, parts, base_url)
+    else:
+        if node.text:
+            parts.append(node.text)
+        for child in node:
+            _serialize(child, parts, base_url)
+            parts.append(" ")
+            if child.tail:
+                parts.append(child.tail)
+        if tag in BLOCK_TAGS:
+            parts.append("\n")
 
-def generate_affiliate_link(product_url: str, affiliate_id: str = TEMU_AFFILIATE_ID) -> str:
+
+def _compact_text(node, base_url: str) -> str:
+    parts = []
+    _serialize(node, parts, base_url)
+    text = re.sub(r"[ \t\r\f\v]+", " ", "".join(parts))
+    return re.sub(r"\s*\n\s*", "\n", text).strip()
+
+
+def _chunk_cards(cards: List[str], budget: int, chunk_tokens: int) -> tuple:
     """
-    Genera link de afiliado de Temu
+    Agrupa tarjetas de producto en chunks de hasta chunk_tokens respetando el presupuesto total
+
+    Returns:
+        Tupla (chunks, tarjetas descartadas por presupuesto)
+    """
+    chunks, current, current_tokens, used = [], [], 0, 0
+
+    for index, card in enumerate(cards):
+        tokens = estimate_tokens(card)
+        if used + tokens > budget:
+            if current:
+                chunks.append("\n\n".join(current))
+            return chunks, len(cards) - index
+
+        if current and current_tokens + tokens > chunk_tokens:
+            chunks.append("\n\n".join(current))
+            current, current_tokens = [], 0
+
+        current.append(card)
+        current_tokens += tokens
+        used += tokens
+
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks, 0
 
-    Args:
-        product_url: URL original del producto
-        affiliate_id: Tu ID de afiliado
+
+def prepare_llm_input(html: str, markdown: str, url: str, page_type: str) -> dict:
+    """
+    Reduce la página a la región de productos y la divide en chunks para el LLM
 
     Returns:
-        URL con parámetros de afiliado
+        Dict con chunks y tokens estimados antes/después del recorte
     """
-    # Limpiar URL
-    if "?" in product_url:
-        base_url = product_url.split("?")[0]
+    tokens_before = estimate_tokens(markdown)
+    prepared = {
+        "chunks": [markdown[:LLM_TOKEN_BUDGET * LLM_CHARS_PER_TOKEN]],
+        "pruned": False,
+        "tokens_before": tokens_before,
+        "cards": 0,
+        "dropped_cards": 0
+    }
+
+    if not LLM_PRUNING_ENABLED or not html:
+        prepared["tokens_after"] = estimate_tokens(prepared["chunks"][0])
+        return prepared
+
+    try:
+        doc = lxml_html.fromstring(html)
+    except (etree.ParserError, ValueError):
+        prepared["tokens_after"] = estimate_tokens(prepared["chunks"][0])
+        return prepared
+
+    _drop_boilerplate(doc, len(doc.xpath(PRODUCT_LINK_XPATH)) if page_type == "search" else 0)
+    region = _product_region(doc, page_type)
+
+    # Cada hijo del grid con enlaces de producto es una tarjeta
+    cards = [child for child in region if isinstance(child.tag, str) and child.xpath("." + PRODUCT_LINK_XPATH)]
+    if page_type == "search" and len(cards) >= 2:
+        texts = [text for text in (_compact_text(card, url) for card in cards) if text]
     else:
-        base_url = product_url
+        texts = [_compact_text(region, url)]
 
-    # Agregar parámetros de afiliado
-    affiliate_params = f"?_x_ads_channel=affiliate&_x_ads_sub_channel={affiliate_id}"
+    texts = [text for text in texts if text]
+    if not texts:
+        prepared["tokens_after"] = estimate_tokens(prepared["chunks"][0])
+        return prepared
 
-    return base_url + affiliate_params
+    if len(texts) == 1:
+        chunks = [texts[0][:LLM_TOKEN_BUDGET * LLM_CHARS_PER_TOKEN]]
+        dropped = 0
+    else:
+        chunks, dropped = _chunk_cards(texts, LLM_TOKEN_BUDGET, LLM_CHUNK_TOKENS)
 
+    prepared.update({
+        "chunks": chunks,
+        "pruned": True,
+        "tokens_after": sum(estimate_tokens(chunk) for chunk in chunks),
+        "cards": len(texts),
+        "dropped_cards": dropped
+    })
+    return prepared
 
-async def scrape_temu_search(
-    search_query: str,
-    max_products: int = 20,
-    min_rating: float = 0.0,
-    min_reviews: int = 0,
-    min_sales: int = 0,
-    price_min: float = 0.0,
-    price_max: float = 999999.0
-) -> dict:
+# ================== EXTRACCIÓN ==================
+
+def _page_markdown(result) -> str:
+    """Markdown de la página tal como lo genera crawl4ai"""
+    markdown = result.markdown
+    return getattr(markdown, "raw_markdown", None) or str(markdown or "")
+
+
+def _validate_products(candidates: List[dict]) -> List[dict]:
+    """Devuelve solo los candidatos que validan contra TemuProduct"""
+    valid = []
+    for candidate in candidates:
+        try:
+            product = TemuProduct.model_validate(candidate)
+        except ValidationError:
+            continue
+
+        if not product.title or product.price <= 0:
+            continue
+        if product.rating is not None and not 0 <= product.rating <= 5:
+            continue
+
+        valid.append(candidate)
+    return valid
+
+
+def _products_from_blocks(blocks: list, page_type: str) -> List[dict]:
+    """Aplana los bloques devueltos por LLMExtractionStrategy"""
+    products = []
+    for block in blocks or []:
+        if not isinstance(block, dict) or block.get("error"):
+            continue
+        if isinstance(block.get("products"), list):
+            products.extend(p for p in block["products"] if isinstance(p, dict))
+        elif block.get("title"):
+            products.append({k: v for k, v in block.items() if k not in ("index", "error", "tags")})
+
+    if page_type == "product":
+        return products[:1]
+    return products
+
+
+def _fast_path_extract(html: str, url: str, page_type: str):
     """
-    Scrape de búsqueda en Temu con filtros
+    Intenta extraer productos sin LLM
 
-    Args:
-        search_query: Término de búsqueda
-        max_products: Máximo de productos a extraer
-        min_rating: Rating mínimo (0-5)
-        min_reviews: Mínimo de reviews
-        min_sales: Mínimo de ventas
-        price_min: Precio mínimo
-        price_max: Precio máximo
+    Returns:
+        Tupla (path, productos válidos, candidatos) o (None, [], n) si no alcanza
+    """
+    sources = (
+        ("json_state", lambda: products_from_state(html)),
+        ("ld_json", lambda: products_from_ld_json(html)),
+        ("css", lambda: products_from_css(html, url, page_type)),
+    )
+
+    best_candidates = 0
+    for path, extract in sources:
+        candidates = extract()
+        if not candidates:
+            continue
+
+        best_candidates = max(best_candidates, len(candidates))
+
+        if page_type == "product":
+            # Solo vale el producto de la URL, no los recomendados del estado o del JSON-LD
+            valid = _validate_products(_main_product(candidates, url, path))
+            if valid:
+                return path, valid, len(candidates)
+            continue
+
+        valid = _validate_products(candidates)
+        if page_type == "search" and valid and len(valid) >= EXTRACTION_MIN_VALID_RATIO * len(candidates):
+            return path, valid, len(candidates)
+
+    return None, [], best_candidates
+
+
+def _main_product(candidates: List[dict], url: str, path: str) -> List[dict]:
+    """
+    El candidato que es el producto de la URL (lista vacía si no se reconoce)
+
+    Si la URL trae goods_id solo vale un candidato con ese goods_id. El CSS de
+    producto lee la propia ficha (h1, precio...), no listados: su candidato es
+    el de la página aunque no traiga goods_id. Sin goods_id en la URL solo se
+    acepta un candidato único. Solo el elegido recibe la URL de la página
+    como product_url.
+    """
+    goods_id = extract_product_id_from_url(url)
+    if not goods_id:
+        # Sin goods_id no se distingue el principal de los recomendados
+        if path != "css" and len(candidates) > 1:
+            return []
+        main = candidates[0]
+    elif path == "css":
+        main = candidates[0]
+        main["goods_id"] = main.get("goods_id") or goods_id
+        if str(main["goods_id"]) != goods_id:
+            return []
+    else:
+        main = next((c for c in candidates if str(c.get("goods_id")) == goods_id), None)
+        if main is None:
+            return []
+
+    if not main.get("product_url"):
+        main["product_url"] = url
+    return [main]
+
+
+async def _llm_extract(extraction_strategy, url: str, content: str, page_type: str, instruction: str):
+    """
+    Ejecuta el LLM sobre un chunk, reutilizando resultados cacheados
+
+    La llamada pasa por llm_dispatcher: espera cupo RPM/TPM del proveedor en
+    lugar de fallar con rate limit.
 
     Returns:
-        Dict con productos filtrados y stats
+        Tupla (bloques extraídos, "hit" | "miss", milisegundos, uso de la llamada o None)
     """
+    start = time.perf_counter()
+    schema_name = SCHEMA_NAMES[page_type]
+    key = make_cache_key(content, schema_name, instruction, LLM_PROVIDER)
 
-    # URL de búsqueda en Temu
-    search_url = f"https://www.temu.com/search_result.html?search_key={search_query.replace(' ', '+')}"
+    with stage("llm_cache"):
+        blocks = await extraction_cache.get(key)
+    if blocks is not None:
+        return blocks, "hit", (time.perf_counter() - start) * 1000, None
 
-    print(f"🔍 Buscando: '{search_query}' en Temu...")
-    print(f"📊 Filtros: Rating>={min_rating}, Reviews>={min_reviews}, Ventas>={min_sales}")
-    print(f"💰 Precio: ${price_min} - ${price_max}")
+    blocks, usage = await llm_dispatcher.extract(extraction_strategy, url, content)
+    if _products_from_blocks(blocks, page_type):
+        await extraction_cache.set(key, blocks)
+    return blocks, "miss", (time.perf_counter() - start) * 1000, usage
+
+
+async def _llm_extract_chunks(extraction_strategy, url: str, chunks: List[str], page_type: str, instruction: str):
+    """
+    Extrae todos los chunks en paralelo y combina los productos
+
+    Returns:
+        Tupla (productos sin duplicados, estado de caché, telemetría de latencia, tokens y coste)
+    """
+    start = time.perf_counter()
+    results = await asyncio.gather(*[
+        _llm_extract(extraction_strategy, url, chunk, page_type, instruction) for chunk in chunks
+    ])
+
+    products, seen = [], set()
+    with stage("parse"):
+        for blocks, _, _, _ in results:
+            for product in _products_from_blocks(blocks, page_type):
+                key = product.get("product_url") or product.get("title")
+                if key in seen:
+                    continue
+                seen.add(key)
+                products.append(product)
+
+    statuses = {status for _, status, _, _ in results}
+    cache_status = statuses.pop() if len(statuses) == 1 else "partial"
+    usages = [usage for _, _, _, usage in results if usage]
+
+    return products[:1] if page_type == "product" else products, cache_status, {
+        "llm_ms": round((time.perf_counter() - start) * 1000, 1),
+        "llm_ms_sequential": round(sum(ms for _, _, ms, _ in results), 1),
+        "llm_queue_ms": round(max((usage["queue_ms"] for usage in usages), default=0.0), 1),
+        "llm_prompt_tokens": sum(usage["prompt_tokens"] for usage in usages),
+        "llm_completion_tokens": sum(usage["completion_tokens"] for usage in usages),
+        "llm_cost_usd": round(sum(usage["cost_usd"] for usage in usages), 6)
+    }
+
+
+async def extract_page_products(result, url: str, page_type: str, extraction_strategy, instruction: str) -> tuple:
+    """
+    Extrae productos de una página ya renderizada
+
+    Usa primero el camino determinista (estado JSON, JSON-LD, CSS) y solo
+    llama al LLM si faltan campos requeridos o no validan. Antes del LLM la
+    página se recorta a la región de productos y se divide en chunks que se
+    extraen en paralelo; los resultados se cachean por hash del contenido.
+
+    Returns:
+        Tupla (productos, telemetría de extracción de la página)
+    """
+    start = time.perf_counter()
+    path, products, candidates = (None, [], 0)
+    fallback_reason = "fast_path_disabled"
+    cache_status = None
+    llm_input = None
+
+    if EXTRACTION_FAST_PATH_ENABLED:
+        with stage("fast_path"):
+            path, products, candidates = _fast_path_extract(result.html or "", url, page_type)
+        if path is None:
+            fallback_reason = "no_candidates" if not candidates else "validation_failed"
+
+    if path is None:
+        with stage("llm_prepare"):
+            prepared = prepare_llm_input(result.html or "", _page_markdown(result), url, page_type)
+        products, cache_status, latency = await _llm_extract_chunks(
+            extraction_strategy, url, prepared.pop("chunks"), page_type, instruction
+        )
+        llm_input = {**prepared, **latency}
+        path = "llm" if products else "failed"
+    else:
+        fallback_reason = None
 
-    # Configuración del crawler
-    config = CrawlerRunConfig(
+    duration_ms = (time.perf_counter() - start) * 1000
+    extraction_telemetry.record(page_type, path, duration_ms)
+
+    return products, {
+        "path": path,
+        "page_type": page_type,
+        "fast_path_candidates": candidates,
+        "fallback_reason": fallback_reason,
+        "llm_cache": cache_status,
+        "llm_input": llm_input,
+        "duration_ms": round(duration_ms, 1)
+    }
+
+# ================== CRAWLER ==================
+
+def build_run_config(page_type: str) -> CrawlerRunConfig:
+    """
+    Configuración de crawl4ai por tipo de página
+
+    Browser, user agent y headers viven en el pool. En lugar de networkidle +
+    3 s fijos, se espera a que el grid de productos (o el bloque de precio)
+    esté presente y estable, con un techo de READINESS_MAX_WAIT_MS.
+    """
+    return CrawlerRunConfig(
         # Anti-bot protection
         magic=True,  # Activa múltiples features anti-bot
         simulate_user=True,  # Simula comportamiento humano
         override_navigator=True,  # Falsifica navigator properties
 
-        # Stealth mode
-        browser_type="chromium",
-        headless=True,
-
-        # Esperar a que cargue contenido dinámico
-        wait_until="networkidle",
-        delay_before_return_html=3.0,  # Esperar 3 segundos
-
-        # User agent real
-        user_agent="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36",
-
-        # Headers adicionales
-        headers={
-            "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8",
-            "Accept-Language": "en-US,en;q=0.5",
-            "Accept-Encoding": "gzip, deflate, br",
-            "DNT": "1",
-            "Connection": "keep-alive",
-            "Upgrade-Insecure-Requests": "1"
-        }
+        # Esperar a que el contenido dinámico esté listo (adaptativo)
+        wait_until="domcontentloaded",
+        wait_for=wait_condition(page_type),
+        wait_for_timeout=wait_timeout_ms(),
+        delay_before_return_html=0.1,
+
+        cache_mode=CacheMode.BYPASS
     )
 
-    # Estrategia de extracción con LLM
-    extraction_strategy = LLMExtractionStrategy(
-        provider=LLM_PROVIDER,
-        schema=TemuSearchResults.model_json_schema(),
-        extraction_type="schema",
-        instruction=f"""
+
+# ================== BÚSQUEDA ==================
+
+# Coalescing: búsquedas idénticas en curso y páginas de resultados en curso
+# Un único presupuesto por host para todos los batches (jobs, refresco...)
+host_rate_limiter = HostRateLimiter(BATCH_PER_HOST_RPS)
+
+search_flights = SingleFlight("search")
+page_flights = SingleFlight("search_page")
+
+SEARCH_INSTRUCTION = """
         Extrae información de TODOS los productos visibles en esta página de resultados de Temu.
 
         Para cada producto, extrae:
@@ -145,85 +512,415 @@ async def scrape_temu_search(
         - URL del producto (link completo)
         - Categoría del producto si está visible
 
-        Extrae hasta {max_products} productos.
         Si un campo no está disponible, usa null.
         Asegúrate de que los precios sean números decimales sin símbolos de moneda.
         """
-    )
 
-    # Ejecutar crawling
-    async with AsyncWebCrawler(config=config) as crawler:
-        print("🤖 Iniciando crawler con anti-bot protection...")
 
-        result = await crawler.arun(
-            url=search_url,
-            extraction_strategy=extraction_strategy,
-            bypass_cache=True
-        )
+def normalize_query(search_query: str) -> str:
+    """Query en minúsculas y con espacios colapsados (clave de coalescing)"""
+    return " ".join(search_query.lower().split())
 
-        if not result.success:
-            return {
-                "success": False,
-                "error": "Failed to scrape Temu",
-                "products": []
-            }
 
-        # Parsear resultados
-        try:
-            extracted_data = json.loads(result.extracted_content)
-            products = extracted_data.get("products", [])
+def search_page_url(search_query: str, page: int = 1) -> str:
+    """URL de una página de resultados de búsqueda en Temu"""
+    url = f"https://www.temu.com/search_result.html?search_key={search_query.replace(' ', '+')}"
+    return url if page == 1 else f"{url}&page={page}"
 
-            print(f"✅ Encontrados {len(products)} productos inicialmente")
 
-            # Aplicar filtros
-            filtered_products = []
-            for product in products:
-                # Filtro de rating
-                if product.get("rating") and product["rating"] < min_rating:
-                    continue
+def product_identity(product: dict) -> str:
+    """Identificador para deduplicar productos (goods_id canónico, URL o título)"""
+    goods_id = product.get("goods_id") or canonical_goods_id(product.get("product_url"))
+    return str(goods_id or product.get("product_url") or product.get("title"))
+
+
+def passes_filters(
+    product: dict,
+    min_rating: float = 0.0,
+    min_reviews: int = 0,
+    min_sales: int = 0,
+    price_min: float = 0.0,
+    price_max: float = 999999.0
+) -> bool:
+    """Aplica los filtros de rating, reviews, ventas y precio"""
+    # Filtro de rating
+    if product.get("rating") and product["rating"] < min_rating:
+        return False
+
+    # Filtro de reviews
+    if product.get("reviews_count") and product["reviews_count"] < min_reviews:
+        return False
+
+    # Filtro de ventas
+    if product.get("sales_count") and product["sales_count"] < min_sales:
+        return False
+
+    # Filtro de precio
+    price = product.get("price") or 0
+    if price < price_min or price > price_max:
+        return False
+
+    return True
 
-                # Filtro de reviews
-                if product.get("reviews_count") and product["reviews_count"] < min_reviews:
-                    continue
 
-                # Filtro de ventas
-                if product.get("sales_count") and product["sales_count"] < min_sales:
+def _collect_pages(pages: dict, filters: dict) -> tuple:
+    """
+    Recorre las páginas consecutivas ya extraídas (1, 2, ...) en orden
+
+    Returns:
+        Tupla (ids vistos, productos filtrados sin duplicados, páginas consecutivas)
+    """
+    seen, filtered = set(), []
+    page = 1
+    with stage("filtering"):
+        while page in pages:
+            for product in pages[page]:
+                identity = product_identity(product)
+                if identity in seen:
                     continue
+                seen.add(identity)
+                if passes_filters(product, **filters):
+                    filtered.append(product)
+            page += 1
+    return seen, filtered, page - 1
+
+
+def _record_readiness(page_type: str, html: str) -> Optional[dict]:
+    """Registra el tiempo hasta página lista (también como etapa page_ready, dentro de navigation)"""
+    readiness = readiness_stats.record_from_html(page_type, html)
+    if readiness:
+        record("page_ready", readiness["ready_ms"] / 1000)
+    return readiness
+
+
+async def _scrape_search_page(search_query: str, page: int) -> tuple:
+    """
+    Renderiza y extrae una página de resultados
+
+    Returns:
+        Tupla (success, productos, telemetría de extracción)
+    """
+    url = search_page_url(search_query, page)
+
+    config = build_run_config("search")
+
+    # Estrategia de extracción con LLM
+    extraction_strategy = LLMExtractionStrategy(
+        provider=LLM_PROVIDER,
+        schema=TemuSearchResults.model_json_schema(),
+        extraction_type="schema",
+        instruction=SEARCH_INSTRUCTION
+    )
+
+    # Ejecutar crawling con un navegador del pool (se libera antes de extraer)
+    async with browser_pool.lease() as crawler:
+        print(f"🤖 Página {page}: iniciando crawler con anti-bot protection...")
+        with stage("navigation"):
+            result = await crawler.arun(url=url, config=config)
+
+    if not result.success:
+        return False, [], {"path": "failed", "error": result.error_message or "Failed to scrape Temu"}
 
-                # Filtro de precio
-                price = product.get("price", 0)
-                if price < price_min or price > price_max:
+    readiness = _record_readiness("search", result.html)
+    products, extraction = await extract_page_products(
+        result, url, "search", extraction_strategy, SEARCH_INSTRUCTION
+    )
+    extraction["readiness"] = readiness
+    return True, products, extraction
+
+
+# ================== FUNCIONES PRINCIPALES ==================
+
+async def scrape_temu_search(
+    search_query: str,
+    max_products: int = 20,
+    min_rating: float = 0.0,
+    min_reviews: int = 0,
+    min_sales: int = 0,
+    price_min: float = 0.0,
+    price_max: float = 999999.0,
+    progress_callback: Optional[Callable[[dict], None]] = None
+) -> dict:
+    """
+    Scrape de búsqueda en Temu con filtros
+
+    Recorre páginas de resultados en paralelo (hasta MAX_CONCURRENT_REQUESTS,
+    escalonadas REQUEST_DELAY_SECONDS) y se detiene en cuanto hay max_products
+    productos que pasan los filtros.
+
+    Args:
+        search_query: Término de búsqueda
+        max_products: Máximo de productos a extraer
+        min_rating: Rating mínimo (0-5)
+        min_reviews: Mínimo de reviews
+        min_sales: Mínimo de ventas
+        price_min: Precio mínimo
+        price_max: Precio máximo
+        progress_callback: Se llama tras cada página con el progreso acumulado
+
+    Búsquedas idénticas concurrentes (query normalizada + mismos filtros)
+    comparten un único scrape; las que solo difieren en filtros comparten la
+    extracción de cada página y aplican sus propios filtros.
+
+    Returns:
+        Dict con productos filtrados y stats
+    """
+    search_query = normalize_query(search_query)
+    params = {
+        "search_query": search_query,
+        "max_products": max_products,
+        "min_rating": min_rating,
+        "min_reviews": min_reviews,
+        "min_sales": min_sales,
+        "price_min": price_min,
+        "price_max": price_max
+    }
+    key = tuple(sorted(params.items()))
+
+    def on_event(event: dict):
+        # Todos los que esperan la búsqueda (no solo quien la inició) ven el progreso por página
+        if event["event"] == "progress" and progress_callback:
+            progress = {k: v for k, v in event.items() if k != "event"}
+            if shared:
+                progress["coalesced"] = True
+            progress_callback(progress)
+
+    shared = key in search_flights
+    results, _ = await search_flights.do(key, lambda: _search(key, params), listener=on_event)
+
+    # Copia propia para cada llamador (la API añade metadata al resultado)
+    results = copy.deepcopy(results)
+    results["coalesced"] = shared
+    return results
+
+
+async def coalesced_search_events(
+    search_query: str,
+    max_products: int = 20,
+    min_rating: float = 0.0,
+    min_reviews: int = 0,
+    min_sales: int = 0,
+    price_min: float = 0.0,
+    price_max: float = 999999.0
+) -> AsyncIterator[dict]:
+    """
+    Eventos de search_events compartiendo el scrape con búsquedas idénticas en curso
+
+    Mismo single-flight que scrape_temu_search: un stream que llega tarde
+    recibe primero los eventos ya emitidos y después los siguientes. Si
+    todos los interesados se van, el scrape se cancela.
+    """
+    params = {
+        "search_query": normalize_query(search_query),
+        "max_products": max_products,
+        "min_rating": min_rating,
+        "min_reviews": min_reviews,
+        "min_sales": min_sales,
+        "price_min": price_min,
+        "price_max": price_max
+    }
+    key = tuple(sorted(params.items()))
+    events = asyncio.Queue()
+    flight = asyncio.create_task(search_flights.do(key, lambda: _search(key, params), listener=events.put_nowait))
+
+    try:
+        while True:
+            if events.empty() and flight.done():
+                flight.result()  # Propaga el error del scrape si terminó sin evento done
+                return
+
+            getter = asyncio.ensure_future(events.get())
+            await asyncio.wait({getter, flight}, return_when=asyncio.FIRST_COMPLETED)
+            if not getter.done():
+                getter.cancel()
+                continue
+
+            event = getter.result()
+            if event["event"] == "done":
+                # Copia propia: el resultado se comparte con los demás interesados
+                yield {"event": "done", "result": copy.deepcopy(event["result"])}
+                return
+            yield event
+
+    finally:
+        flight.cancel()
+        await asyncio.gather(flight, return_exceptions=True)
+
+
+async def _search(key: tuple, params: dict) -> dict:
+    """Búsqueda paginada que publica sus eventos en el vuelo key (ver scrape_temu_search)"""
+    results = None
+    async for event in search_events(**params):
+        search_flights.publish(key, event)
+        if event["event"] == "done":
+            results = event["result"]
+    return results
+
+
+async def search_events(
+    search_query: str,
+    max_products: int = 20,
+    min_rating: float = 0.0,
+    min_reviews: int = 0,
+    min_sales: int = 0,
+    price_min: float = 0.0,
+    price_max: float = 999999.0
+) -> AsyncIterator[dict]:
+    """
+    Búsqueda paginada como flujo de eventos
+
+    Emite, en orden:
+        {"event": "progress", ...}  tras cada página extraída
+        {"event": "product", "index": n, "product": {...}}  cada producto filtrado
+            en cuanto su página (y todas las anteriores) están extraídas
+        {"event": "done", "result": {...}}  mismo dict que scrape_temu_search
+
+    Si el consumidor deja de iterar, se cancelan las páginas en vuelo.
+    """
+    search_query = normalize_query(search_query)
+
+    print(f"🔍 Buscando: '{search_query}' en Temu...")
+    print(f"📊 Filtros: Rating>={min_rating}, Reviews>={min_reviews}, Ventas>={min_sales}")
+    print(f"💰 Precio: ${price_min} - ${price_max}")
+
+    filters = {
+        "min_rating": min_rating,
+        "min_reviews": min_reviews,
+        "min_sales": min_sales,
+        "price_min": price_min,
+        "price_max": price_max
+    }
+
+    pages = {}  # página -> productos extraídos
+    extractions = []
+    emitted = []  # Productos ya emitidos (copias con link de afiliado)
+    failed_page = None
+    exhausted = False
+    next_page = 1
+    pending = {}
+
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    start_lock = asyncio.Lock()
+    next_start = time.monotonic()
+
+    async def fetch(page: int):
+        nonlocal next_start
+        async with semaphore:
+            # Escalonar el arranque de las páginas REQUEST_DELAY_SECONDS entre sí
+            async with start_lock:
+                wait = next_start - time.monotonic()
+                next_start = max(next_start, time.monotonic()) + REQUEST_DELAY_SECONDS
+            if wait > 0:
+                await asyncio.sleep(wait)
+            result, _ = await page_flights.do(
+                (search_query, page), lambda: _scrape_search_page(search_query, page)
+            )
+            return result
+
+    def new_products(filtered: list) -> List[dict]:
+        """Eventos de los productos filtrados aún no emitidos (copias con link de afiliado)"""
+        fresh = []
+        # Copias: las páginas extraídas pueden estar compartidas con otras búsquedas
+        for product in filtered[len(emitted):max_products]:
+            product = dict(product)
+            if product.get("product_url"):
+                product["affiliate_link"] = generate_affiliate_link(product["product_url"], TEMU_AFFILIATE_ID)
+            fresh.append({"event": "product", "index": len(emitted), "product": product})
+            emitted.append(product)
+        return fresh
+
+    try:
+        while True:
+            seen, filtered, complete_pages = _collect_pages(pages, filters)
+            if len(filtered) >= max_products:
+                break
+
+            # Páginas en vuelo según el rendimiento observado (productos filtrados por página)
+            if not exhausted and failed_page is None:
+                deficit = max_products - len(filtered)
+                per_page = len(filtered) / complete_pages if complete_pages else 0
+                wanted = math.ceil(deficit / per_page) if per_page else MAX_CONCURRENT_REQUESTS
+                wanted = min(wanted, MAX_CONCURRENT_REQUESTS)
+                if not pages and not pending:
+                    wanted = 1  # La primera página sola: suele bastar
+
+                while len(pending) < wanted and next_page <= SEARCH_MAX_PAGES:
+                    pending[asyncio.create_task(fetch(next_page))] = next_page
+                    next_page += 1
+
+            if not pending:
+                break
+
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                page = pending.pop(task)
+                success, products, extraction = task.result()
+                extractions.append({"page": page, **extraction})
+
+                if not success:
+                    failed_page = page if failed_page is None else min(failed_page, page)
                     continue
 
-                # Generar link de afiliado
-                if product.get("product_url"):
-                    product["affiliate_link"] = generate_affiliate_link(product["product_url"])
-
-                filtered_products.append(product)
-
-            print(f"🎯 {len(filtered_products)} productos después de filtros")
-
-            return {
-                "success": True,
-                "search_query": search_query,
-                "total_found": len(products),
-                "total_after_filters": len(filtered_products),
-                "filters_applied": {
-                    "min_rating": min_rating,
-                    "min_reviews": min_reviews,
-                    "min_sales": min_sales,
-                    "price_range": f"${price_min} - ${price_max}"
-                },
-                "products": filtered_products
+                pages[page] = products
+                if not products:
+                    exhausted = True  # No hay más resultados
+
+            seen, filtered, complete_pages = _collect_pages(pages, filters)
+            yield {
+                "event": "progress",
+                "pages_done": len(extractions),
+                "products_found": len(seen),
+                "products_filtered": min(len(filtered), max_products),
+                "target": max_products
             }
-
-        except json.JSONDecodeError as e:
-            print(f"❌ Error parseando JSON: {e}")
-            return {
+            for event in new_products(filtered):
+                yield event
+
+    finally:
+        # Parada temprana: no se renderizan ni extraen más páginas
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    if 1 not in pages:
+        SCRAPES.inc(kind="search", outcome="failed")
+        yield {
+            "event": "done",
+            "result": {
                 "success": False,
-                "error": f"JSON parse error: {str(e)}",
+                "error": "Failed to scrape Temu",
                 "products": []
             }
+        }
+        return
+
+    seen, filtered, complete_pages = _collect_pages(pages, filters)
+    for event in new_products(filtered):
+        yield event
+
+    print(f"✅ Encontrados {len(seen)} productos en {complete_pages} página(s)")
+    print(f"🎯 {len(emitted)} productos después de filtros")
+    SCRAPES.inc(kind="search", outcome="success" if emitted else "empty")
+
+    yield {
+        "event": "done",
+        "result": {
+            "success": True,
+            "search_query": search_query,
+            "total_found": len(seen),
+            "total_after_filters": len(emitted),
+            "pages_fetched": len(extractions),
+            "filters_applied": {
+                "min_rating": min_rating,
+                "min_reviews": min_reviews,
+                "min_sales": min_sales,
+                "price_range": f"${price_min} - ${price_max}"
+            },
+            "extraction": sorted(extractions, key=lambda e: e["page"]),
+            "products": emitted
+        }
+    }
 
 
 async def scrape_single_product(product_url: str) -> dict:
@@ -239,23 +936,8 @@ async def scrape_single_product(product_url: str) -> dict:
 
     print(f"🔍 Scrapeando producto: {product_url}")
 
-    # Configuración del crawler (similar a arriba)
-    config = CrawlerRunConfig(
-        magic=True,
-        simulate_user=True,
-        override_navigator=True,
-        browser_type="chromium",
-        headless=True,
-        wait_until="networkidle",
-        delay_before_return_html=3.0,
-    )
-
     # Estrategia de extracción
-    extraction_strategy = LLMExtractionStrategy(
-        provider=LLM_PROVIDER,
-        schema=TemuProduct.model_json_schema(),
-        extraction_type="schema",
-        instruction="""
+    instruction = """
         Extrae toda la información disponible de este producto de Temu:
         - Título completo
         - Precio actual
@@ -268,32 +950,110 @@ async def scrape_single_product(product_url: str) -> dict:
         - Categoría
         - Todas las especificaciones técnicas disponibles
         """
+    extraction_strategy = LLMExtractionStrategy(
+        provider=LLM_PROVIDER,
+        schema=TemuProduct.model_json_schema(),
+        extraction_type="schema",
+        instruction=instruction
     )
 
-    async with AsyncWebCrawler(config=config) as crawler:
-        result = await crawler.arun(
-            url=product_url,
-            extraction_strategy=extraction_strategy,
-            bypass_cache=True
-        )
+    config = build_run_config("product")
 
-        if not result.success:
-            return {"success": False, "error": "Failed to scrape product"}
+    async with browser_pool.lease() as crawler:
+        with stage("navigation"):
+            result = await crawler.arun(url=product_url, config=config)
 
-        try:
-            product_data = json.loads(result.extracted_content)
+    if not result.success:
+        SCRAPES.inc(kind="product", outcome="failed")
+        return {"success": False, "error": "Failed to scrape product"}
 
-            # Agregar link de afiliado
-            product_data["affiliate_link"] = generate_affiliate_link(product_url)
-            product_data["original_url"] = product_url
+    readiness = _record_readiness("product", result.html)
+    products, extraction = await extract_page_products(
+        result, product_url, "product", extraction_strategy, instruction
+    )
+    extraction["readiness"] = readiness
 
-            return {
-                "success": True,
-                "product": product_data
-            }
+    if not products:
+        SCRAPES.inc(kind="product", outcome="empty")
+        return {"success": False, "error": "No product data extracted", "extraction": extraction}
+
+    product_data = products[0]
+
+    # Agregar link de afiliado
+    product_data["affiliate_link"] = generate_affiliate_link(product_url, TEMU_AFFILIATE_ID)
+    product_data["original_url"] = product_url
+
+    SCRAPES.inc(kind="product", outcome="success")
+    return {
+        "success": True,
+        "product": product_data,
+        "extraction": extraction
+    }
+
+
+async def scrape_products_batch(
+    product_urls: List[str],
+    max_concurrency: Optional[int] = None,
+    per_host_rps: Optional[float] = None,
+    progress_callback: Optional[Callable[[dict], None]] = None
+) -> dict:
+    """
+    Scrape concurrente de muchos productos sobre el pool de navegadores
 
-        except json.JSONDecodeError as e:
-            return {"success": False, "error": f"JSON parse error: {str(e)}"}
+    Args:
+        product_urls: URLs de productos (las repetidas se scrapean una vez)
+        max_concurrency: Límite global de scrapes simultáneos
+        per_host_rps: Requests por segundo por host para este batch; solo puede
+            bajar el límite compartido BATCH_PER_HOST_RPS, nunca subirlo
+        progress_callback: Se llama tras cada producto con el progreso acumulado
+
+    Returns:
+        Dict con un resultado (éxito o error) por URL, en el orden recibido
+    """
+    max_concurrency = max_concurrency or BATCH_MAX_CONCURRENCY
+    # El límite por host es global (host_rate_limiter); uno más estricto se suma solo para este batch
+    stricter = per_host_rps is not None and 0 < per_host_rps and not 0 < BATCH_PER_HOST_RPS <= per_host_rps
+    batch_limiter = HostRateLimiter(per_host_rps) if stricter else None
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    print(f"📦 Batch de {len(product_urls)} productos (concurrencia {max_concurrency})")
+
+    unique_urls = list(dict.fromkeys(product_urls))
+    progress = {"done": 0, "succeeded": 0, "total": len(unique_urls)}
+
+    async def scrape_one(url: str) -> dict:
+        async with semaphore:
+            await host_rate_limiter.acquire(url)
+            if batch_limiter:
+                await batch_limiter.acquire(url)
+            try:
+                result = await scrape_single_product(url)
+            except Exception as e:
+                # Un fallo no aborta el batch
+                result = {"success": False, "error": str(e)}
+
+        progress["done"] += 1
+        progress["succeeded"] += bool(result.get("success"))
+        if progress_callback:
+            progress_callback(progress)
+        return {"url": url, **result}
+
+    results = await asyncio.gather(*[scrape_one(url) for url in unique_urls])
+    by_url = dict(zip(unique_urls, results))
+
+    ordered = [by_url[url] for url in product_urls]
+    succeeded = sum(1 for result in results if result.get("success"))
+
+    print(f"✅ Batch completado: {succeeded}/{len(unique_urls)} productos OK")
+
+    return {
+        "success": True,
+        "total_urls": len(product_urls),
+        "unique_urls": len(unique_urls),
+        "succeeded": succeeded,
+        "failed": len(unique_urls) - succeeded,
+        "results": ordered
+    }
 
 
 # ================== FUNCIONES DE PRUEBA ==================
@@ -319,6 +1079,8 @@ async def test_search():
 
     print(f"\n💾 Resultados guardados en: temu_search_results.json")
 
+    await browser_pool.close()
+
 
 async def test_single_product():
     """Prueba de producto individual"""
@@ -332,6 +1094,8 @@ async def test_single_product():
     print("="*60)
     print(json.dumps(result, indent=2, ensure_ascii=False))
 
+    await browser_pool.close()
+
 
 # ================== MAIN ==================
 
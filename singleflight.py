@@ -0,0 +1,101 @@
+"""
+SINGLE-FLIGHT
+Coalescing de operaciones idénticas concurrentes: la primera llamada ejecuta,
+las demás esperan y reciben el mismo resultado (y, si lo piden, los eventos
+de progreso que publique la ejecución).
+"""
+
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+
+class _Flight:
+    def __init__(self):
+        self.task: Optional[asyncio.Task] = None
+        self.waiters = 0
+        self.events: List[Any] = []  # Publicados hasta ahora (se reproducen a quien se une tarde)
+        self.listeners: List[Callable[[Any], None]] = []
+
+    def publish(self, event: Any):
+        self.events.append(event)
+        for listener in list(self.listeners):
+            listener(event)
+
+
+class SingleFlight:
+    """
+    Agrupa llamadas concurrentes con la misma clave en una sola ejecución
+
+    La ejecución corre en su propia task: si quien la inició se cancela, los
+    demás siguen esperando. Solo se cancela cuando no queda nadie esperando.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._flights: Dict[Hashable, _Flight] = {}
+        self.executed = 0
+        self.coalesced = 0
+
+    async def do(
+        self,
+        key: Hashable,
+        fn: Callable[[], Awaitable[Any]],
+        listener: Optional[Callable[[Any], None]] = None
+    ) -> Tuple[Any, bool]:
+        """
+        Ejecuta fn() o se une a la ejecución en curso con la misma clave
+
+        listener recibe los eventos que fn publique con publish(key, ...): los
+        ya publicados al unirse y los siguientes según lleguen.
+
+        Returns:
+            Tupla (resultado, True si se compartió una ejecución en curso)
+        """
+        flight = self._flights.get(key)
+        shared = flight is not None
+
+        if shared:
+            self.coalesced += 1
+        else:
+            self.executed += 1
+            flight = self._flights[key] = _Flight()
+            flight.task = asyncio.create_task(fn())
+            flight.task.add_done_callback(lambda _, k=key, f=flight: self._release(k, f))
+
+        if listener:
+            for event in flight.events:
+                listener(event)
+            flight.listeners.append(listener)
+
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task), shared
+        finally:
+            if listener:
+                flight.listeners.remove(listener)
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                flight.task.cancel()
+
+    def __contains__(self, key: Hashable) -> bool:
+        """True si hay una ejecución en curso con esa clave"""
+        return key in self._flights
+
+    def publish(self, key: Hashable, event: Any):
+        """Entrega event a todos los que esperan la ejecución en curso de key"""
+        flight = self._flights.get(key)
+        if flight is not None:
+            flight.publish(event)
+
+    def _release(self, key: Hashable, flight: _Flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    def stats(self) -> dict:
+        total = self.executed + self.coalesced
+        return {
+            "in_flight": len(self._flights),
+            "executed": self.executed,
+            "coalesced": self.coalesced,
+            "coalesced_ratio": round(self.coalesced / total, 4) if total else 0.0
+        }
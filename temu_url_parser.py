@@ -6,108 +6,134 @@ and generate affiliate links.
 """
 
 import re
-from urllib.parse import urlparse, parse_qs, urlunparse
+from collections import namedtuple
+from functools import lru_cache
+from urllib.parse import unquote, urlencode
+
+# Parsed URLs kept in memory (link dumps repeat the same products a lot)
+CACHE_SIZE = 65536
+
+# Affiliate and tracking parameters removed from clean URLs
+AFFILIATE_PARAMS = {
+    '_x_ads_csite', '_x_ads_channel', '_x_ads_sub_channel',
+    '_x_sessn_id', 'top_gallery_url'
+}
+TRACKING_PREFIXES = ('refer_page_',)
+
+# scheme://netloc/path?query#fragment (RFC 3986, appendix B); much cheaper than urlsplit
+_URL = re.compile(r'^(?:([^:/?#]+):)?(?://([^/?#]*))?([^?#]*)(?:\?([^#]*))?')
+# /es/product-title-g-1234567890.html -> 1234567890
+_HTML_ID = re.compile(r'(\d+)\.html$')
+# /product-1234567890-something.html -> 1234567890 (long numeric slug part)
+_SLUG_ID = re.compile(r'(?:^|-)(\d{8,})(?=-|\.html$)')
+
+CanonicalUrl = namedtuple('CanonicalUrl', ['goods_id', 'clean_url'])
+
+
+def _is_tracking(key):
+    return key in AFFILIATE_PARAMS or key.startswith(TRACKING_PREFIXES)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def canonicalize(url):
+    """
+    Parse a Temu URL once: product ID (string or None) and clean URL
+
+    Every other function in this module is built on this one, so a URL is
+    only split, matched and rebuilt the first time it is seen.
+    """
+    scheme, netloc, path, raw_query = _URL.match(url.strip()).groups()
+    path_parts = path.split('/')
+    # Query parameters as (decoded key, raw "key=value" segment): kept segments
+    # are reused as-is, so their values stay exactly as encoded in the input
+    query = [
+        (unquote(segment.split('=', 1)[0]), segment)
+        for segment in (raw_query or '').split('&') if segment
+    ]
+
+    goods_id = None
+    html_parts = [part for part in path_parts if part.endswith('.html')]
+
+    # Temu URLs typically have the product ID at the end of the .html path part
+    for part in html_parts:
+        match = _HTML_ID.search(part)
+        if match:
+            goods_id = match.group(1)
+            break
+
+    # Otherwise from the goods_id query parameter
+    if goods_id is None:
+        goods_id = next((unquote(segment.split('=', 1)[-1]) for key, segment in query if key == 'goods_id'), None)
+
+    # Otherwise a long numeric part of the slug (last one wins)
+    if goods_id is None:
+        for part in html_parts:
+            found = _SLUG_ID.findall(part)
+            if found:
+                goods_id = found[-1]
+                break
+
+    base_url = path if netloc is None else f"//{netloc}{path}"
+    if scheme:
+        base_url = f"{scheme}:{base_url}"
+    clean_query = '&'.join(segment for key, segment in query if not _is_tracking(key))
+    clean_url = f"{base_url}?{clean_query}" if clean_query else base_url
+
+    return CanonicalUrl(goods_id, clean_url)
+
 
 def extract_product_id_from_url(url):
     """
     Extract product ID from Temu URL
     """
-    # Parse the URL
-    parsed_url = urlparse(url)
-    path_parts = parsed_url.path.split('/')
-    
-    # Look for product ID in path
-    # Temu URLs typically have product IDs in the path like:
-    # /es/product-title-1234567890.html
-    for part in path_parts:
-        if part.endswith('.html'):
-            # Extract numeric ID from the end of the path part
-            match = re.search(r'g-(\d+)\.html$', part)
-            if match:
-                return match.group(1)
-            
-            # Alternative pattern: just numbers at the end before .html
-            match = re.search(r'(\d+)\.html$', part)
-            if match:
-                return match.group(1)
-    
-    # If not found in path, try to extract from URL parameters
-    query_params = parse_qs(parsed_url.query)
-    if 'goods_id' in query_params:
-        return query_params['goods_id'][0]
-    
-    # Looking for the ID in the path segments in different formats
-    # Common pattern: /.../product-1234567890.html
-    for i, segment in enumerate(path_parts):
-        if '-' in segment and segment.endswith('.html'):
-            # Split by hyphens and look for numeric values
-            parts = segment.split('-')
-            for part in reversed(parts):  # Start from the end
-                if part.endswith('.html'):
-                    part = part.replace('.html', '')
-                if part.isdigit() and len(part) >= 8:  # Temu IDs are typically long
-                    return part
-    
-    return None
+    return canonicalize(url).goods_id
 
-def generate_affiliate_link(product_url, affiliate_id):
+
+def canonical_goods_id(url):
     """
-    Generate affiliate link for Temu product with your affiliate ID
+    Canonical goods id (int) of a Temu product URL, or None
+
+    The same item reached through different slugs, locales or tracking
+    parameters always yields the same goods id.
     """
-    # Parse the original URL
-    parsed_url = urlparse(product_url)
-    
-    # Extract the base URL and path
-    base_url = f"{parsed_url.scheme}://{parsed_url.netloc}{parsed_url.path}"
-    
-    # Parse the original query parameters
-    query_params = parse_qs(parsed_url.query)
-    
-    # Update or add affiliate parameters
-    query_params['_x_ads_csite'] = ['affiliate_seo']
-    query_params['_x_ads_channel'] = ['affiliate']
-    query_params['_x_ads_sub_channel'] = [affiliate_id]  # Your affiliate ID
-    
-    # Reconstruct the query string without creating duplicates
-    new_query = []
-    for key, values in query_params.items():
-        for value in values:
-            new_query.append(f"{key}={value}")
-    
-    affiliate_link = f"{base_url}?{'&'.join(new_query)}"
-    
-    return affiliate_link
+    if not url:
+        return None
+
+    product_id = canonicalize(url).goods_id
+    if not product_id or not product_id.isdigit():
+        return None
+
+    goods_id = int(product_id)
+    # Must fit in a signed BIGINT column
+    return goods_id if 0 < goods_id < 2 ** 63 else None
+
 
 def clean_affiliate_link(product_url):
     """
-    Remove existing affiliate parameters from a Temu URL
+    Remove existing affiliate and tracking parameters from a Temu URL
     """
-    parsed_url = urlparse(product_url)
-    query_params = parse_qs(parsed_url.query)
-    
-    # Keep only non-affiliate parameters
-    clean_params = {}
-    affiliate_params = {
-        '_x_ads_csite', '_x_ads_channel', '_x_ads_sub_channel', 
-        '_x_sessn_id', 'refer_page_name', 'refer_page_id', 
-        'refer_page_sn'
-    }
-    
-    for key, values in query_params.items():
-        if key not in affiliate_params:
-            clean_params[key] = values
-    
-    # Reconstruct the query string
-    new_query = []
-    for key, values in clean_params.items():
-        for value in values:
-            new_query.append(f"{key}={value}")
-    
-    clean_url = f"{parsed_url.scheme}://{parsed_url.netloc}{parsed_url.path}"
-    if new_query:
-        clean_url += f"?{'&'.join(new_query)}"
-    
-    return clean_url
+    return canonicalize(product_url).clean_url
+
+
+def generate_affiliate_link(product_url, affiliate_id):
+    """
+    Generate affiliate link for Temu product with your affiliate ID
+
+    Any previous affiliate/tracking parameters are replaced; parameter
+    values are URL-encoded.
+    """
+    clean_url = canonicalize(product_url).clean_url
+    separator = '&' if '?' in clean_url else '?'
+    return f"{clean_url}{separator}{_affiliate_query(affiliate_id)}"
+
+
+@lru_cache(maxsize=64)
+def _affiliate_query(affiliate_id):
+    return urlencode([
+        ('_x_ads_csite', 'affiliate_seo'),
+        ('_x_ads_channel', 'affiliate'),
+        ('_x_ads_sub_channel', affiliate_id),  # Your affiliate ID
+    ])
 
 # Example usage
 if __name__ == "__main__":
@@ -0,0 +1,86 @@
+"""
+THROTTLING
+Token buckets asíncronos y rate limiter por host
+"""
+
+import asyncio
+import time
+from typing import Dict
+from urllib.parse import urlparse
+
+
+class TokenBucket:
+    """
+    Token bucket asíncrono
+
+    rate tokens por segundo con ráfagas de hasta capacity tokens.
+    acquire() espera (en lugar de fallar) hasta que haya tokens.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self, amount: float = 1.0) -> float:
+        """
+        Consume tokens esperando lo necesario
+
+        Returns:
+            Segundos esperados
+        """
+        waited = 0.0
+        # Nunca pedir más de la capacidad o no se llenaría nunca
+        amount = min(amount, self.capacity)
+
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return waited
+
+                delay = (amount - self.tokens) / self.rate
+                waited += delay
+                await asyncio.sleep(delay)
+
+    def adjust(self, amount: float):
+        """
+        Devuelve (amount > 0) o cobra a posteriori (amount < 0) tokens
+
+        El saldo puede quedar negativo: los siguientes acquire() esperan la deuda.
+        """
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+    def pause(self, seconds: float):
+        """Nadie obtiene tokens durante al menos seconds (las pausas no se acumulan)"""
+        self._refill()
+        self.tokens = min(self.tokens, -self.rate * seconds)
+
+
+class HostRateLimiter:
+    """Un token bucket por host (www.temu.com, img.kwcdn.com, ...)"""
+
+    def __init__(self, requests_per_second: float, burst: int = 1):
+        self.requests_per_second = requests_per_second
+        self.burst = burst
+        self._buckets: Dict[str, TokenBucket] = {}
+
+    async def acquire(self, url: str) -> float:
+        """Espera el turno del host de la URL; devuelve los segundos esperados"""
+        if self.requests_per_second <= 0:
+            return 0.0
+
+        host = urlparse(url).netloc.lower()
+        bucket = self._buckets.get(host)
+        if bucket is None:
+            bucket = self._buckets[host] = TokenBucket(self.requests_per_second, self.burst)
+        return await bucket.acquire()
@@ -0,0 +1,288 @@
+"""
+TRACING
+Tiempos por etapa del scraping (lease de navegador, navegación, extracción,
+LLM, parseo, filtrado, guardado...) y métricas en formato Prometheus.
+
+Cada etapa se mide con stage("nombre"): se observa en el histograma global
+y, si hay una traza activa (trace()), se suma al desglose de esa request.
+La traza viaja en un ContextVar, así que las tasks creadas dentro (páginas
+en paralelo, chunks del LLM) suman su tiempo a la misma traza.
+"""
+
+import math
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# ================== MÉTRICAS (PROMETHEUS) ==================
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Tuple[str, ...], values: Tuple, extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _number(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """Contador monótono con etiquetas"""
+
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._values: Dict[Tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = tuple(labels.get(name, "") for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            return [
+                f"{self.name}{_labels(self.label_names, key)} {_number(value)}"
+                for key, value in sorted(self._values.items())
+            ]
+
+
+class Histogram:
+    """Histograma acumulativo (buckets + _sum + _count) con etiquetas"""
+
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._series: Dict[Tuple, list] = {}  # etiquetas -> [conteos por bucket, suma, total]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(name, "") for name in self.label_names)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][index] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def samples(self) -> List[str]:
+        lines = []
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    le = f'le="{_number(bound)}"'
+                    lines.append(f"{self.name}_bucket{_labels(self.label_names, key, le)} {cumulative}")
+                lines.append(f"{self.name}_sum{_labels(self.label_names, key)} {_number(total)}")
+                lines.append(f"{self.name}_count{_labels(self.label_names, key)} {count}")
+        return lines
+
+
+class CallbackMetric:
+    """Gauge o contador leído en cada scrape de /metrics (p. ej. de los stats() existentes)"""
+
+    def __init__(self, name: str, help: str, type: str, fn: Callable[[], object], labels: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.label_names = tuple(labels)
+        self.fn = fn
+
+    def samples(self) -> List[str]:
+        value = self.fn()
+        if not isinstance(value, dict):
+            return [f"{self.name} {_number(value)}"]
+        return [
+            f"{self.name}{_labels(self.label_names, key if isinstance(key, tuple) else (key,))} {_number(number)}"
+            for key, number in sorted(value.items())
+        ]
+
+
+class MetricsRegistry:
+    """Registro de métricas y render en el formato de texto de Prometheus"""
+
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: Iterable[str] = ()) -> Counter:
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: Iterable[str] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def gauge_function(self, name: str, help: str, fn: Callable[[], object], labels: Iterable[str] = ()):
+        return self.register(CallbackMetric(name, help, "gauge", fn, labels))
+
+    def counter_function(self, name: str, help: str, fn: Callable[[], object], labels: Iterable[str] = ()):
+        return self.register(CallbackMetric(name, help, "counter", fn, labels))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            try:
+                samples = metric.samples()
+            except Exception as e:
+                # Una métrica rota no tumba /metrics
+                lines.append(f"# {metric.name} no disponible: {_escape(e)}")
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+STAGE_SECONDS = metrics.histogram(
+    "temu_stage_duration_seconds", "Duración de cada etapa del scraping", labels=("stage",)
+)
+HTTP_SECONDS = metrics.histogram(
+    "temu_http_request_duration_seconds", "Duración de las requests HTTP", labels=("method", "route", "status")
+)
+SCRAPES = metrics.counter(
+    "temu_scrapes_total", "Scrapes terminados por tipo y resultado", labels=("kind", "outcome")
+)
+
+# ================== TRAZAS POR REQUEST ==================
+
+class Trace:
+    """Desglose de tiempos de una request o job"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self._stages: Dict[str, list] = {}  # etapa -> [segundos, veces]
+        self._lock = threading.Lock()
+
+    def add(self, name: str, seconds: float):
+        with self._lock:
+            stage_total = self._stages.setdefault(name, [0.0, 0])
+            stage_total[0] += seconds
+            stage_total[1] += 1
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def breakdown(self) -> dict:
+        """
+        Tiempo total y por etapa (ms)
+
+        Las etapas de tareas en paralelo se suman, así que pueden superar al
+        total; page_ready va incluida dentro de navigation.
+        """
+        with self._lock:
+            stages = {
+                name: {"ms": round(seconds * 1000, 1), "count": count}
+                for name, (seconds, count) in sorted(self._stages.items(), key=lambda item: -item[1][0])
+            }
+        return {"total_ms": round(self.elapsed() * 1000, 1), "stages": stages}
+
+    def server_timing(self) -> str:
+        """Cabecera Server-Timing (la ven las devtools del navegador)"""
+        with self._lock:
+            parts = [f"{name};dur={seconds * 1000:.1f}" for name, (seconds, _) in self._stages.items()]
+        parts.append(f"total;dur={self.elapsed() * 1000:.1f}")
+        return ", ".join(parts)
+
+
+_current: ContextVar[Optional[Trace]] = ContextVar("trace", default=None)
+
+
+def current_trace() -> Optional[Trace]:
+    return _current.get()
+
+
+@contextmanager
+def trace():
+    """Abre una traza nueva para el contexto actual (y las tasks que cree)"""
+    new_trace = Trace()
+    token = _current.set(new_trace)
+    try:
+        yield new_trace
+    finally:
+        try:
+            _current.reset(token)
+        except ValueError:
+            pass  # Generador async cerrado desde otro contexto: la variable ya no es nuestra
+
+
+def record(name: str, seconds: float):
+    """Registra la duración de una etapa medida fuera de stage()"""
+    STAGE_SECONDS.observe(seconds, stage=name)
+    active = _current.get()
+    if active is not None:
+        active.add(name, seconds)
+
+
+@contextmanager
+def stage(name: str):
+    """Mide el bloque como etapa name (vale también alrededor de awaits)"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - started)
+
+# ================== MIDDLEWARE HTTP ==================
+
+class TimingMiddleware:
+    """
+    Middleware ASGI: una traza por request, histograma por ruta y cabecera Server-Timing
+
+    ASGI puro (no BaseHTTPMiddleware) para no interferir con los uploads y
+    respuestas en streaming. La ruta es la plantilla (/api/jobs/{job_id}) para
+    no disparar la cardinalidad de las etiquetas.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+        with trace() as request_trace:
+            async def send_timed(message):
+                nonlocal status
+                if message["type"] == "http.response.start":
+                    status = message["status"]
+                    headers = list(message.get("headers", []))
+                    headers.append((b"server-timing", request_trace.server_timing().encode("latin-1")))
+                    message = {**message, "headers": headers}
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_timed)
+            finally:
+                route = getattr(scope.get("route"), "path", None) or "unmatched"
+                HTTP_SECONDS.observe(request_trace.elapsed(), method=scope["method"], route=route, status=str(status))